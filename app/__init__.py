@@ -2,32 +2,291 @@ from flask import Flask
 import os
 from dotenv import load_dotenv
 
+from app.backends import Backends
+from app.metrics import Metrics
+
+
+class DropItFlask(Flask):
+    """Flask app whose MongoDB and MinIO clients are created per process."""
+
+    @property
+    def mongo_db(self):
+        return self.backends.get("mongo_db")
+
+    @mongo_db.setter
+    def mongo_db(self, value):
+        self.backends.set("mongo_db", value)
+
+    @property
+    def minio_client(self):
+        return self.backends.get("minio_client")
+
+    @minio_client.setter
+    def minio_client(self, value):
+        self.backends.set("minio_client", value)
+
+    @property
+    def minio_public_client(self):
+        return self.backends.get("minio_public_client")
+
+    @minio_public_client.setter
+    def minio_public_client(self, value):
+        self.backends.set("minio_public_client", value)
+
+
 def create_app():
     BASE_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
     TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
 
     load_dotenv(dotenv_path=os.path.join(os.getcwd(), ".env.test"))
 
-    app = Flask(__name__, template_folder=TEMPLATE_DIR)
+    app = DropItFlask(__name__, template_folder=TEMPLATE_DIR)
     app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key")
+    app.config["DOWNLOAD_CHUNK_SIZE"] = int(
+        os.getenv("DOWNLOAD_CHUNK_SIZE", 256 * 1024)
+    )
+    app.config["UPLOAD_PART_SIZE"] = int(os.getenv("UPLOAD_PART_SIZE", 8 * 1024 * 1024))
+    app.config["UPLOAD_MAX_BUFFER"] = int(
+        os.getenv("UPLOAD_MAX_BUFFER", 32 * 1024 * 1024)
+    )
+    # "gzip" or "zstd" (needs the zstandard package) stores text-like uploads
+    # compressed; empty disables compression
+    app.config["STORAGE_COMPRESSION"] = os.getenv("STORAGE_COMPRESSION", "")
+    app.config["RESUMABLE_CHUNK_SIZE"] = int(
+        os.getenv("RESUMABLE_CHUNK_SIZE", 8 * 1024 * 1024)
+    )
+    app.config["RESUMABLE_PARALLEL_CHUNKS"] = int(
+        os.getenv("RESUMABLE_PARALLEL_CHUNKS", 4)
+    )
+    # Each batch upload worker buffers up to UPLOAD_MAX_BUFFER bytes
+    app.config["BATCH_UPLOAD_WORKERS"] = int(os.getenv("BATCH_UPLOAD_WORKERS", 4))
+    app.config["BATCH_MAX_FILES"] = int(os.getenv("BATCH_MAX_FILES", 500))
+    # Files at least this large are redirected to MinIO; 0 disables redirects
+    app.config["PRESIGNED_DOWNLOAD_THRESHOLD"] = int(
+        os.getenv("PRESIGNED_DOWNLOAD_THRESHOLD", 0)
+    )
+    app.config["DOWNLOAD_TOKEN_TTL"] = int(os.getenv("DOWNLOAD_TOKEN_TTL", 600))
+    app.config["DOWNLOAD_GRANT_TTL"] = int(os.getenv("DOWNLOAD_GRANT_TTL", 1800))
+    app.config["PRESIGNED_URL_EXPIRY"] = int(os.getenv("PRESIGNED_URL_EXPIRY", 300))
+    # Upper bound on how long browsers and CDNs may reuse a public download
+    app.config["DOWNLOAD_CACHE_MAX_AGE"] = int(
+        os.getenv("DOWNLOAD_CACHE_MAX_AGE", 3600)
+    )
 
-    from app.routes import main
-    app.register_blueprint(main)
+    app.config["BCRYPT_ROUNDS"] = int(os.getenv("BCRYPT_ROUNDS", 12))
+    app.config["BCRYPT_WORKERS"] = int(
+        os.getenv("BCRYPT_WORKERS", max(1, (os.cpu_count() or 2) // 2))
+    )
+    app.config["BCRYPT_MAX_QUEUE"] = int(os.getenv("BCRYPT_MAX_QUEUE", 32))
+    app.config["PASSWORD_MAX_FAILURES"] = int(os.getenv("PASSWORD_MAX_FAILURES", 5))
+    app.config["PASSWORD_FAILURE_WINDOW"] = int(
+        os.getenv("PASSWORD_FAILURE_WINDOW", 300)
+    )
+
+    app.config["METADATA_CACHE_SIZE"] = int(os.getenv("METADATA_CACHE_SIZE", 10000))
+    app.config["METADATA_CACHE_TTL"] = int(os.getenv("METADATA_CACHE_TTL", 10))
 
-    from pymongo import MongoClient
-    from minio import Minio
+    # Local disk copies of hot objects; 0 disables the cache
+    app.config["OBJECT_CACHE_SIZE"] = int(os.getenv("OBJECT_CACHE_SIZE", 0))
+    app.config["OBJECT_CACHE_MAX_OBJECT_SIZE"] = int(
+        os.getenv("OBJECT_CACHE_MAX_OBJECT_SIZE", 64 * 1024 * 1024)
+    )
+    app.config["OBJECT_CACHE_DIR"] = os.getenv(
+        "OBJECT_CACHE_DIR", os.path.join(BASE_DIR, "dropit_uploads", "cache")
+    )
 
-    app.mongo_db = MongoClient(os.getenv("MONGO_URI", "mongodb://localhost:27017"))[
-        os.getenv("MONGO_DBNAME", "dropit")
-    ]
+    # Download shaping; every limit is in bytes per second and 0 disables it
+    app.config["TRANSFER_MAX_ACTIVE"] = int(os.getenv("TRANSFER_MAX_ACTIVE", 0))
+    app.config["TRANSFER_MAX_QUEUE"] = int(os.getenv("TRANSFER_MAX_QUEUE", 64))
+    app.config["TRANSFER_QUEUE_TIMEOUT"] = float(
+        os.getenv("TRANSFER_QUEUE_TIMEOUT", 30)
+    )
+    app.config["EGRESS_RATE_LIMIT"] = int(os.getenv("EGRESS_RATE_LIMIT", 0))
+    app.config["CLIENT_RATE_LIMIT"] = int(os.getenv("CLIENT_RATE_LIMIT", 0))
+    app.config["DOWNLOAD_RATE_LIMIT"] = int(os.getenv("DOWNLOAD_RATE_LIMIT", 0))
+
+    # Buffered download events and counters; 0 disables the log, and then every
+    # download is counted with its own write
+    app.config["DOWNLOAD_LOG_BUFFER"] = int(os.getenv("DOWNLOAD_LOG_BUFFER", 0))
+    app.config["DOWNLOAD_LOG_FLUSH_SIZE"] = int(
+        os.getenv("DOWNLOAD_LOG_FLUSH_SIZE", 500)
+    )
+    app.config["DOWNLOAD_LOG_FLUSH_INTERVAL"] = float(
+        os.getenv("DOWNLOAD_LOG_FLUSH_INTERVAL", 5)
+    )
+
+    # Thumbnails and text excerpts made after upload; 0 workers disables them.
+    # Images and PDFs need the optional Pillow and PyMuPDF packages.
+    app.config["PREVIEW_WORKERS"] = int(os.getenv("PREVIEW_WORKERS", 0))
+    app.config["PREVIEW_MAX_SOURCE_SIZE"] = int(
+        os.getenv("PREVIEW_MAX_SOURCE_SIZE", 64 * 1024 * 1024)
+    )
+    app.config["PREVIEW_THUMBNAIL_SIZE"] = int(os.getenv("PREVIEW_THUMBNAIL_SIZE", 480))
+    app.config["PREVIEW_TEXT_BYTES"] = int(os.getenv("PREVIEW_TEXT_BYTES", 8192))
+    app.config["PREVIEW_CACHE_MAX_AGE"] = int(
+        os.getenv("PREVIEW_CACHE_MAX_AGE", 30 * 86400)
+    )
+
+    # Bearer token for the operator API (GET /files); empty disables it
+    app.config["ADMIN_TOKEN"] = os.getenv("ADMIN_TOKEN", "")
+    app.config["LISTING_PAGE_SIZE"] = int(os.getenv("LISTING_PAGE_SIZE", 100))
+
+    app.config["REAPER_INTERVAL"] = int(os.getenv("REAPER_INTERVAL", 300))
+    app.config["REAPER_BATCH_SIZE"] = int(os.getenv("REAPER_BATCH_SIZE", 500))
+    app.config["UPLOAD_SESSION_TTL"] = int(os.getenv("UPLOAD_SESSION_TTL", 86400))
+
+    # Return from uploads once the bytes are staged and finish them in the background
+    app.config["ASYNC_UPLOAD_FINALIZE"] = bool(
+        int(os.getenv("ASYNC_UPLOAD_FINALIZE", 0))
+    )
+    app.config["FINALIZE_WORKERS"] = int(os.getenv("FINALIZE_WORKERS", 2))
+    app.config["FINALIZE_MAX_ATTEMPTS"] = int(os.getenv("FINALIZE_MAX_ATTEMPTS", 5))
+    app.config["FINALIZE_RETRY_BACKOFF"] = float(os.getenv("FINALIZE_RETRY_BACKOFF", 2))
+    # Where uploads wait for the finalizer; it has to be on local disk
+    app.config["UPLOAD_STAGING_DIR"] = os.getenv(
+        "UPLOAD_STAGING_DIR", os.path.join(BASE_DIR, "dropit_uploads", "staging")
+    )
 
-    app.minio_client = Minio(
-        os.getenv("MINIO_URL", "localhost:9000").replace("http://", ""),
-        access_key=os.getenv("MINIO_ACCESS_KEY", "minio_access_key"),
-        secret_key=os.getenv("MINIO_SECRET_KEY", "minio_secret_key"),
-        secure=False,
+    app.config["MONGO_URI"] = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+    app.config["MONGO_DBNAME"] = os.getenv("MONGO_DBNAME", "dropit")
+    app.config["MONGO_MAX_POOL_SIZE"] = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+    app.config["MONGO_CONNECT_TIMEOUT_MS"] = int(
+        os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000)
     )
+    app.config["MONGO_SERVER_SELECTION_TIMEOUT_MS"] = int(
+        os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)
+    )
+    # 0 means no timeout
+    app.config["MONGO_SOCKET_TIMEOUT_MS"] = int(
+        os.getenv("MONGO_SOCKET_TIMEOUT_MS", 30000)
+    )
+    app.config["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = int(
+        os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000)
+    )
+
+    app.config["MINIO_URL"] = os.getenv("MINIO_URL", "localhost:9000")
+    app.config["MINIO_ACCESS_KEY"] = os.getenv("MINIO_ACCESS_KEY", "minio_access_key")
+    app.config["MINIO_SECRET_KEY"] = os.getenv("MINIO_SECRET_KEY", "minio_secret_key")
+    app.config["MINIO_PUBLIC_URL"] = os.getenv("MINIO_PUBLIC_URL")
+    app.config["MINIO_REGION"] = os.getenv("MINIO_REGION", "us-east-1")
+    app.config["MINIO_POOL_SIZE"] = int(os.getenv("MINIO_POOL_SIZE", 32))
+    app.config["MINIO_CONNECT_TIMEOUT"] = float(os.getenv("MINIO_CONNECT_TIMEOUT", 5))
+    app.config["MINIO_READ_TIMEOUT"] = float(os.getenv("MINIO_READ_TIMEOUT", 300))
+    app.config["MINIO_MAX_RETRIES"] = int(os.getenv("MINIO_MAX_RETRIES", 3))
+    # Extra endpoints, as "name=http://host:9000/bucket,..."; new objects are
+    # spread over these and MINIO_URL by consistent hashing on the file id
+    app.config["MINIO_SHARDS"] = os.getenv("MINIO_SHARDS", "")
+    app.config["REBALANCE_INTERVAL"] = int(os.getenv("REBALANCE_INTERVAL", 600))
+    app.config["REBALANCE_BATCH_SIZE"] = int(os.getenv("REBALANCE_BATCH_SIZE", 100))
+    # How long a moved object's old copy stays readable
+    app.config["REBALANCE_GRACE"] = int(os.getenv("REBALANCE_GRACE", 3600))
+
+    app.metrics = Metrics()
+    # Clients are created on first use in each process, never at import time
+    app.backends = Backends(app.config, app.metrics)
     app.bucket_name = os.getenv("MINIO_BUCKET_NAME", "dropit-storage")
 
-    return app
+    from app.analytics import DownloadLog
+    from app.bootstrap import StorageBootstrap
+    from app.cache import MetadataCache
+    from app.finalizer import UploadFinalizer
+    from app.objectcache import ObjectCache
+    from app.passwords import AttemptLimiter, PasswordHasher
+    from app.previews import PreviewGenerator
+    from app.reaper import ExpiryReaper, migrate_expiration_dates
+    from app.shaping import TransferScheduler
+    from app.sharding import StorageRebalancer, StorageRouter
+
+    app.storage = StorageRouter.from_app(app)
+    app.storage_rebalancer = StorageRebalancer(
+        app,
+        app.config["REBALANCE_INTERVAL"],
+        app.config["REBALANCE_BATCH_SIZE"],
+        app.config["REBALANCE_GRACE"],
+    )
+
+    app.metadata_cache = MetadataCache(
+        app.config["METADATA_CACHE_SIZE"], app.config["METADATA_CACHE_TTL"]
+    )
+
+    app.object_cache = ObjectCache(
+        app.config["OBJECT_CACHE_DIR"],
+        app.config["OBJECT_CACHE_SIZE"],
+        app.config["OBJECT_CACHE_MAX_OBJECT_SIZE"],
+    )
+
+    app.download_log = DownloadLog(
+        app,
+        app.config["DOWNLOAD_LOG_BUFFER"],
+        app.config["DOWNLOAD_LOG_FLUSH_SIZE"],
+        app.config["DOWNLOAD_LOG_FLUSH_INTERVAL"],
+    )
 
+    app.transfer_scheduler = TransferScheduler(
+        app.config["TRANSFER_MAX_ACTIVE"],
+        app.config["TRANSFER_MAX_QUEUE"],
+        app.config["TRANSFER_QUEUE_TIMEOUT"],
+        app.config["EGRESS_RATE_LIMIT"],
+        app.config["CLIENT_RATE_LIMIT"],
+        app.config["DOWNLOAD_RATE_LIMIT"],
+    )
+
+    app.password_hasher = PasswordHasher(
+        app.config["BCRYPT_WORKERS"], app.config["BCRYPT_MAX_QUEUE"]
+    )
+    app.password_attempts = AttemptLimiter(
+        app.config["PASSWORD_MAX_FAILURES"], app.config["PASSWORD_FAILURE_WINDOW"]
+    )
+
+    app.expiry_reaper = ExpiryReaper(
+        app,
+        app.config["REAPER_INTERVAL"],
+        app.config["REAPER_BATCH_SIZE"],
+        app.config["UPLOAD_SESSION_TTL"],
+    )
+
+    app.storage_bootstrap = StorageBootstrap(app)
+
+    app.preview_generator = PreviewGenerator(
+        app,
+        app.config["PREVIEW_WORKERS"],
+        app.config["PREVIEW_MAX_SOURCE_SIZE"],
+        app.config["PREVIEW_THUMBNAIL_SIZE"],
+        app.config["PREVIEW_TEXT_BYTES"],
+    )
+
+    app.upload_finalizer = UploadFinalizer(
+        app,
+        app.config["FINALIZE_WORKERS"],
+        app.config["FINALIZE_MAX_ATTEMPTS"],
+        app.config["FINALIZE_RETRY_BACKOFF"],
+        app.config["UPLOAD_STAGING_DIR"],
+    )
+
+    @app.cli.command("migrate-expiry")
+    def migrate_expiry_command():
+        """Convert string expiration dates to BSON datetimes."""
+        migrated = migrate_expiration_dates(app.mongo_db["files"])
+        print(f"Migrated {migrated} expiration dates")
+
+    @app.cli.command("reap-expired")
+    def reap_expired_command():
+        """Delete expired files from MongoDB and MinIO once."""
+        print(app.expiry_reaper.run_once())
+
+    @app.cli.command("rebalance-storage")
+    def rebalance_storage_command():
+        """Move objects to the shards the current ring places them on."""
+        print(app.storage_rebalancer.run_once())
+
+    @app.cli.command("bootstrap")
+    def bootstrap_command():
+        """Create the MinIO buckets and MongoDB indexes."""
+        app.storage_bootstrap.ensure()
+        print(app.storage_bootstrap.status())
+
+    from app.routes import main
+
+    app.register_blueprint(main)
+
+    return app
@@ -0,0 +1,252 @@
+import atexit
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+
+COUNTER_FIELDS = ("downloads", "bytes_served", "completed", "aborted", "failed")
+
+
+class DownloadLog:
+    """Write-behind log of downloads with per-file counters.
+
+    Events go into a bounded ring buffer and counters are summed per file in
+    memory; a background thread writes both out every ``flush_interval``
+    seconds, or sooner once ``flush_size`` events are waiting. A hot file
+    costs one counter update per flush however often it is downloaded. When
+    the buffer is full the oldest events are dropped instead of blocking
+    downloads; counters are never dropped.
+    """
+
+    def __init__(self, app, capacity, flush_size, flush_interval):
+        self.app = app
+        self.capacity = capacity
+        self.flush_size = max(1, min(flush_size, capacity or flush_size))
+        self.flush_interval = flush_interval
+        self._events = deque(maxlen=capacity or None)
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.recorded = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.events_written = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return
+            self._thread = threading.Thread(
+                target=self._loop, name="download-log", daemon=True
+            )
+            self._thread.start()
+        # Whatever is still buffered is written when the process exits cleanly
+        atexit.register(self.flush)
+
+    def record(self, event, count=False):
+        """Buffer one download ``event``.
+
+        ``count`` adds it to the file's ``download_count`` on the next flush,
+        for downloads that weren't counted when they started.
+        """
+        counts = count and event["status"] != "failed"
+        with self._lock:
+            if len(self._events) == self.capacity:
+                self.dropped += 1
+            self._events.append(event)
+            self.recorded += 1
+            totals = self._counters.get(event["file_id"])
+            if totals is None:
+                totals = self._counters[event["file_id"]] = new_totals()
+            add_event(totals, event, counts)
+            due = len(self._events) >= self.flush_size
+        if due:
+            if self._thread is None:
+                self.flush()
+            else:
+                self._wake.set()
+
+    def flush(self):
+        """Write buffered events and counters to Mongo; returns events written."""
+        with self._flush_lock:
+            with self._lock:
+                events = list(self._events)
+                self._events.clear()
+                counters, self._counters = self._counters, {}
+            if not events and not counters:
+                return 0
+
+            mongo_db = self.app.mongo_db
+            written = 0
+            if events:
+                try:
+                    mongo_db["download_events"].insert_many(events, ordered=False)
+                    written = len(events)
+                except BulkWriteError as e:
+                    print(f"Error writing download events: {str(e)}")
+                    # Only the events that weren't written go back; a duplicate
+                    # key means an earlier attempt already wrote that one
+                    failed = [
+                        events[error["index"]]
+                        for error in e.details.get("writeErrors", [])
+                        if error.get("code") != DUPLICATE_KEY
+                    ]
+                    written = e.details.get("nInserted", 0)
+                    if failed:
+                        self._requeue(failed)
+                except Exception as e:
+                    print(f"Error writing download events: {str(e)}")
+                    # They keep the _id insert_many gave them, so a retry skips
+                    # any that were written before the error
+                    self._requeue(events)
+
+            for file_id, totals in counters.items():
+                try:
+                    self._apply(mongo_db, file_id, totals)
+                except Exception as e:
+                    print(f"Error updating download counters for {file_id}: {str(e)}")
+                    self._merge(file_id, totals)
+
+            with self._lock:
+                self.flushes += 1
+                self.events_written += written
+            return written
+
+    def _apply(self, mongo_db, file_id, totals):
+        mongo_db["download_stats"].update_one(
+            {"_id": file_id},
+            {
+                "$inc": {field: totals[field] for field in COUNTER_FIELDS},
+                "$max": {"last_download": totals["last_download"]},
+            },
+            upsert=True,
+        )
+        if totals["counted"]:
+            mongo_db["files"].update_one(
+                {"_id": file_id}, {"$inc": {"download_count": totals["counted"]}}
+            )
+            self.app.metadata_cache.invalidate(file_id)
+
+    def _requeue(self, events):
+        with self._lock:
+            self.flush_errors += 1
+            # Newer events win if the buffer filled up in the meantime
+            overflow = max(len(events) - (self.capacity - len(self._events)), 0)
+            self.dropped += overflow
+            self._events.extendleft(reversed(events[overflow:]))
+
+    def _merge(self, file_id, totals):
+        with self._lock:
+            self.flush_errors += 1
+            pending = self._counters.get(file_id)
+            if pending is None:
+                self._counters[file_id] = totals
+                return
+            for field in COUNTER_FIELDS + ("counted",):
+                pending[field] += totals[field]
+            pending["last_download"] = max(
+                pending["last_download"], totals["last_download"]
+            )
+
+    def _loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing download log: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "buffered": len(self._events),
+                "pending_files": len(self._counters),
+                "recorded": self.recorded,
+                "dropped": self.dropped,
+                "flushes": self.flushes,
+                "flush_errors": self.flush_errors,
+                "events_written": self.events_written,
+            }
+
+
+def new_totals():
+    totals = dict.fromkeys(COUNTER_FIELDS, 0)
+    totals["counted"] = 0
+    totals["last_download"] = None
+    return totals
+
+
+def add_event(totals, event, counts):
+    if not event["resumed"]:
+        totals["downloads"] += 1
+    totals["bytes_served"] += event["bytes"]
+    if event["status"] in ("completed", "aborted", "failed"):
+        totals[event["status"]] += 1
+    totals["counted"] += int(counts)
+    if totals["last_download"] is None or event["time"] > totals["last_download"]:
+        totals["last_download"] = event["time"]
+
+
+def download_event(file_id, client, user_agent, resumed, status=None):
+    return {
+        "file_id": file_id,
+        "time": datetime.now(timezone.utc),
+        "client": client,
+        "user_agent": (user_agent or "")[:256],
+        "resumed": resumed,
+        "bytes": 0,
+        "status": status,
+        "duration": 0.0,
+    }
+
+
+class RecordedBody:
+    """Response body that logs its download once the server closes it.
+
+    The status is ``completed`` if every byte was handed to the server,
+    ``failed`` if reading the object raised, and ``aborted`` otherwise,
+    e.g. when the client disconnected.
+    """
+
+    def __init__(self, body, log, event, count=False):
+        self.body = body
+        self.log = log
+        self.event = event
+        self.count = count
+        self._started = time.perf_counter()
+        self._recorded = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.body:
+                self.event["bytes"] += len(chunk)
+                yield chunk
+        except Exception:
+            self.event["status"] = "failed"
+            raise
+        self.event["status"] = "completed"
+
+    def close(self):
+        try:
+            close = getattr(self.body, "close", None)
+            if close:
+                close()
+        finally:
+            if not self._recorded:
+                self._recorded = True
+                self.event["status"] = self.event["status"] or "aborted"
+                self.event["duration"] = round(time.perf_counter() - self._started, 6)
+                self.log.record(self.event, self.count)
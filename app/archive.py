@@ -0,0 +1,142 @@
+import zipfile
+from datetime import datetime
+
+from app.compression import DecodedStream
+from app.storage import stream_object
+
+
+class ArchiveEntry:
+    """One MinIO object to be added to a streamed ZIP."""
+
+    def __init__(
+        self,
+        name,
+        object_name,
+        size,
+        compress,
+        modified=None,
+        codec=None,
+        storage=None,
+    ):
+        self.name = name
+        self.object_name = object_name
+        self.size = size
+        self.compress = compress
+        self.modified = modified
+        # Set when the object is stored compressed; members hold decoded bytes
+        self.codec = codec
+        # (minio, bucket_name) holding the object, when it isn't the stream's
+        self.storage = storage
+
+
+class _Sink:
+    """Write-only target for ``ZipFile`` that is drained after every write.
+
+    It has no ``tell`` or ``seek``, so ``zipfile`` writes sizes and CRCs in
+    data descriptors after each member instead of seeking back to patch them.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def unique_names(names):
+    """Suffix repeated archive member names so none are overwritten on extract."""
+    seen = set()
+    unique = []
+    for name in names:
+        candidate = name
+        stem, dot, extension = name.rpartition(".")
+        if not stem:
+            stem, dot, extension = name, "", ""
+        counter = 1
+        while candidate in seen:
+            candidate = f"{stem} ({counter}){dot}{extension}"
+            counter += 1
+        seen.add(candidate)
+        unique.append(candidate)
+    return unique
+
+
+class ZipStream:
+    """ZIP body assembled while it is sent, one MinIO chunk at a time.
+
+    Memory use is bounded by the download chunk size and the compressor's
+    window, regardless of how many or how large the members are.
+    """
+
+    def __init__(self, minio, bucket_name, entries, chunk_size, on_error=None):
+        self.minio = minio
+        self.bucket_name = bucket_name
+        self.entries = entries
+        self.chunk_size = chunk_size
+        self.on_error = on_error
+        self._current = None
+
+    def __iter__(self):
+        sink = _Sink()
+        try:
+            with zipfile.ZipFile(sink, mode="w", allowZip64=True) as archive:
+                for entry in self.entries:
+                    info = zipfile.ZipInfo(entry.name, zip_date_time(entry.modified))
+                    info.compress_type = (
+                        zipfile.ZIP_DEFLATED if entry.compress else zipfile.ZIP_STORED
+                    )
+                    # Lets zipfile decide up front whether the member needs ZIP64
+                    info.file_size = entry.size or 0
+
+                    minio, bucket_name = entry.storage or (
+                        self.minio,
+                        self.bucket_name,
+                    )
+                    self._current = stream_object(
+                        minio,
+                        bucket_name,
+                        entry.object_name,
+                        self.chunk_size,
+                        on_error=self.on_error,
+                    )
+                    if entry.codec:
+                        self._current = DecodedStream(
+                            self._current, entry.codec, self.chunk_size
+                        )
+                    with archive.open(info, mode="w") as member:
+                        for chunk in self._current:
+                            member.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+                    self._current = None
+            # Member trailers and the central directory
+            yield sink.drain()
+        except Exception as e:
+            print(f"Error streaming archive: {str(e)}")
+            # ObjectStream already reported failures that happened mid-object
+            if self._current is None and self.on_error:
+                self.on_error()
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+
+
+def zip_date_time(value):
+    # ZIP timestamps can't predate 1980
+    if not isinstance(value, datetime) or value.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return value.timetuple()[:6]
@@ -0,0 +1,112 @@
+import os
+import threading
+
+import certifi
+import urllib3
+from minio import Minio
+from pymongo import MongoClient
+
+from app.metrics import MongoCommandTimer, TimedClient
+
+
+class Backends:
+    """MongoDB and MinIO clients, created on first use in each process.
+
+    Neither client survives a fork: pymongo's monitor threads and urllib3's
+    sockets would be shared with the parent. Clients are therefore built
+    lazily and rebuilt when the process id changes, which also keeps
+    ``create_app`` from blocking on the backends.
+    """
+
+    def __init__(self, settings, metrics=None):
+        self.settings = settings
+        self.metrics = metrics
+        self._clients = {}
+        self._overrides = {}
+        self._pid = os.getpid()
+        # Reentrant: building mongo_db looks up mongo_client
+        self._lock = threading.RLock()
+
+    def get(self, name, create=None):
+        if name in self._overrides:
+            return self._overrides[name]
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: drop the parent's clients without closing their sockets
+                self._clients = {}
+                self._pid = os.getpid()
+            if name not in self._clients:
+                create = create or getattr(self, f"_create_{name}")
+                self._clients[name] = create()
+            return self._clients[name]
+
+    def set(self, name, client):
+        self._overrides[name] = client
+
+    def _create_mongo_client(self):
+        settings = self.settings
+        return MongoClient(
+            settings["MONGO_URI"],
+            maxPoolSize=settings["MONGO_MAX_POOL_SIZE"],
+            connectTimeoutMS=settings["MONGO_CONNECT_TIMEOUT_MS"],
+            serverSelectionTimeoutMS=settings["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+            socketTimeoutMS=settings["MONGO_SOCKET_TIMEOUT_MS"] or None,
+            waitQueueTimeoutMS=settings["MONGO_WAIT_QUEUE_TIMEOUT_MS"] or None,
+            event_listeners=[MongoCommandTimer(self.metrics)] if self.metrics else [],
+        )
+
+    def _create_mongo_db(self):
+        return self.get("mongo_client")[self.settings["MONGO_DBNAME"]]
+
+    def _create_minio_client(self):
+        return self.create_minio(
+            self.settings["MINIO_URL"],
+            self.settings["MINIO_ACCESS_KEY"],
+            self.settings["MINIO_SECRET_KEY"],
+            "minio",
+        )
+
+    def create_minio(self, url, access_key, secret_key, backend):
+        settings = self.settings
+        # Parallel part uploads and batch workers each hold a connection, so
+        # the pool is sized for them rather than urllib3's default of 10
+        http_client = urllib3.PoolManager(
+            num_pools=4,
+            maxsize=settings["MINIO_POOL_SIZE"],
+            timeout=urllib3.Timeout(
+                connect=settings["MINIO_CONNECT_TIMEOUT"],
+                read=settings["MINIO_READ_TIMEOUT"],
+            ),
+            retries=urllib3.Retry(
+                total=settings["MINIO_MAX_RETRIES"],
+                backoff_factor=0.2,
+                status_forcelist=[500, 502, 503, 504],
+            ),
+            cert_reqs="CERT_REQUIRED",
+            ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        )
+        client = Minio(
+            url.replace("http://", "").replace("https://", ""),
+            access_key=access_key,
+            secret_key=secret_key,
+            secure=url.startswith("https://"),
+            http_client=http_client,
+        )
+        if self.metrics:
+            return TimedClient(client, self.metrics, backend)
+        return client
+
+    def _create_minio_public_client(self):
+        # Presigned URLs embed the host they were signed for, so sign them
+        # against the address browsers can reach when it differs from the
+        # internal one. Signing is local, so this client never connects.
+        public_url = self.settings["MINIO_PUBLIC_URL"]
+        if not public_url:
+            return None
+        return Minio(
+            public_url.replace("http://", "").replace("https://", ""),
+            access_key=self.settings["MINIO_ACCESS_KEY"],
+            secret_key=self.settings["MINIO_SECRET_KEY"],
+            secure=public_url.startswith("https://"),
+            region=self.settings["MINIO_REGION"],
+        )
@@ -0,0 +1,134 @@
+from datetime import datetime, timezone
+
+from pymongo import ReturnDocument
+
+from app.sharding import DEFAULT_SHARD
+from app.storage import compose_parts, remove_objects
+
+
+def make_blob_id(digest, codec=None):
+    # Compressed and raw copies of the same content are separate blobs; the
+    # digest, and with it the file ETag, is that of the uncompressed content
+    if codec:
+        return f"{codec}+sha256:{digest}"
+    return f"sha256:{digest}"
+
+
+def blob_object_name(blob_id, owner_id):
+    # The creating file's id keeps a re-created blob from reusing the name of
+    # one that is still being deleted
+    digest = blob_id.rsplit(":", 1)[-1]
+    return f"blobs/{digest}/{owner_id}"
+
+
+def store_blob(
+    blobs_collection,
+    minio,
+    bucket_name,
+    source_names,
+    blob_id,
+    size,
+    owner_id,
+    shard=DEFAULT_SHARD,
+):
+    """Turn staged objects into a reference to the blob with the same content.
+
+    ``source_names`` are concatenated in order to form the content, on the
+    storage ``shard`` that ``minio`` and ``bucket_name`` point at. Returns the
+    object name holding it, whether it was already stored, and the shard it
+    is stored on, which for a duplicate may be another one. The sources are
+    always consumed: a single source becomes the new blob, several are
+    composed into one, and duplicates are deleted unless they already are
+    the blob.
+    """
+    existing = blobs_collection.find_one_and_update(
+        {"_id": blob_id},
+        {"$inc": {"refcount": 1}},
+        projection={"object_name": 1, "shard": 1},
+    )
+    if existing:
+        # A retried or repeated call may pass the blob's own object back in
+        remove_objects(
+            minio,
+            bucket_name,
+            [name for name in source_names if name != existing["object_name"]],
+        )
+        return existing["object_name"], True, existing.get("shard") or DEFAULT_SHARD
+
+    if len(source_names) == 1:
+        # The uploaded object's name is already unique to its file, so it
+        # becomes the blob as-is instead of being copied inside MinIO
+        object_name = source_names[0]
+        stale = []
+    else:
+        object_name = blob_object_name(blob_id, owner_id)
+        compose_parts(minio, bucket_name, object_name, source_names)
+        stale = list(source_names)
+
+    blob = blobs_collection.find_one_and_update(
+        {"_id": blob_id},
+        {
+            "$inc": {"refcount": 1},
+            "$setOnInsert": {
+                "object_name": object_name,
+                "size": size,
+                "shard": shard,
+                # The rebalancer places the blob by the id its shard was
+                # chosen from, which object names don't always end in
+                "placement_key": owner_id,
+                "created_at": datetime.now(timezone.utc),
+            },
+        },
+        projection={"object_name": 1, "shard": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+    # Lost a race with an identical upload: keep theirs, drop our copy
+    if blob["object_name"] != object_name:
+        stale.append(object_name)
+    remove_objects(minio, bucket_name, stale)
+    return (
+        blob["object_name"],
+        blob["object_name"] != object_name,
+        blob.get("shard") or DEFAULT_SHARD,
+    )
+
+
+def release_blobs(blobs_collection, blob_ids):
+    """Drop one reference per entry.
+
+    Returns the ``(shard, object_name)`` pairs that are now unused, including
+    the old copy of a blob the rebalancer hasn't purged yet.
+    """
+    counts = {}
+    for blob_id in blob_ids:
+        counts[blob_id] = counts.get(blob_id, 0) + 1
+
+    unused = []
+    for blob_id, count in counts.items():
+        blob = blobs_collection.find_one_and_update(
+            {"_id": blob_id},
+            {"$inc": {"refcount": -count}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if not blob or blob["refcount"] > 0:
+            continue
+        # A new reference may have arrived since the decrement; only delete
+        # the blob if it is still unreferenced
+        deleted = blobs_collection.find_one_and_delete(
+            {"_id": blob_id, "refcount": {"$lte": 0}}
+        )
+        if deleted:
+            unused.append(
+                (deleted.get("shard") or DEFAULT_SHARD, deleted["object_name"])
+            )
+            moved_from = deleted.get("moved_from")
+            if moved_from:
+                unused.append(
+                    (
+                        moved_from["shard"],
+                        moved_from.get("object_name", deleted["object_name"]),
+                    )
+                )
+    return unused
@@ -0,0 +1,112 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+from minio.error import S3Error
+from pymongo import ASCENDING
+
+from app.listing import ensure_listing_indexes
+
+
+def ensure_bucket(minio, bucket_name):
+    if minio.bucket_exists(bucket_name):
+        return False
+    try:
+        minio.make_bucket(bucket_name)
+    except S3Error as e:
+        # Another process created it first
+        if e.code not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+            raise
+        return False
+    return True
+
+
+def ensure_indexes(mongo_db):
+    mongo_db["files"].create_index([("expiration_date", ASCENDING)])
+    mongo_db["files"].create_index([("status", ASCENDING)], sparse=True)
+    ensure_listing_indexes(mongo_db["files"])
+    # The rebalancer repoints every file sharing a blob it moved
+    mongo_db["files"].create_index([("blob_id", ASCENDING)], sparse=True)
+    mongo_db["blobs"].create_index([("moved_from.at", ASCENDING)], sparse=True)
+    mongo_db["bundles"].create_index([("expiration_date", ASCENDING)])
+    mongo_db["upload_sessions"].create_index([("created_at", ASCENDING)])
+    mongo_db["download_grants"].create_index(
+        [("expires_at", ASCENDING)], expireAfterSeconds=0
+    )
+    mongo_db["download_events"].create_index(
+        [("file_id", ASCENDING), ("time", ASCENDING)]
+    )
+
+
+class StorageBootstrap:
+    """Creates the buckets and indexes and warms up connections, once per process.
+
+    Upload paths call ``ensure`` instead of checking the bucket on every
+    request; after the first success it returns without any I/O.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.ready = False
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.duration = None
+        self.bucket_created = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        if self.ready:
+            return
+        with self._lock:
+            if not self.ready:
+                self._run()
+
+    def start(self):
+        """Warm up in the background so the first upload doesn't pay for it."""
+        with self._lock:
+            if self._thread is not None or self.ready:
+                return
+            self._thread = threading.Thread(
+                target=self._warm_up, name="storage-bootstrap", daemon=True
+            )
+            self._thread.start()
+
+    def _warm_up(self):
+        try:
+            self.ensure()
+        except Exception as e:
+            print(f"Error bootstrapping storage: {str(e)}")
+
+    def _run(self):
+        app = self.app
+        self.started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        try:
+            # Opens the Mongo pool and fails fast if the server is unreachable
+            app.mongo_db.command("ping")
+            ensure_indexes(app.mongo_db)
+            self.bucket_created = False
+            for shard in app.storage.shards.values():
+                if ensure_bucket(shard.client, shard.bucket_name):
+                    self.bucket_created = True
+        except Exception as e:
+            self.error = str(e)
+            raise
+        self.duration = time.perf_counter() - started
+        self.finished_at = datetime.now(timezone.utc)
+        self.error = None
+        self.ready = True
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "duration_seconds": round(self.duration, 3)
+            if self.duration is not None
+            else None,
+            "bucket_created": self.bucket_created,
+        }
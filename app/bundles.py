@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from app.blobs import make_blob_id, release_blobs, store_blob
+from app.compression import probe
+from app.storage import put_stream
+
+
+def upload_object_name(file_id):
+    return f"objects/{file_id}"
+
+
+def store_files(
+    router,
+    blobs_collection,
+    uploads,
+    part_size,
+    max_buffer,
+    workers,
+):
+    """Upload several streams to MinIO at once and turn each into a blob.
+
+    ``uploads`` is a list of ``(file_id, stream, content_type, codec)``, where
+    ``codec`` is the compression to try for that file, if any. Each file goes
+    to the shard ``router`` places it on. Returns a ``{file_id: (object_name,
+    blob_id, size, codec, shard)}`` mapping. If any upload fails, the blobs
+    already stored for the batch are released before re-raising.
+    """
+
+    def store(file_id, stream, content_type, codec):
+        shard = router.place(file_id)
+        upload_name = upload_object_name(file_id)
+        stream, codec = probe(stream, codec)
+        size, digest = put_stream(
+            shard.client,
+            shard.bucket_name,
+            upload_name,
+            stream,
+            content_type,
+            part_size,
+            max_buffer,
+            codec,
+        )
+        router.record(shard, "write", size)
+        blob_id = make_blob_id(digest, codec)
+        object_name, _, blob_shard = store_blob(
+            blobs_collection,
+            shard.client,
+            shard.bucket_name,
+            [upload_name],
+            blob_id,
+            size,
+            file_id,
+            shard.name,
+        )
+        return object_name, blob_id, size, codec, blob_shard
+
+    # Each worker buffers up to max_buffer bytes, so the pool bounds memory too
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(workers, len(uploads))),
+        thread_name_prefix="batch-upload",
+    ) as executor:
+        futures = {
+            file_id: executor.submit(store, file_id, stream, content_type, codec)
+            for file_id, stream, content_type, codec in uploads
+        }
+
+    stored = {}
+    failed = []
+    error = None
+    for file_id, future in futures.items():
+        try:
+            stored[file_id] = future.result()
+        except Exception as e:
+            failed.append(file_id)
+            error = error or e
+
+    if error is not None:
+        discard_files(router, blobs_collection, stored.values())
+        router.remove(
+            (router.place(file_id).name, upload_object_name(file_id))
+            for file_id in failed
+        )
+        raise error
+    return stored
+
+
+def discard_files(router, blobs_collection, stored):
+    """Undo ``store_files`` for entries that never got a file document."""
+    blob_ids = [blob_id for _, blob_id, _, _, _ in stored]
+    router.remove(release_blobs(blobs_collection, blob_ids))
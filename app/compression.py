@@ -0,0 +1,188 @@
+import hashlib
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional; gzip is used instead
+    zstandard = None
+
+# Content types worth compressing; filenames are checked via their icon
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/xml",
+    "application/javascript",
+    "application/csv",
+    "application/x-yaml",
+    "application/sql",
+)
+
+# Bytes read up front to decide whether compressing the upload pays off
+SAMPLE_SIZE = 64 * 1024
+
+# The sample must shrink to at most this fraction of its size
+MAX_RATIO = 0.9
+
+READ_SIZE = 1024 * 1024
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def available_codec(preferred):
+    """The codec to store with, falling back to gzip if zstd isn't installed."""
+    if preferred == "zstd" and zstandard is not None:
+        return "zstd"
+    return "gzip" if preferred else None
+
+
+def compressible(content_type):
+    return bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def encoder(codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+
+
+def decoder(codec):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(GZIP_WBITS)
+
+
+def compress(codec, data):
+    compressor = encoder(codec)
+    return compressor.compress(data) + compressor.flush()
+
+
+class SampledStream:
+    """Replays the bytes read for the sample before the rest of the stream."""
+
+    def __init__(self, sample, stream):
+        self._sample = sample
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self._sample:
+            return self.stream.read(size)
+        if size < 0:
+            data, self._sample = self._sample + self.stream.read(), b""
+            return data
+        data, self._sample = self._sample[:size], self._sample[size:]
+        return data
+
+
+def probe(stream, codec):
+    """Decide from the first bytes of ``stream`` whether to compress it.
+
+    Returns ``(stream, codec)``, where the stream still yields every byte and
+    the codec is None when the sample doesn't compress well enough.
+    """
+    if not codec:
+        return stream, None
+    chunks = []
+    remaining = SAMPLE_SIZE
+    while remaining > 0:
+        data = stream.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    sample = b"".join(chunks)
+
+    if len(compress(codec, sample)) > len(sample) * MAX_RATIO:
+        codec = None
+    return SampledStream(sample, stream), codec
+
+
+class CompressingReader:
+    """File-like wrapper that hashes and counts the raw bytes and hands out
+    their compressed form.
+
+    At most one compressed read chunk is buffered beyond what the caller asks
+    for, so memory stays bounded whatever the upload's size.
+    """
+
+    def __init__(self, stream, codec):
+        self.stream = stream
+        self.codec = codec
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.sha256 = hashlib.sha256()
+        self._encoder = encoder(codec)
+        self._buffer = bytearray()
+        self._finished = False
+
+    def read(self, size=-1):
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            data = self.stream.read(READ_SIZE)
+            if not data:
+                self._buffer += self._encoder.flush()
+                self._finished = True
+                break
+            self.bytes_read += len(data)
+            self.sha256.update(data)
+            self._buffer += self._encoder.compress(data)
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self.bytes_written += len(data)
+        return data
+
+
+class DecodedStream:
+    """Iterable over the decoded bytes ``[start, stop)`` of a compressed object.
+
+    ``chunks`` is the stored object's body, typically an ``ObjectStream``;
+    closing this stream closes it too.
+    """
+
+    def __init__(self, chunks, codec, chunk_size, start=0, stop=None):
+        self.chunks = chunks
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.start = start
+        self.stop = stop
+
+    def __iter__(self):
+        position = 0
+        try:
+            for data in self._decode():
+                end = position + len(data)
+                if end > self.start:
+                    data = data[max(self.start - position, 0) :]
+                    if self.stop is not None:
+                        data = data[: max(self.stop - max(position, self.start), 0)]
+                    if data:
+                        yield data
+                position = end
+                if self.stop is not None and position >= self.stop:
+                    break
+        finally:
+            self.close()
+
+    def _decode(self):
+        decompressor = decoder(self.codec)
+        for chunk in self.chunks:
+            if self.codec == "zstd":
+                yield decompressor.decompress(chunk)
+                continue
+            # Output is capped per call so a highly compressed chunk can't
+            # expand into one large buffer
+            data = decompressor.decompress(chunk, self.chunk_size)
+            yield data
+            while decompressor.unconsumed_tail:
+                yield decompressor.decompress(
+                    decompressor.unconsumed_tail, self.chunk_size
+                )
+        if self.codec != "zstd":
+            yield decompressor.flush()
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close:
+            close()
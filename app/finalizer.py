@@ -0,0 +1,360 @@
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import timezone
+
+from bson import json_util
+from pymongo.errors import DuplicateKeyError
+
+from app.blobs import make_blob_id, release_blobs, store_blob
+from app.bundles import upload_object_name
+from app.compression import probe
+from app.storage import put_stream
+
+# Manifests hold file documents; dates come back as aware UTC datetimes
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS.with_options(
+    tz_aware=True, tzinfo=timezone.utc
+)
+
+
+class UploadFinalizer:
+    """Stores uploads after the upload request has returned.
+
+    The request only writes the upload to the local staging directory, with
+    a manifest holding the file document to create; a worker then writes the
+    object to MinIO, stores it as a blob and inserts the document. Resumable
+    uploads, whose chunks already are in MinIO, stage just the manifest.
+
+    Manifests are the durable record of the jobs, so uploads staged before a
+    restart are picked up again by ``recover``. A worker claims a manifest by
+    renaming it, which keeps the processes sharing the directory from
+    finalizing the same upload. Staged uploads live on one host's disk, so
+    only that host's processes finalize them or report them as processing.
+    """
+
+    def __init__(
+        self, app, workers, max_attempts, backoff, staging_dir, lease_seconds=300
+    ):
+        self.app = app
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.staging_dir = staging_dir
+        self.lease_seconds = lease_seconds
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.retrying = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_work = 0.0
+
+    def start(self):
+        # Each worker process runs its own pool; claiming a manifest is what
+        # keeps two pools from finalizing the same upload
+        with self._lock:
+            if self._threads or self.workers <= 0:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._loop, name=f"upload-finalizer-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+        self.recover()
+
+    def _path(self, file_id, suffix):
+        return os.path.join(self.staging_dir, f"{file_id}{suffix}")
+
+    def stage_data(self, file_id, stream, chunk_size=1024 * 1024):
+        """Write the upload body to the staging directory; returns its size."""
+        os.makedirs(self.staging_dir, exist_ok=True)
+        with open(self._path(file_id, ".data"), "wb") as target:
+            shutil.copyfileobj(stream, target, chunk_size)
+            return target.tell()
+
+    def stage(self, file_doc, sources=None, blob_id=None, codec=None):
+        """Queue ``file_doc`` to be stored and inserted.
+
+        Without ``sources`` the upload is the data staged by ``stage_data``,
+        compressed with ``codec`` if it is worth it. Otherwise ``sources`` are
+        staged objects on the file's shard that make up blob ``blob_id``.
+        """
+        os.makedirs(self.staging_dir, exist_ok=True)
+        file_id = file_doc["_id"]
+        manifest = {
+            "file": file_doc,
+            "sources": sources,
+            "blob_id": blob_id,
+            "codec": codec,
+        }
+        # The job exists once its manifest does, complete
+        temp_path = self._path(file_id, f".json.{os.getpid()}.tmp")
+        with open(temp_path, "w") as target:
+            target.write(json_util.dumps(manifest, json_options=JSON_OPTIONS))
+        os.replace(temp_path, self._path(file_id, ".json"))
+        self.submit(file_id)
+
+    def staged(self, file_id):
+        """The document of an upload still being finalized here, or None."""
+        for suffix in (".json", ".claimed"):
+            try:
+                manifest = self._load(self._path(file_id, suffix))
+            except (FileNotFoundError, ValueError):
+                continue
+            file_doc = manifest["file"]
+            file_doc.pop("password", None)
+            file_doc["status"] = "processing"
+            return file_doc
+        return None
+
+    def _load(self, path):
+        with open(path) as source:
+            return json_util.loads(source.read(), json_options=JSON_OPTIONS)
+
+    def _save(self, path, manifest):
+        with open(path, "w") as target:
+            target.write(json_util.dumps(manifest, json_options=JSON_OPTIONS))
+
+    def submit(self, file_id, attempt=1, enqueued_at=None):
+        self._queue.put((file_id, attempt, enqueued_at or time.monotonic()))
+
+    def recover(self):
+        """Queue staged uploads, including those a crashed worker had claimed."""
+        try:
+            names = os.listdir(self.staging_dir)
+        except FileNotFoundError:
+            return 0
+        cutoff = time.time() - self.lease_seconds
+        recovered = 0
+        for name in names:
+            file_id, _, suffix = name.partition(".")
+            path = os.path.join(self.staging_dir, name)
+            try:
+                if suffix == "json":
+                    self.submit(file_id)
+                    recovered += 1
+                elif suffix == "claimed" and os.path.getmtime(path) < cutoff:
+                    os.replace(path, self._path(file_id, ".json"))
+                    self.submit(file_id)
+                    recovered += 1
+                elif suffix != "data" and os.path.getmtime(path) < cutoff:
+                    # A manifest that was never completed
+                    os.remove(path)
+                elif (
+                    suffix == "data"
+                    and os.path.getmtime(path) < cutoff
+                    and not os.path.exists(self._path(file_id, ".json"))
+                    and not os.path.exists(self._path(file_id, ".claimed"))
+                ):
+                    # The request failed before writing the manifest
+                    os.remove(path)
+            except FileNotFoundError:
+                # Claimed or finished by another process meanwhile
+                continue
+        return recovered
+
+    def _loop(self):
+        while True:
+            file_id, attempt, enqueued_at = self._queue.get()
+            try:
+                self._process(file_id, attempt, enqueued_at)
+            except Exception as e:
+                print(f"Error finalizing upload {file_id}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def _process(self, file_id, attempt, enqueued_at):
+        with self._lock:
+            self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            self.finalize(file_id)
+        except Exception as e:
+            self._record_failure(file_id, attempt, enqueued_at, e)
+            return
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.in_flight -= 1
+                self.total_work += elapsed
+
+        latency = time.monotonic() - enqueued_at
+        with self._lock:
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def finalize(self, file_id):
+        """Store the staged upload ``file_id`` and insert its document.
+
+        Returns False if it isn't staged here or another worker claimed it.
+        """
+        claimed_path = self._path(file_id, ".claimed")
+        try:
+            os.rename(self._path(file_id, ".json"), claimed_path)
+        except FileNotFoundError:
+            return False
+        # The claim's age is the lease; a rename keeps the staging time
+        os.utime(claimed_path)
+        try:
+            self._store(file_id, claimed_path)
+        except Exception:
+            # Handed back for the retry
+            os.replace(claimed_path, self._path(file_id, ".json"))
+            raise
+        return True
+
+    def _store(self, file_id, claimed_path):
+        app = self.app
+        blobs_collection = app.mongo_db["blobs"]
+        manifest = self._load(claimed_path)
+        file_doc = manifest["file"]
+
+        stored = manifest.get("stored")
+        if not stored:
+            if manifest["sources"] is None:
+                shard = app.storage.place(file_id)
+                sources = [upload_object_name(file_id)]
+                with open(self._path(file_id, ".data"), "rb") as data:
+                    stream, codec = probe(data, manifest["codec"])
+                    file_size, digest = put_stream(
+                        shard.client,
+                        shard.bucket_name,
+                        sources[0],
+                        stream,
+                        file_doc["content_type"],
+                        app.config["UPLOAD_PART_SIZE"],
+                        app.config["UPLOAD_MAX_BUFFER"],
+                        codec,
+                    )
+                app.metrics.uploaded_bytes.inc(amount=file_size)
+                app.storage.record(shard, "write", file_size)
+                blob_id = make_blob_id(digest, codec)
+            else:
+                shard = app.storage.locate(file_doc)
+                sources = manifest["sources"]
+                blob_id = manifest["blob_id"]
+                codec = None
+
+            saved_name, _, blob_shard = store_blob(
+                blobs_collection,
+                shard.client,
+                shard.bucket_name,
+                sources,
+                blob_id,
+                file_doc["file_size"],
+                file_id,
+                shard.name,
+            )
+            # Recorded before anything else can fail: the sources are consumed
+            # now, and a retry must not take a second reference on the blob
+            stored = {
+                "saved_filename": saved_name,
+                "blob_id": blob_id,
+                "codec": codec,
+                "shard": blob_shard,
+            }
+            manifest["stored"] = stored
+            self._save(claimed_path, manifest)
+
+        file_doc.update(stored)
+        try:
+            app.mongo_db["files"].insert_one(file_doc)
+        except DuplicateKeyError:
+            # An earlier attempt inserted it and stopped before cleaning up
+            app.storage.remove(release_blobs(blobs_collection, [stored["blob_id"]]))
+        self._discard(file_id)
+        app.metadata_cache.invalidate(file_id)
+        if (file_doc.get("preview") or {}).get("status") == "pending":
+            app.preview_generator.submit(file_id)
+
+    def _discard(self, file_id):
+        for suffix in (".data", ".claimed", ".json"):
+            try:
+                os.remove(self._path(file_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _record_failure(self, file_id, attempt, enqueued_at, error):
+        print(f"Error finalizing upload {file_id} (attempt {attempt}): {str(error)}")
+
+        if attempt >= self.max_attempts:
+            self._give_up(file_id, error)
+            with self._lock:
+                self.failed += 1
+            return
+
+        delay = self.backoff * 2 ** (attempt - 1)
+        with self._lock:
+            self.retries += 1
+            self.retrying += 1
+        timer = threading.Timer(
+            delay, self._retry, args=(file_id, attempt + 1, enqueued_at)
+        )
+        timer.daemon = True
+        timer.start()
+
+    def _give_up(self, file_id, error):
+        # The document is inserted as failed so the upload page can say so;
+        # sources that were never consumed are left for the reaper
+        claimed_path = self._path(file_id, ".claimed")
+        try:
+            os.rename(self._path(file_id, ".json"), claimed_path)
+        except FileNotFoundError:
+            return
+        manifest = self._load(claimed_path)
+        file_doc = manifest["file"]
+        stored = manifest.get("stored")
+        if stored:
+            self.app.storage.remove(
+                release_blobs(self.app.mongo_db["blobs"], [stored["blob_id"]])
+            )
+        file_doc.update(
+            {
+                "status": "failed",
+                "finalize_error": str(error),
+                "saved_filename": None,
+                "blob_id": None,
+                "pending_sources": None if stored else manifest["sources"],
+            }
+        )
+        try:
+            self.app.mongo_db["files"].insert_one(file_doc)
+        except DuplicateKeyError:
+            pass
+        self._discard(file_id)
+        self.app.metadata_cache.invalidate(file_id)
+
+    def _retry(self, file_id, attempt, enqueued_at):
+        with self._lock:
+            self.retrying -= 1
+        self.submit(file_id, attempt, enqueued_at)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": bool(self._threads),
+                "workers": self.workers,
+                "queue_depth": self._queue.qsize(),
+                "in_flight": self.in_flight,
+                "retrying": self.retrying,
+                "completed": self.completed,
+                "failed": self.failed,
+                "retries": self.retries,
+                "avg_latency_seconds": round(self.total_latency / self.completed, 6)
+                if self.completed
+                else 0.0,
+                "max_latency_seconds": round(self.max_latency, 6),
+                "avg_work_seconds": round(
+                    self.total_work / (self.completed + self.failed + self.retries), 6
+                )
+                if self.completed + self.failed + self.retries
+                else 0.0,
+            }
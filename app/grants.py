@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta, timezone
+
+from nanoid import generate
+
+
+def open_grant(grants_collection, file_id, start, stop, ttl):
+    """Record a counted download serving bytes ``start`` to ``stop``.
+
+    The grant's watermark is where the bytes served under it end. It is set to
+    ``stop`` up front and lowered by ``GrantedBody`` if the client goes away
+    early, so a resume picks up from the last byte it actually received.
+    """
+    grant_id = generate()
+    grants_collection.insert_one(
+        {
+            "_id": grant_id,
+            "file_id": file_id,
+            "watermark": stop,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl),
+        }
+    )
+    return grant_id
+
+
+def extend_grant(grants_collection, grant_id, file_id, start, stop):
+    """Claim ``start`` to ``stop`` as a continuation of a counted download.
+
+    Only bytes past the watermark qualify: a range that covers anything
+    already served under the grant is a new download. The watermark moves in
+    the same update, so parallel requests can't share one grant's bytes.
+    """
+    claimed = grants_collection.find_one_and_update(
+        {
+            "_id": grant_id,
+            "file_id": file_id,
+            "watermark": {"$lte": start},
+            "expires_at": {"$gt": datetime.now(timezone.utc)},
+        },
+        {"$set": {"watermark": stop}},
+        projection={"_id": 1},
+    )
+    return claimed is not None
+
+
+def settle_grant(grants_collection, grant_id, stop, served_to):
+    # Unless a later request already moved the watermark on
+    grants_collection.update_one(
+        {"_id": grant_id, "watermark": stop}, {"$set": {"watermark": served_to}}
+    )
+
+
+class GrantedBody:
+    """Response body serving ``start`` to ``stop`` of the file under a grant.
+
+    When the server closes it early, the grant's watermark is lowered to the
+    bytes that were handed to the server, so those are all a resume skips.
+    """
+
+    def __init__(self, body, grants_collection, grant_id, start, stop):
+        self.body = body
+        self.grants_collection = grants_collection
+        self.grant_id = grant_id
+        self.start = start
+        self.stop = stop
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.body, "close", None)
+            if close:
+                close()
+        finally:
+            if self.start + self.sent < self.stop:
+                settle_grant(
+                    self.grants_collection,
+                    self.grant_id,
+                    self.stop,
+                    self.start + self.sent,
+                )
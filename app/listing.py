@@ -0,0 +1,200 @@
+import base64
+import json
+import re
+from datetime import datetime, timezone
+
+from pymongo import DESCENDING
+
+# Newest first; _id breaks ties between uploads in the same millisecond
+LISTING_SORT = [("upload_time", DESCENDING), ("_id", DESCENDING)]
+
+# Never includes the password hash
+LISTING_PROJECTION = {
+    "original_filename": 1,
+    "file_size": 1,
+    "content_type": 1,
+    "upload_time": 1,
+    "expiration_date": 1,
+    "download_count": 1,
+    "download_limit": 1,
+    "has_password": 1,
+    "status": 1,
+    "bundle_id": 1,
+}
+
+MAX_PAGE_SIZE = 1000
+
+
+class ListingError(ValueError):
+    """Raised for a filter or cursor the listing can't use."""
+
+
+# Filters on these are checked against the index keys while it is walked in
+# LISTING_SORT order, so the documents they reject are never fetched
+RANGE_FILTER_KEYS = [("file_size", 1), ("expiration_date", 1)]
+
+
+def ensure_listing_indexes(files_collection):
+    # One index per access path the listing offers: everything, and one or
+    # more content types, both walked in LISTING_SORT order. A range on the
+    # sort's own leading field would force an in-memory sort, so the range
+    # filters trail instead
+    files_collection.create_index(LISTING_SORT + RANGE_FILTER_KEYS)
+    files_collection.create_index(
+        [("content_type", 1)] + LISTING_SORT + RANGE_FILTER_KEYS
+    )
+
+
+def family_types(files_collection, family):
+    """The content types stored under ``family`` (``image/``)."""
+    # Answered from the content type index alone
+    return sorted(
+        files_collection.distinct(
+            "content_type", {"content_type": {"$regex": "^" + re.escape(family)}}
+        )
+    )
+
+
+def parse_time(value, name):
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ListingError(f"{name} must be an ISO 8601 date or time")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def parse_int(value, name):
+    try:
+        return int(value)
+    except ValueError:
+        raise ListingError(f"{name} must be an integer")
+
+
+def encode_cursor(file_doc):
+    upload_time = file_doc["upload_time"]
+    if upload_time.tzinfo is None:
+        upload_time = upload_time.replace(tzinfo=timezone.utc)
+    payload = json.dumps([upload_time.isoformat(), file_doc["_id"]])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        upload_time, file_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(upload_time), str(file_id)
+    except (ValueError, TypeError):
+        raise ListingError("Invalid cursor")
+
+
+def build_listing_query(args, now=None, content_types=None):
+    """Translate listing query parameters into a Mongo filter.
+
+    ``content_type`` matches exactly, or a whole family when it ends in a
+    slash (``image/``). Times are ISO 8601 and sizes are in bytes.
+
+    A family is matched by prefix unless ``content_types`` lists its types.
+    Listings pass them (see ``family_types``): the server merges one index
+    walk per type and keeps LISTING_SORT order, where a prefix range over
+    the content type index would leave the sort to memory.
+    """
+    clauses = []
+
+    upload_time = {}
+    if args.get("uploaded_after"):
+        upload_time["$gte"] = parse_time(args["uploaded_after"], "uploaded_after")
+    if args.get("uploaded_before"):
+        upload_time["$lt"] = parse_time(args["uploaded_before"], "uploaded_before")
+    if upload_time:
+        clauses.append({"upload_time": upload_time})
+
+    file_size = {}
+    if args.get("min_size"):
+        file_size["$gte"] = parse_int(args["min_size"], "min_size")
+    if args.get("max_size"):
+        file_size["$lte"] = parse_int(args["max_size"], "max_size")
+    if file_size:
+        clauses.append({"file_size": file_size})
+
+    content_type = args.get("content_type")
+    if content_type and content_type.endswith("/") and content_types is not None:
+        clauses.append({"content_type": {"$in": content_types}})
+    elif content_type and content_type.endswith("/"):
+        clauses.append({"content_type": {"$regex": "^" + re.escape(content_type)}})
+    elif content_type:
+        clauses.append({"content_type": content_type})
+
+    expiration = {}
+    if args.get("expires_after"):
+        expiration["$gte"] = parse_time(args["expires_after"], "expires_after")
+    if args.get("expires_before"):
+        expiration["$lt"] = parse_time(args["expires_before"], "expires_before")
+    if expiration:
+        clauses.append({"expiration_date": expiration})
+
+    expired = args.get("expired")
+    now = now or datetime.now(timezone.utc)
+    if expired in ("true", "1"):
+        clauses.append({"expiration_date": {"$lte": now}})
+    elif expired in ("false", "0"):
+        clauses.append(
+            {"$or": [{"expiration_date": None}, {"expiration_date": {"$gt": now}}]}
+        )
+
+    if args.get("cursor"):
+        # Keyset pagination: continue strictly after the last document served
+        upload_time, file_id = decode_cursor(args["cursor"])
+        clauses.append(
+            {
+                "$or": [
+                    {"upload_time": {"$lt": upload_time}},
+                    {"upload_time": upload_time, "_id": {"$lt": file_id}},
+                ]
+            }
+        )
+
+    if not clauses:
+        return {}
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$and": clauses}
+
+
+def isoformat(value):
+    if not isinstance(value, datetime):
+        return value
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.isoformat()
+
+
+def serialize_file(file_doc):
+    entry = {"file_id": file_doc["_id"]}
+    for field in LISTING_PROJECTION:
+        if field in file_doc:
+            entry[field] = isoformat(file_doc[field])
+    return entry
+
+
+def list_files(files_collection, args, default_limit=100):
+    """Return ``(file_docs, next_cursor)`` for one page of the listing."""
+    limit = parse_int(args.get("limit") or default_limit, "limit")
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    content_type = args.get("content_type")
+    content_types = None
+    if content_type and content_type.endswith("/"):
+        content_types = family_types(files_collection, content_type)
+    query = build_listing_query(args, content_types=content_types)
+
+    # One extra document tells whether another page follows
+    file_docs = list(
+        files_collection.find(query, LISTING_PROJECTION)
+        .sort(LISTING_SORT)
+        .limit(limit + 1)
+    )
+    next_cursor = None
+    if len(file_docs) > limit:
+        file_docs = file_docs[:limit]
+        next_cursor = encode_cursor(file_docs[-1])
+    return file_docs, next_cursor
@@ -0,0 +1,232 @@
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self, kind="counter"):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {kind}",
+        ]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self):
+        return super().render("gauge")
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # Per-bucket counts, then the sum and count of observations
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1)
+                series += [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            return series[-1] if series else 0
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            snapshot = sorted((key, list(value)) for key, value in self._series.items())
+        for label_values, series in snapshot:
+            cumulative = 0
+            for bound, observed in zip(self.buckets + ("+Inf",), series):
+                cumulative += observed
+                labels = format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Metrics:
+    """Process-wide metrics, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            "dropit_http_request_duration_seconds",
+            "Time until the response starts, by route.",
+            ("method", "route", "status"),
+        )
+        self.uploaded_bytes = Counter(
+            "dropit_uploaded_bytes_total", "Bytes received in uploads."
+        )
+        self.downloaded_bytes = Counter(
+            "dropit_downloaded_bytes_total", "Bytes sent in downloads and archives."
+        )
+        self.storage_bytes = Counter(
+            "dropit_storage_bytes_total",
+            "Bytes written to and read from each storage shard.",
+            ("shard", "direction"),
+        )
+        self.transfers_in_flight = Gauge(
+            "dropit_transfers_in_flight",
+            "Uploads and downloads currently in progress.",
+            ("direction",),
+        )
+        self.backend_duration = Histogram(
+            "dropit_backend_call_duration_seconds",
+            "MongoDB, MinIO and bcrypt call durations.",
+            ("backend", "operation"),
+        )
+        self.backend_errors = Counter(
+            "dropit_backend_errors_total",
+            "MongoDB, MinIO and bcrypt calls that failed.",
+            ("backend", "operation"),
+        )
+
+    @contextmanager
+    def time_backend(self, backend, operation):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.backend_errors.inc(backend, operation)
+            raise
+        finally:
+            self.backend_duration.observe(
+                time.perf_counter() - started, backend, operation
+            )
+
+    def render(self):
+        lines = []
+        for metric in (
+            self.request_duration,
+            self.uploaded_bytes,
+            self.downloaded_bytes,
+            self.storage_bytes,
+            self.transfers_in_flight,
+            self.backend_duration,
+            self.backend_errors,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every command a ``MongoClient`` sends, by command name."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.backend_duration.observe(
+            event.duration_micros / 1e6, "mongo", event.command_name
+        )
+
+    def failed(self, event):
+        self.metrics.backend_errors.inc("mongo", event.command_name)
+        self.metrics.backend_duration.observe(
+            event.duration_micros / 1e6, "mongo", event.command_name
+        )
+
+
+class TimedClient:
+    """Proxy that times each public method call on ``client``.
+
+    Wrapped methods are cached on the proxy, so after the first call a method
+    costs one extra function call and a ``perf_counter`` pair.
+    """
+
+    def __init__(self, client, metrics, backend):
+        self._client = client
+        self._metrics = metrics
+        self._backend = backend
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+        time_backend = self._metrics.time_backend
+        backend = self._backend
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            with time_backend(backend, name):
+                return attribute(*args, **kwargs)
+
+        self.__dict__[name] = timed
+        return timed
@@ -0,0 +1,358 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Temp files this old are left over from a fill that died, not one in progress
+STALE_TEMP_SECONDS = 3600
+
+
+def entry_name(key, validator):
+    return hashlib.sha256(f"{key}\0{validator}".encode("utf-8")).hexdigest()
+
+
+class ObjectCache:
+    """LRU copies of hot MinIO objects on local disk, bounded by a byte budget.
+
+    Entries are named after the object key and its ETag, so a changed object
+    never matches an old copy. Concurrent misses for the same entry share one
+    fetch, and eviction runs on a background thread after each fill, so
+    requests never wait for deletes.
+
+    The directory may be shared by several processes. Each adopts the copies
+    the others wrote, recency is kept in the files' modification times, and
+    the budget is measured on disk, so it holds for the directory as a whole.
+    """
+
+    def __init__(self, directory, max_bytes, max_object_size):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_size = max_object_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._fetching = {}
+        self._teeing = set()
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._evict_needed = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.merged = 0
+        self.fill_errors = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def accepts(self, size):
+        if not self.enabled or size is None:
+            return False
+        return size <= min(self.max_object_size or self.max_bytes, self.max_bytes)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or not self.enabled:
+                return
+            self._thread = threading.Thread(
+                target=self._loop, name="object-cache-evictor", daemon=True
+            )
+            self._thread.start()
+
+    def lookup(self, key, validator):
+        """Return the path of the cached copy of ``key``, or None on a miss."""
+        name = entry_name(key, validator)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+        if not self._find(name, path):
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def fetch(self, key, validator, fill):
+        """Return the path of the cached copy of ``key``, filling it on a miss.
+
+        ``fill(path)`` must write the object to ``path``. Returns None if the
+        fill fails, in which case the caller should read from MinIO itself.
+        """
+        name = entry_name(key, validator)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+        if self._find(name, path):
+            with self._lock:
+                self.hits += 1
+            return path
+        with self._lock:
+            if name in self._teeing:
+                # Filled at the pace of another client; don't wait for it
+                self.merged += 1
+                return None
+            pending = self._fetching.get(name)
+            if pending is None:
+                self._fetching[name] = threading.Event()
+                self.misses += 1
+            else:
+                self.merged += 1
+
+        if pending is not None:
+            # Another request is already fetching this object
+            pending.wait()
+            with self._lock:
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+                    return path
+            return None
+
+        temp_path = self._temp_path(path)
+        try:
+            fill(temp_path)
+            self._commit(name, temp_path, path)
+        except Exception as e:
+            print(f"Error caching object {key}: {str(e)}")
+            remove_file(temp_path)
+            with self._lock:
+                self.fill_errors += 1
+                self._fetching.pop(name).set()
+            return None
+
+        with self._lock:
+            self._fetching.pop(name).set()
+        return path
+
+    def tee(self, key, validator, chunks):
+        """Wrap ``chunks``, the whole object, so sending it also fills the cache.
+
+        Returns ``chunks`` itself if the entry is already being filled.
+        """
+        name = entry_name(key, validator)
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            self._load()
+            if name in self._fetching or name in self._teeing:
+                self.merged += 1
+                return chunks
+            self._teeing.add(name)
+            self.misses += 1
+        return CacheFill(self, name, path, chunks)
+
+    def _find(self, name, path):
+        with self._lock:
+            known = name in self._entries
+            if known:
+                self._entries.move_to_end(name)
+        try:
+            # The modification time is the recency every process sees
+            os.utime(path)
+            if not known:
+                # Filled by another process sharing the directory
+                size = os.path.getsize(path)
+        except FileNotFoundError:
+            if known:
+                self.discard_name(name)
+            return False
+        if not known:
+            with self._lock:
+                if name not in self._entries:
+                    self._entries[name] = size
+                    self._size += size
+        return True
+
+    def _temp_path(self, path):
+        # Unique per process and fill, so no fill touches another's file
+        return f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+    def _commit(self, name, temp_path, path):
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self._lock:
+            if name not in self._entries:
+                self._entries[name] = size
+                self._size += size
+        # Measured after every fill: this process's count alone would miss
+        # what the others added
+        if self._thread is None:
+            self.evict()
+        else:
+            self._evict_needed.set()
+
+    def _end_tee(self, name, temp_path, path, complete):
+        try:
+            if complete:
+                self._commit(name, temp_path, path)
+            else:
+                remove_file(temp_path)
+        except Exception as e:
+            print(f"Error caching object {name}: {str(e)}")
+            remove_file(temp_path)
+            with self._lock:
+                self.fill_errors += 1
+        finally:
+            with self._lock:
+                self._teeing.discard(name)
+
+    def discard(self, key, validator):
+        """Forget an entry whose file disappeared, e.g. evicted by another process."""
+        self.discard_name(entry_name(key, validator))
+
+    def discard_name(self, name):
+        with self._lock:
+            size = self._entries.pop(name, None)
+            if size is not None:
+                self._size -= size
+
+    def evict(self):
+        """Delete least recently used copies until the directory fits the budget.
+
+        The directory is measured on disk, so copies and fills of every
+        process sharing it count against the budget.
+        """
+        found, total = self._scan()
+        with self._lock:
+            # Ties in modification time go by this process's own order
+            order = {name: rank for rank, name in enumerate(self._entries)}
+        found.sort(key=lambda item: (item[0], order.get(item[1], -1)))
+
+        removed = set()
+        for _, name, size in found:
+            if total <= self.max_bytes:
+                break
+            # A request that already opened the file keeps reading it until
+            # it closes it
+            remove_file(os.path.join(self.directory, name))
+            total -= size
+            removed.add(name)
+
+        with self._lock:
+            self._entries = OrderedDict(
+                (name, size) for _, name, size in found if name not in removed
+            )
+            self._size = total
+            self.evictions += len(removed)
+        return len(removed)
+
+    def _loop(self):
+        while True:
+            self._evict_needed.wait()
+            self._evict_needed.clear()
+            try:
+                self.evict()
+            except Exception as e:
+                print(f"Error evicting cached objects: {str(e)}")
+
+    def _load(self):
+        # Adopts copies left by an earlier run or other processes, so a
+        # restart keeps the cache warm and they count against the budget
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        found, total = self._scan()
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+        self._size = total
+        if self._size > self.max_bytes:
+            self._evict_needed.set()
+
+    def _scan(self):
+        """Returns ``(mtime, name, size)`` of each copy, and the bytes in use.
+
+        Fills in progress count towards the bytes but are never evicted;
+        temp files left by fills that died are deleted.
+        """
+        found = []
+        total = 0
+        stale = time.time() - STALE_TEMP_SECONDS
+        for entry in os.scandir(self.directory):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(".tmp"):
+                if stat.st_mtime < stale:
+                    remove_file(entry.path)
+                else:
+                    total += stat.st_size
+                continue
+            total += stat.st_size
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+        return found, total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "merged_misses": self.merged,
+                "fill_errors": self.fill_errors,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class CacheFill:
+    """Response body that writes the chunks it hands out to a cache entry.
+
+    The entry is committed once the whole object went out; a client that
+    goes away early leaves nothing behind.
+    """
+
+    def __init__(self, cache, name, path, chunks):
+        self.cache = cache
+        self.name = name
+        self.path = path
+        self.chunks = chunks
+        self.temp_path = cache._temp_path(path)
+        self._file = None
+        self._complete = False
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            self._file = open(self.temp_path, "wb")
+        except OSError as e:
+            print(f"Error caching object {self.name}: {str(e)}")
+        for chunk in self.chunks:
+            if self._file is not None:
+                try:
+                    self._file.write(chunk)
+                except OSError as e:
+                    # e.g. a full disk; the client still gets every byte
+                    print(f"Error caching object {self.name}: {str(e)}")
+                    self._file.close()
+                    self._file = None
+                    remove_file(self.temp_path)
+            yield chunk
+        self._complete = self._file is not None
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            close = getattr(self.chunks, "close", None)
+            if close:
+                close()
+        finally:
+            if self._file is not None:
+                self._file.close()
+            self.cache._end_tee(self.name, self.temp_path, self.path, self._complete)
@@ -0,0 +1,125 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HasherBusy(Exception):
+    """Raised when the bcrypt queue is full and the request should back off."""
+
+
+class PasswordHasher:
+    """Runs bcrypt on a small dedicated pool so it can't starve request threads.
+
+    bcrypt releases the GIL, so the pool size is the number of cores that can
+    be spent hashing at once. Work beyond ``max_queue`` pending calls is
+    rejected with ``HasherBusy`` instead of queueing without bound.
+    """
+
+    def __init__(self, workers, max_queue, timeout=30):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def _get_executor(self):
+        # Created on first use so a pre-forking server doesn't share threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="bcrypt"
+                )
+            return self._executor
+
+    def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy()
+        try:
+            future = self._get_executor().submit(self._timed, func, *args)
+            return future.result(timeout=self.timeout)
+        finally:
+            self._slots.release()
+
+    def _timed(self, func, *args):
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.calls += 1
+                self.total_seconds += elapsed
+                self.max_seconds = max(self.max_seconds, elapsed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "calls": self.calls,
+                "rejected": self.rejected,
+                "total_seconds": round(self.total_seconds, 6),
+                "avg_seconds": round(self.total_seconds / self.calls, 6)
+                if self.calls
+                else 0.0,
+                "max_seconds": round(self.max_seconds, 6),
+            }
+
+
+class AttemptLimiter:
+    """Counts failed password attempts per key in a fixed time window."""
+
+    def __init__(self, max_failures, window_seconds, max_keys=100000):
+        self.max_failures = max_failures
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, key):
+        """Seconds until ``key`` may try again, or 0 if it isn't blocked."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._failures.get(key)
+            if not entry:
+                return 0
+            count, window_start = entry
+            remaining = window_start + self.window_seconds - now
+            if remaining <= 0:
+                del self._failures[key]
+                return 0
+            return int(remaining) + 1 if count >= self.max_failures else 0
+
+    def record_failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            count, window_start = self._failures.get(key, (0, now))
+            if window_start + self.window_seconds <= now:
+                count, window_start = 0, now
+            self._failures[key] = (count + 1, window_start)
+            if len(self._failures) > self.max_keys:
+                self._prune(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+    def _prune(self, now):
+        expired = [
+            key
+            for key, (_, window_start) in self._failures.items()
+            if window_start + self.window_seconds <= now
+        ]
+        for key in expired:
+            del self._failures[key]
+        # Still too many live keys: drop the oldest windows first
+        overflow = len(self._failures) - self.max_keys
+        if overflow > 0:
+            oldest = sorted(self._failures, key=lambda key: self._failures[key][1])
+            for key in oldest[:overflow]:
+                del self._failures[key]
@@ -0,0 +1,329 @@
+import hashlib
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from app.compression import COMPRESSIBLE_TYPES, DecodedStream
+from app.storage import download_to_file, stream_object
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional; images get no thumbnail without Pillow
+    Image = None
+
+try:
+    import fitz
+except ImportError:  # optional; PyMuPDF renders the first page of PDFs
+    fitz = None
+
+TEXT_EXTENSIONS = (".txt", ".csv", ".md", ".json", ".log", ".yaml", ".yml", ".xml")
+
+# Formats Pillow decodes that browsers may not; vector images are already small
+SKIPPED_IMAGE_TYPES = ("image/svg+xml",)
+
+
+def preview_object_name(file_id):
+    return f"previews/{file_id}"
+
+
+def previewable(file_doc):
+    # A preview would show the content of a protected file to anyone, and
+    # one of a download-limited file would keep it readable, from any cache,
+    # once the limit is reached
+    return not file_doc.get("has_password") and not file_doc.get("download_limit")
+
+
+def preview_source(content_type, filename):
+    """What a preview is made from: ``image``, ``pdf``, ``text`` or None."""
+    content_type = content_type or ""
+    if content_type.startswith("image/") and content_type not in SKIPPED_IMAGE_TYPES:
+        return "image" if Image is not None else None
+    if content_type == "application/pdf":
+        return "pdf" if fitz is not None else None
+    if content_type.startswith(COMPRESSIBLE_TYPES) or (filename or "").lower().endswith(
+        TEXT_EXTENSIONS
+    ):
+        return "text"
+    return None
+
+
+def text_excerpt(chunks, max_bytes):
+    """The first ``max_bytes`` of ``chunks`` as UTF-8, cut at a line end."""
+    data = b""
+    try:
+        for chunk in chunks:
+            data += chunk
+            if len(data) >= max_bytes:
+                break
+    finally:
+        chunks.close()
+    if len(data) > max_bytes:
+        data = data[:max_bytes]
+        newline = data.rfind(b"\n")
+        if newline > 0:
+            data = data[: newline + 1]
+    return data.decode("utf-8", errors="replace").encode("utf-8")
+
+
+def render_thumbnail(path, max_size, quality):
+    """Downscale the image at ``path``; returns ``(data, content_type)``."""
+    with Image.open(path) as image:
+        # JPEG decoders can skip straight to a reduced scale, so a 40 MB photo
+        # is never decoded at full resolution
+        image.draft("RGB", (max_size, max_size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+            image.save(output, "PNG", optimize=True)
+            return output.getvalue(), "image/png"
+        image.convert("RGB").save(output, "JPEG", quality=quality, optimize=True)
+        return output.getvalue(), "image/jpeg"
+
+
+def render_first_page(path, max_size):
+    with fitz.open(path) as document:
+        page = document.load_page(0)
+        zoom = max_size / max(page.rect.width, page.rect.height)
+        pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return pixmap.tobytes("png"), "image/png"
+
+
+class PreviewGenerator:
+    """Builds small preview objects for uploaded files in the background.
+
+    Images get a downscaled thumbnail, PDFs a render of their first page and
+    text files an excerpt. The ``preview`` field of the file document is the
+    durable record of the job, so previews still pending after a restart are
+    picked up again by ``recover``.
+    """
+
+    def __init__(
+        self, app, workers, max_source_size, thumbnail_size, text_bytes, quality=80
+    ):
+        self.app = app
+        self.workers = workers
+        self.max_source_size = max_source_size
+        self.thumbnail_size = thumbnail_size
+        self.text_bytes = text_bytes
+        self.quality = quality
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.generated = 0
+        self.unavailable = 0
+        self.failed = 0
+        self.bytes_stored = 0
+        self.total_work = 0.0
+
+    @property
+    def enabled(self):
+        return self.workers > 0
+
+    def wants(self, file_doc):
+        """Whether a preview should be made for a new file document."""
+        if not self.enabled or not previewable(file_doc):
+            return False
+        source = preview_source(
+            file_doc.get("content_type"), file_doc.get("original_filename")
+        )
+        if source is None:
+            return False
+        # Excerpts read only the start of the file; renders need all of it
+        return source == "text" or (file_doc.get("file_size") or 0) <= (
+            self.max_source_size
+        )
+
+    def start(self):
+        with self._lock:
+            if self._threads or not self.enabled:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._loop, name=f"preview-generator-{index}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+        self.recover()
+
+    def submit(self, file_id):
+        if self.enabled:
+            self._queue.put(file_id)
+
+    def recover(self):
+        """Queue previews left pending, e.g. by a restart."""
+        files_collection = self.app.mongo_db["files"]
+        recovered = 0
+        for file_doc in files_collection.find(
+            {"preview.status": "pending", "status": {"$nin": ["processing", "failed"]}},
+            {"_id": 1},
+        ):
+            self.submit(file_doc["_id"])
+            recovered += 1
+        return recovered
+
+    def _loop(self):
+        while True:
+            file_id = self._queue.get()
+            try:
+                self.generate(file_id)
+            except Exception as e:
+                print(f"Error generating preview for {file_id}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    def generate(self, file_id):
+        """Build and store the preview of ``file_id``.
+
+        Returns False if the file has no pending preview or isn't stored yet.
+        """
+        app = self.app
+        files_collection = app.mongo_db["files"]
+        file_doc = files_collection.find_one(
+            {"_id": file_id, "preview.status": "pending"},
+            {
+                "saved_filename": 1,
+                "content_type": 1,
+                "original_filename": 1,
+                "file_size": 1,
+                "codec": 1,
+                "shard": 1,
+                "status": 1,
+            },
+        )
+        if not file_doc or file_doc.get("status") in ("processing", "failed"):
+            return False
+
+        started = time.perf_counter()
+        shard = app.storage.locate(file_doc)
+        try:
+            rendered = self.render(shard, file_doc)
+        except Exception as e:
+            print(f"Error rendering preview for {file_id}: {str(e)}")
+            self._finish(file_id, {"status": "failed", "error": str(e)})
+            with self._lock:
+                self.failed += 1
+            return True
+        finally:
+            with self._lock:
+                self.total_work += time.perf_counter() - started
+
+        if rendered is None:
+            self._finish(file_id, {"status": "unavailable"})
+            with self._lock:
+                self.unavailable += 1
+            return True
+
+        data, content_type, kind = rendered
+        object_name = preview_object_name(file_id)
+        # Stored next to the file; recorded separately because the rebalancer
+        # only moves the file's blob
+        shard.client.put_object(
+            shard.bucket_name,
+            object_name,
+            io.BytesIO(data),
+            length=len(data),
+            content_type=content_type,
+        )
+        app.storage.record(shard, "write", len(data))
+        preview = {
+            "status": "ready",
+            "kind": kind,
+            "object_name": object_name,
+            "shard": shard.name,
+            "content_type": content_type,
+            "size": len(data),
+            "etag": hashlib.sha256(data).hexdigest()[:32],
+            "created_at": datetime.now(timezone.utc),
+        }
+        if not self._finish(file_id, preview):
+            # Deleted while we worked
+            app.storage.remove([(shard.name, object_name)])
+            return True
+        with self._lock:
+            self.generated += 1
+            self.bytes_stored += len(data)
+        return True
+
+    def render(self, shard, file_doc):
+        """Returns ``(data, content_type, kind)``, or None if there's no preview."""
+        source = preview_source(
+            file_doc.get("content_type"), file_doc.get("original_filename")
+        )
+        chunk_size = self.app.config["DOWNLOAD_CHUNK_SIZE"]
+        codec = file_doc.get("codec")
+
+        if source == "text":
+            if codec:
+                chunks = DecodedStream(
+                    stream_object(
+                        shard.client,
+                        shard.bucket_name,
+                        file_doc["saved_filename"],
+                        chunk_size,
+                    ),
+                    codec,
+                    chunk_size,
+                    stop=self.text_bytes + 1,
+                )
+            else:
+                # One extra byte tells whether the excerpt was cut short
+                chunks = stream_object(
+                    shard.client,
+                    shard.bucket_name,
+                    file_doc["saved_filename"],
+                    chunk_size,
+                    length=self.text_bytes + 1,
+                )
+            data = text_excerpt(chunks, self.text_bytes)
+            return (data, "text/plain; charset=utf-8", "text") if data else None
+
+        if source is None or (file_doc.get("file_size") or 0) > self.max_source_size:
+            return None
+
+        handle, path = tempfile.mkstemp(prefix="dropit-preview-")
+        os.close(handle)
+        try:
+            download_to_file(
+                shard.client,
+                shard.bucket_name,
+                file_doc["saved_filename"],
+                chunk_size,
+                path,
+                codec,
+            )
+            if source == "image":
+                data, content_type = render_thumbnail(
+                    path, self.thumbnail_size, self.quality
+                )
+            else:
+                data, content_type = render_first_page(path, self.thumbnail_size)
+        finally:
+            os.remove(path)
+        return data, content_type, "image"
+
+    def _finish(self, file_id, preview):
+        updated = self.app.mongo_db["files"].update_one(
+            {"_id": file_id, "preview.status": "pending"},
+            {"$set": {"preview": preview}},
+        )
+        self.app.metadata_cache.invalidate(file_id)
+        return bool(updated.matched_count)
+
+    def stats(self):
+        with self._lock:
+            done = self.generated + self.unavailable + self.failed
+            return {
+                "running": bool(self._threads),
+                "workers": self.workers,
+                "queue_depth": self._queue.qsize(),
+                "generated": self.generated,
+                "unavailable": self.unavailable,
+                "failed": self.failed,
+                "bytes_stored": self.bytes_stored,
+                "avg_work_seconds": round(self.total_work / done, 6) if done else 0.0,
+            }
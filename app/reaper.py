@@ -0,0 +1,226 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+
+from app.blobs import release_blobs
+from app.storage import chunk_object_name
+
+
+def parse_legacy_expiration(value):
+    if len(value) == 10:  # YYYY-MM-DD format
+        return datetime.strptime(value, "%Y-%m-%d").replace(
+            hour=23, minute=59, second=59, microsecond=999999, tzinfo=timezone.utc
+        )
+    return datetime.fromisoformat(value)
+
+
+def migrate_expiration_dates(files_collection, batch_size=1000):
+    """Rewrite string expiration dates as BSON datetimes; returns docs updated."""
+    files_collection.create_index([("expiration_date", ASCENDING)])
+
+    migrated = 0
+    while True:
+        batch = list(
+            files_collection.find(
+                {"expiration_date": {"$type": "string"}}, {"expiration_date": 1}
+            ).limit(batch_size)
+        )
+        if not batch:
+            return migrated
+
+        # Expiries are always end-of-day, so a batch collapses to a few values
+        by_value = {}
+        for file_doc in batch:
+            try:
+                expires_at = parse_legacy_expiration(file_doc["expiration_date"])
+            except ValueError:
+                # Unparseable dates never expired before, so keep them that way
+                expires_at = None
+            by_value.setdefault(expires_at, []).append(file_doc["_id"])
+
+        for expires_at, file_ids in by_value.items():
+            files_collection.update_many(
+                {"_id": {"$in": file_ids}}, {"$set": {"expiration_date": expires_at}}
+            )
+        migrated += len(batch)
+
+
+class ExpiryReaper:
+    """Deletes expired files from Mongo and MinIO in the background."""
+
+    def __init__(self, app, interval, batch_size, session_ttl):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.session_ttl = session_ttl
+        self._thread = None
+        self._lock = threading.Lock()
+        self._migrated = False
+        self.runs = 0
+        self.files_reaped = 0
+        self.objects_reclaimed = 0
+        self.sessions_reaped = 0
+        self.last_run = {}
+
+    def start(self):
+        # Every worker process may run a reaper; documents are claimed one by
+        # one, so overlapping runs never process the same file twice
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._thread = threading.Thread(
+                target=self._loop, name="expiry-reaper", daemon=True
+            )
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error reaping expired files: {str(e)}")
+            time.sleep(self.interval)
+
+    def run_once(self):
+        app = self.app
+        files_collection = app.mongo_db["files"]
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+
+        if not self._migrated:
+            migrate_expiration_dates(files_collection, self.batch_size)
+            self._migrated = True
+
+        files = objects = 0
+        oldest_expiry = None
+        while True:
+            candidates = list(
+                files_collection.find(
+                    {"expiration_date": {"$lt": now}}, {"expiration_date": 1}
+                )
+                .sort("expiration_date", ASCENDING)
+                .limit(self.batch_size)
+            )
+            if not candidates:
+                break
+            if oldest_expiry is None:
+                oldest_expiry = candidates[0]["expiration_date"]
+
+            # Each document is claimed by deleting it, so a concurrent reaper in
+            # another worker (or a retry after a failed run) can't release the
+            # same blob reference twice
+            batch = []
+            for candidate in candidates:
+                file_doc = files_collection.find_one_and_delete(
+                    {"_id": candidate["_id"], "expiration_date": {"$lt": now}},
+                    projection={
+                        "saved_filename": 1,
+                        "blob_id": 1,
+                        "pending_sources": 1,
+                        "shard": 1,
+                        "preview": 1,
+                    },
+                )
+                if file_doc:
+                    batch.append(file_doc)
+                app.metadata_cache.invalidate(candidate["_id"])
+
+            # Shared blobs are only deleted once their last reference is gone
+            objects_to_remove = release_blobs(
+                app.mongo_db["blobs"],
+                [file_doc["blob_id"] for file_doc in batch if file_doc.get("blob_id")],
+            )
+            objects_to_remove += [
+                (file_doc.get("shard"), file_doc["saved_filename"])
+                for file_doc in batch
+                if file_doc.get("saved_filename") and not file_doc.get("blob_id")
+            ]
+            # Staged uploads that were never finalized
+            for file_doc in batch:
+                objects_to_remove += [
+                    (file_doc.get("shard"), name)
+                    for name in file_doc.get("pending_sources") or []
+                ]
+            objects_to_remove += [
+                (file_doc["preview"]["shard"], file_doc["preview"]["object_name"])
+                for file_doc in batch
+                if (file_doc.get("preview") or {}).get("status") == "ready"
+            ]
+            app.storage.remove(objects_to_remove)
+
+            files += len(batch)
+            objects += len(objects_to_remove)
+            if len(candidates) < self.batch_size:
+                break
+
+        # Bundle files expire with their bundle and are reaped above
+        bundles = (
+            app.mongo_db["bundles"]
+            .delete_many({"expiration_date": {"$lt": now}})
+            .deleted_count
+        )
+        sessions = self._reap_upload_sessions(now)
+        duration = time.perf_counter() - started
+
+        with self._lock:
+            self.runs += 1
+            self.files_reaped += files
+            self.objects_reclaimed += objects
+            self.sessions_reaped += sessions
+            self.last_run = {
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+                "duration_seconds": round(duration, 3),
+                "files_reaped": files,
+                "objects_reclaimed": objects,
+                "sessions_reaped": sessions,
+                "bundles_reaped": bundles,
+                "files_per_second": round(files / duration, 1) if duration else 0.0,
+                # How long the oldest reaped file outlived its expiry
+                "lag_seconds": round(lag_seconds(oldest_expiry, now), 1),
+            }
+        return self.last_run
+
+    def _reap_upload_sessions(self, now):
+        # Abandoned resumable uploads leave their chunks behind
+        sessions_collection = self.app.mongo_db["upload_sessions"]
+        files_collection = self.app.mongo_db["files"]
+        cutoff = now - timedelta(seconds=self.session_ttl)
+        reaped = 0
+        for session in sessions_collection.find(
+            {"created_at": {"$lt": cutoff}}, {"parts": 1, "shard": 1, "file_id": 1}
+        ).limit(self.batch_size):
+            # A complete that stopped after recording the file has already
+            # consumed the chunks; one of them may be the file's blob
+            completed = session.get("file_id") and files_collection.count_documents(
+                {"_id": session["file_id"]}, limit=1
+            )
+            if not completed:
+                self.app.storage.remove(
+                    (session.get("shard"), chunk_object_name(session["_id"], int(i)))
+                    for i in session["parts"]
+                )
+            sessions_collection.delete_one({"_id": session["_id"]})
+            reaped += 1
+        return reaped
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self._thread is not None,
+                "interval_seconds": self.interval,
+                "runs": self.runs,
+                "files_reaped": self.files_reaped,
+                "objects_reclaimed": self.objects_reclaimed,
+                "sessions_reaped": self.sessions_reaped,
+                "last_run": self.last_run,
+            }
+
+
+def lag_seconds(expires_at, now):
+    if expires_at is None:
+        return 0.0
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (now - expires_at).total_seconds())
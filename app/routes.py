@@ -1,24 +1,85 @@
+import hashlib
+import hmac
 import os
+import time
+import unicodedata
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from urllib.parse import quote, unquote
 from flask import (
     Blueprint,
+    Response,
+    after_this_request,
     flash,
-    send_file,
+    g,
+    get_flashed_messages,
     jsonify,
+    make_response,
     redirect,
     render_template,
     request,
+    send_file,
     url_for,
     current_app,
 )
 from nanoid import generate
+from werkzeug.http import dump_options_header, is_resource_modified
 import bcrypt
 
+from app.analytics import RecordedBody, download_event
+from app.archive import ArchiveEntry, ZipStream, unique_names
+from app.blobs import make_blob_id, release_blobs, store_blob
+from app.bundles import discard_files, store_files, upload_object_name
+from app.compression import DecodedStream, available_codec, compressible, probe
+from app.listing import ListingError, list_files, serialize_file
+from app.storage import (
+    MIN_PART_SIZE,
+    CountingReader,
+    chunk_object_name,
+    download_to_file,
+    put_stream,
+    stream_object,
+)
+from app.passwords import HasherBusy
+from app.previews import previewable
+from app.shaping import ShapedBody, TransfersBusy
+from app.reaper import parse_legacy_expiration
+from app.grants import GrantedBody, extend_grant, open_grant, settle_grant
+from app.ranges import MultipartRangeStream, if_range_matches, resolve_ranges
+from app.tokens import (
+    issue_bundle_token,
+    issue_download_grant,
+    issue_download_token,
+    verify_bundle_token,
+    verify_download_grant,
+    verify_download_token,
+)
+
 main = Blueprint("main", __name__)
 UPLOAD_FOLDER = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "..", "dropit_uploads"
 )
 
+UPLOAD_ENDPOINTS = {
+    "main.upload_file",
+    "main.stream_upload",
+    "main.upload_chunk",
+    "main.upload_bundle",
+}
+DOWNLOAD_ENDPOINTS = {
+    "main.download_file",
+    "main.download_archive",
+    "main.download_bundle_archive",
+}
+
+# Fields fetched for page renders and downloads; the hash is loaded separately
+FILE_PROJECTION = {"password": 0}
+
+# S3 multipart uploads are limited to 10,000 parts
+MAX_UPLOAD_CHUNKS = 10000
+
+MAX_BANDWIDTH_WEIGHT = 10
+
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
@@ -34,6 +95,16 @@ file_type_icons = {
     "default": "fa-file",
 }
 
+# Already-compressed categories are stored in ZIPs rather than deflated again
+PRECOMPRESSED_ICONS = {
+    file_type_icons[category] for category in ("image", "video", "audio", "archive")
+}
+
+
+# Categories stored compressed when STORAGE_COMPRESSION is set and a sample
+# of the upload shrinks enough
+COMPRESSIBLE_ICONS = {file_type_icons["text"], file_type_icons["excel"]}
+
 
 def get_file_icon(filename, content_type):
     if content_type and content_type.startswith("image/"):
@@ -58,6 +129,83 @@ def get_file_icon(filename, content_type):
     return file_type_icons["default"]
 
 
+@main.before_app_request
+def start_background_workers():
+    if not current_app.testing:
+        current_app.storage_bootstrap.start()
+        current_app.expiry_reaper.start()
+        current_app.upload_finalizer.start()
+        current_app.object_cache.start()
+        current_app.download_log.start()
+        current_app.storage_rebalancer.start()
+        current_app.preview_generator.start()
+
+
+@main.before_app_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    if request.endpoint in UPLOAD_ENDPOINTS:
+        current_app.metrics.transfers_in_flight.inc("upload")
+        g.upload_in_flight = True
+
+
+@main.after_app_request
+def record_request_metrics(response):
+    metrics = current_app.metrics
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.request_duration.observe(
+            time.perf_counter() - started,
+            request.method,
+            route,
+            str(response.status_code),
+        )
+    if request.endpoint in DOWNLOAD_ENDPOINTS and response.status_code in (200, 206):
+        track_download(response, metrics)
+    return response
+
+
+@main.teardown_app_request
+def finish_upload_metrics(error):
+    if g.pop("upload_in_flight", False):
+        current_app.metrics.transfers_in_flight.dec("upload")
+
+
+def track_download(response, metrics):
+    metrics.transfers_in_flight.inc("download")
+    response.call_on_close(partial(metrics.transfers_in_flight.dec, "download"))
+    if response.direct_passthrough:
+        # send_file bodies may go out through sendfile, where chunks can't be
+        # seen, so they are counted by their length once sent
+        if response.content_length:
+            response.call_on_close(
+                partial(metrics.downloaded_bytes.inc, amount=response.content_length)
+            )
+        return
+    response.response = CountedBody(response.response, metrics.downloaded_bytes)
+
+
+class CountedBody:
+    """Response body that counts the bytes actually handed to the server."""
+
+    def __init__(self, body, counter, *label_values):
+        self.body = body
+        self.counter = counter
+        self.label_values = label_values
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.counter.inc(*self.label_values, amount=len(chunk))
+            yield chunk
+
+    def close(self):
+        # Streams from MinIO release their connection on close
+        close = getattr(self.body, "close", None)
+        if close:
+            close()
+
+
 @main.route("/", methods=["GET"])
 def index():
     return render_template("upload_enhanced.html")
@@ -65,10 +213,6 @@ def index():
 
 @main.route("/", methods=["POST"])
 def upload_file():
-    files_collection = current_app.mongo_db["files"]
-    minio = current_app.minio_client
-    bucket_name = current_app.bucket_name
-
     if "file" not in request.files:
         flash("No file selected", "error")
         return redirect(request.url)
@@ -79,10 +223,68 @@ def upload_file():
         return redirect(request.url)
 
     file_id = generate()
-    password = request.form.get("password", "")
-    expiration_days = request.form.get("expiration-date", "7")
-    download_limit = request.form.get("download-limit", "0")
-    description = request.form.get("description", "")
+    options = parse_upload_options(request.form)
+
+    try:
+        store_upload(file_id, file.filename, file.content_type, file.stream, options)
+
+        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+            return jsonify(
+                {
+                    "success": True,
+                    "file_id": file_id,
+                    "redirect_url": url_for("main.file_success", file_id=file_id),
+                }
+            )
+
+        return redirect(url_for("main.file_success", file_id=file_id))
+
+    except Exception as e:
+        print(f"Error during file upload: {str(e)}")
+
+        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
+            return jsonify({"error": "Upload failed. Please try again."}), 500
+
+        flash("Upload failed. Please try again.", "error")
+        return redirect(request.url)
+
+
+@main.route("/upload", methods=["PUT"])
+def stream_upload():
+    # Raw request body upload: nothing is parsed or spooled to disk before MinIO
+    original_filename = unquote(request.headers.get("X-File-Name", ""))
+    if not original_filename:
+        return jsonify({"error": "No file selected"}), 400
+
+    file_id = generate()
+    values = request.args.to_dict()
+    values["password"] = request.headers.get("X-File-Password", "")
+    options = parse_upload_options(values)
+
+    try:
+        store_upload(
+            file_id, original_filename, request.mimetype, request.stream, options
+        )
+    except Exception as e:
+        print(f"Error during file upload: {str(e)}")
+        return jsonify({"error": "Upload failed. Please try again."}), 500
+
+    return jsonify(
+        {
+            "success": True,
+            "file_id": file_id,
+            "redirect_url": url_for("main.file_success", file_id=file_id),
+        }
+    )
+
+
+def parse_upload_options(values):
+    password = values.get("password", "")
+    expiration_days = values.get("expiration-date", "7")
+    download_limit = values.get("download-limit", "0")
+    rate_limit = values.get("rate-limit", "0")
+    bandwidth_weight = values.get("bandwidth-weight", "1")
+    description = values.get("description", "")
 
     hashed_password = hash_password(password) if password else ""
     if isinstance(hashed_password, bytes):
@@ -93,105 +295,680 @@ def upload_file():
     except ValueError:
         download_limit = 0
 
+    # Per-download rate in KB/s; 0 leaves only the server-wide limits
+    try:
+        rate_limit = max(int(rate_limit), 0) * 1024 if rate_limit else 0
+    except ValueError:
+        rate_limit = 0
+
+    # Share of the egress budget relative to other downloads in progress
+    try:
+        bandwidth_weight = min(max(int(bandwidth_weight), 1), MAX_BANDWIDTH_WEIGHT)
+    except ValueError:
+        bandwidth_weight = 1
+
     try:
         expiration_days = int(expiration_days)
-        # Set expiration to end of day (23:59:59) on the expiration date
-        expiration_datetime = datetime.now(timezone.utc) + timedelta(
-            days=expiration_days
+    except ValueError:
+        expiration_days = 7
+    # Set expiration to end of day (23:59:59) on the expiration date
+    expiration_date = (
+        datetime.now(timezone.utc) + timedelta(days=expiration_days)
+    ).replace(hour=23, minute=59, second=59, microsecond=999999)
+
+    return {
+        "password": hashed_password,
+        "has_password": bool(password),
+        "expiration_date": expiration_date,
+        "download_limit": download_limit,
+        "rate_limit": rate_limit,
+        "bandwidth_weight": bandwidth_weight,
+        "description": description,
+    }
+
+
+def store_upload(file_id, original_filename, content_type, stream, options):
+    if current_app.config["ASYNC_UPLOAD_FINALIZE"]:
+        # Only local disk is written before the response; MinIO and the file
+        # document are left to the finalizer pool
+        finalizer = current_app.upload_finalizer
+        file_size = finalizer.stage_data(file_id, stream)
+        file_data = build_file_doc(
+            file_id,
+            original_filename,
+            None,
+            None,
+            file_size,
+            content_type,
+            options,
         )
-        expiration_datetime = expiration_datetime.replace(
-            hour=23, minute=59, second=59, microsecond=999999
+        plan_preview(file_data)
+        finalizer.stage(file_data, codec=storage_codec(original_filename, content_type))
+        return file_data
+
+    shard = current_app.storage.place(file_id)
+    object_name = upload_object_name(file_id)
+
+    current_app.storage_bootstrap.ensure()
+
+    stream, codec = probe(stream, storage_codec(original_filename, content_type))
+    file_size, digest = put_stream(
+        shard.client,
+        shard.bucket_name,
+        object_name,
+        stream,
+        content_type,
+        current_app.config["UPLOAD_PART_SIZE"],
+        current_app.config["UPLOAD_MAX_BUFFER"],
+        codec,
+    )
+    current_app.metrics.uploaded_bytes.inc(amount=file_size)
+    current_app.storage.record(shard, "write", file_size)
+
+    return record_upload(
+        file_id,
+        original_filename,
+        make_blob_id(digest, codec),
+        [object_name],
+        file_size,
+        content_type,
+        options,
+        codec=codec,
+        shard=shard.name,
+    )
+
+
+def storage_codec(filename, content_type):
+    """The codec to try for an upload, or None if it isn't worth compressing."""
+    codec = available_codec(current_app.config["STORAGE_COMPRESSION"])
+    if codec and (
+        compressible(content_type)
+        or get_file_icon(filename, content_type) in COMPRESSIBLE_ICONS
+    ):
+        return codec
+    return None
+
+
+def record_upload(
+    file_id,
+    original_filename,
+    blob_id,
+    source_names,
+    file_size,
+    content_type,
+    options,
+    codec=None,
+    shard=None,
+):
+    """Create the file document for sources staged on storage ``shard``."""
+    blobs_collection = current_app.mongo_db["blobs"]
+    storage = current_app.storage.get(shard)
+
+    if current_app.config["ASYNC_UPLOAD_FINALIZE"]:
+        # The sources are already durable in MinIO; promoting them to a blob
+        # (a server-side copy) and inserting the document is left to the
+        # finalizer pool
+        file_data = build_file_doc(
+            file_id,
+            original_filename,
+            None,
+            None,
+            file_size,
+            content_type,
+            options,
+            codec,
+            storage.name,
         )
-        expiration_date = expiration_datetime.isoformat()
-    except ValueError:
-        expiration_datetime = datetime.now(timezone.utc) + timedelta(days=7)
-        expiration_datetime = expiration_datetime.replace(
-            hour=23, minute=59, second=59, microsecond=999999
+        plan_preview(file_data)
+        current_app.upload_finalizer.stage(
+            file_data, sources=list(source_names), blob_id=blob_id
         )
-        expiration_date = expiration_datetime.isoformat()
+        return file_data
 
-    original_filename = file.filename
-    saved_name = f"{file_id}_{original_filename}"
-    local_path = os.path.join(UPLOAD_FOLDER, saved_name)
-    file.save(local_path)
+    # Identical content is stored once and shared between file documents, so
+    # a duplicate is read from wherever the first copy went
+    saved_name, _, blob_shard = store_blob(
+        blobs_collection,
+        storage.client,
+        storage.bucket_name,
+        source_names,
+        blob_id,
+        file_size,
+        file_id,
+        storage.name,
+    )
+
+    file_data = build_file_doc(
+        file_id,
+        original_filename,
+        saved_name,
+        blob_id,
+        file_size,
+        content_type,
+        options,
+        codec,
+        blob_shard,
+    )
+    plan_preview(file_data)
 
     try:
-        found = minio.bucket_exists(bucket_name)
-        if not found:
-            minio.make_bucket(bucket_name)
+        current_app.mongo_db["files"].insert_one(file_data)
+    except Exception:
+        current_app.storage.remove(release_blobs(blobs_collection, [blob_id]))
+        raise
+    if file_data.get("preview"):
+        current_app.preview_generator.submit(file_id)
+    return file_data
 
-        minio.fput_object(bucket_name, saved_name, local_path)
 
-        file_size = os.path.getsize(local_path)
-        content_type = file.content_type
-        file_icon = get_file_icon(original_filename, content_type)
+def plan_preview(file_doc):
+    # Marked before the insert, so a restart can't lose the job
+    if current_app.preview_generator.wants(file_doc):
+        file_doc["preview"] = {"status": "pending"}
 
-        file_data = {
-            "_id": file_id,
-            "original_filename": original_filename,
-            "saved_filename": saved_name,
-            "file_size": file_size,
-            "content_type": content_type,
-            "file_icon": file_icon,
-            "upload_time": datetime.now(timezone.utc),
-            "password": hashed_password,
-            "has_password": bool(password),
-            "expiration_date": expiration_date,
-            "download_limit": download_limit,
-            "download_count": 0,
-            "description": description,
+
+def build_file_doc(
+    file_id,
+    original_filename,
+    saved_name,
+    blob_id,
+    file_size,
+    content_type,
+    options,
+    codec=None,
+    shard=None,
+):
+    return {
+        "_id": file_id,
+        "original_filename": original_filename,
+        "saved_filename": saved_name,
+        "blob_id": blob_id,
+        "file_size": file_size,
+        "content_type": content_type,
+        # Compression of the stored object; None means it is stored as uploaded
+        "codec": codec,
+        # Storage endpoint holding the object; None means the default one
+        "shard": shard,
+        "file_icon": get_file_icon(original_filename, content_type),
+        "upload_time": datetime.now(timezone.utc),
+        "download_count": 0,
+        **options,
+    }
+
+
+@main.route("/uploads", methods=["POST"])
+def create_upload_session():
+    sessions_collection = current_app.mongo_db["upload_sessions"]
+    values = request.get_json(silent=True) or request.form.to_dict()
+
+    original_filename = values.get("filename", "")
+    if not original_filename:
+        return jsonify({"error": "No file selected"}), 400
+
+    try:
+        file_size = int(values.get("size", -1))
+    except (TypeError, ValueError):
+        file_size = -1
+    if file_size < 0:
+        return jsonify({"error": "File size is required"}), 400
+
+    # Chunks are composed server-side, so every chunk but the last must meet
+    # MinIO's minimum part size and there can be at most 10,000 of them
+    chunk_size = max(
+        current_app.config["RESUMABLE_CHUNK_SIZE"],
+        MIN_PART_SIZE,
+        -(-file_size // MAX_UPLOAD_CHUNKS),
+    )
+    total_chunks = max(1, -(-file_size // chunk_size))
+
+    upload_id = generate()
+    file_id = generate()
+    session = {
+        "_id": upload_id,
+        "file_id": file_id,
+        "original_filename": original_filename,
+        "content_type": values.get("content_type") or "application/octet-stream",
+        "file_size": file_size,
+        "chunk_size": chunk_size,
+        "total_chunks": total_chunks,
+        "options": parse_upload_options(values),
+        "parts": {},
+        # Chunks are staged where the finished file will live, so composing
+        # them never copies across endpoints
+        "shard": current_app.storage.place(file_id).name,
+        "created_at": datetime.now(timezone.utc),
+    }
+    sessions_collection.insert_one(session)
+
+    return jsonify(
+        {
+            "upload_id": upload_id,
+            "chunk_size": chunk_size,
+            "total_chunks": total_chunks,
+            "parallel_chunks": current_app.config["RESUMABLE_PARALLEL_CHUNKS"],
         }
+    ), 201
 
-        files_collection.insert_one(file_data)
 
-        if os.path.exists(local_path):
-            os.remove(local_path)
+@main.route("/uploads/<upload_id>", methods=["GET"])
+def upload_session_status(upload_id):
+    session = current_app.mongo_db["upload_sessions"].find_one({"_id": upload_id})
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
 
-        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-            return jsonify(
-                {
-                    "success": True,
-                    "file_id": file_id,
-                    "redirect_url": url_for("main.file_success", file_id=file_id),
+    received = sorted(int(index) for index in session["parts"])
+    return jsonify(
+        {
+            "upload_id": upload_id,
+            "chunk_size": session["chunk_size"],
+            "total_chunks": session["total_chunks"],
+            "received": received,
+            "offsets": [index * session["chunk_size"] for index in received],
+            "bytes_received": sum(part["size"] for part in session["parts"].values()),
+        }
+    )
+
+
+@main.route("/uploads/<upload_id>/chunks/<int:index>", methods=["PUT"])
+def upload_chunk(upload_id, index):
+    sessions_collection = current_app.mongo_db["upload_sessions"]
+
+    session = sessions_collection.find_one({"_id": upload_id})
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+    if session.get("completing"):
+        return jsonify({"error": "Upload is already being completed"}), 409
+
+    if index >= session["total_chunks"]:
+        return jsonify({"error": "Chunk index out of range"}), 400
+
+    expected_size = session["chunk_size"]
+    if index == session["total_chunks"] - 1:
+        expected_size = session["file_size"] - index * session["chunk_size"]
+    if request.content_length is None:
+        return jsonify({"error": "Content-Length is required"}), 411
+    if request.content_length != expected_size:
+        return jsonify({"error": f"Chunk {index} must be {expected_size} bytes"}), 400
+
+    try:
+        current_app.storage_bootstrap.ensure()
+
+        shard = current_app.storage.get(session.get("shard"))
+        reader = CountingReader(request.stream)
+        result = shard.client.put_object(
+            shard.bucket_name,
+            chunk_object_name(upload_id, index),
+            reader,
+            length=expected_size,
+        )
+    except Exception as e:
+        print(f"Error storing upload chunk: {str(e)}")
+        return jsonify({"error": "Chunk upload failed. Please retry."}), 500
+
+    sessions_collection.update_one(
+        {"_id": upload_id},
+        {
+            "$set": {
+                f"parts.{index}": {
+                    "size": expected_size,
+                    "etag": result.etag,
+                    "sha256": reader.sha256.hexdigest(),
                 }
-            )
+            }
+        },
+    )
+    current_app.metrics.uploaded_bytes.inc(amount=expected_size)
+    current_app.storage.record(shard, "write", expected_size)
+    return jsonify({"index": index, "size": expected_size})
 
-        return redirect(url_for("main.file_success", file_id=file_id))
 
+@main.route("/uploads/<upload_id>/complete", methods=["POST"])
+def complete_upload_session(upload_id):
+    sessions_collection = current_app.mongo_db["upload_sessions"]
+
+    # Claimed before anything is composed, so an overlapping or retried
+    # complete can't consume the chunks a second time
+    session = sessions_collection.find_one_and_update(
+        {"_id": upload_id, "completing": {"$ne": True}},
+        {"$set": {"completing": True}},
+    )
+    if not session:
+        if sessions_collection.count_documents({"_id": upload_id}, limit=1):
+            return jsonify({"error": "Upload is already being completed"}), 409
+        return jsonify({"error": "Upload session not found"}), 404
+
+    missing = [
+        index
+        for index in range(session["total_chunks"])
+        if str(index) not in session["parts"]
+    ]
+    if missing:
+        sessions_collection.update_one(
+            {"_id": upload_id}, {"$unset": {"completing": ""}}
+        )
+        return jsonify({"error": "Upload is incomplete", "missing": missing}), 409
+
+    file_id = session["file_id"]
+    part_names = [
+        chunk_object_name(upload_id, index) for index in range(session["total_chunks"])
+    ]
+
+    # Chunks arrive out of order, so the content address is a hash over the
+    # chunk digests; it matches re-uploads made with the same chunk size
+    chunk_digests = hashlib.sha256()
+    for index in range(session["total_chunks"]):
+        chunk_digests.update(bytes.fromhex(session["parts"][str(index)]["sha256"]))
+    blob_id = f"sha256-chunks-{session['chunk_size']}:{chunk_digests.hexdigest()}"
+
+    try:
+        # Consumes the chunk objects, composing them into the blob if it's new
+        record_upload(
+            file_id,
+            session["original_filename"],
+            blob_id,
+            part_names,
+            session["file_size"],
+            session["content_type"],
+            session["options"],
+            shard=session.get("shard"),
+        )
     except Exception as e:
-        if os.path.exists(local_path):
-            os.remove(local_path)
-        print(f"Error during file upload: {str(e)}")
+        print(f"Error completing upload: {str(e)}")
+        sessions_collection.update_one(
+            {"_id": upload_id}, {"$unset": {"completing": ""}}
+        )
+        return jsonify({"error": "Upload failed. Please try again."}), 500
 
-        if request.headers.get("X-Requested-With") == "XMLHttpRequest":
-            return jsonify({"error": "Upload failed. Please try again."}), 500
+    sessions_collection.delete_one({"_id": upload_id})
+
+    return jsonify(
+        {
+            "success": True,
+            "file_id": file_id,
+            "redirect_url": url_for("main.file_success", file_id=file_id),
+        }
+    )
+
+
+@main.route("/uploads/<upload_id>", methods=["DELETE"])
+def abort_upload_session(upload_id):
+    sessions_collection = current_app.mongo_db["upload_sessions"]
+    session = sessions_collection.find_one({"_id": upload_id})
+    if not session:
+        return jsonify({"error": "Upload session not found"}), 404
+    if session.get("completing"):
+        return jsonify({"error": "Upload is already being completed"}), 409
+
+    current_app.storage.remove(
+        (session.get("shard"), chunk_object_name(upload_id, int(index)))
+        for index in session["parts"]
+    )
+    sessions_collection.delete_one({"_id": upload_id})
+    return "", 204
+
+
+@main.route("/bundles", methods=["POST"])
+def upload_bundle():
+    is_xhr = request.headers.get("X-Requested-With") == "XMLHttpRequest"
+    files = [file for file in request.files.getlist("files") if file.filename]
+    if not files:
+        if is_xhr:
+            return jsonify({"error": "No file selected"}), 400
+        flash("No file selected", "error")
+        return redirect(url_for("main.index"))
 
+    max_files = current_app.config["BATCH_MAX_FILES"]
+    if len(files) > max_files:
+        if is_xhr:
+            return jsonify({"error": f"At most {max_files} files per upload"}), 400
+        flash(f"At most {max_files} files per upload", "error")
+        return redirect(url_for("main.index"))
+
+    bundle_id = generate()
+    # One password hash is shared by every file in the bundle
+    options = parse_upload_options(request.form)
+
+    try:
+        bundle = store_bundle(bundle_id, files, options)
+    except Exception as e:
+        print(f"Error during bundle upload: {str(e)}")
+        if is_xhr:
+            return jsonify({"error": "Upload failed. Please try again."}), 500
         flash("Upload failed. Please try again.", "error")
-        return redirect(request.url)
+        return redirect(url_for("main.index"))
+
+    if is_xhr:
+        return jsonify(
+            {
+                "success": True,
+                "bundle_id": bundle_id,
+                "file_ids": bundle["file_ids"],
+                "redirect_url": url_for("main.bundle_success", bundle_id=bundle_id),
+            }
+        )
+    return redirect(url_for("main.bundle_success", bundle_id=bundle_id))
+
+
+def store_bundle(bundle_id, files, options):
+    blobs_collection = current_app.mongo_db["blobs"]
+
+    current_app.storage_bootstrap.ensure()
+
+    uploads = [(generate(), file) for file in files]
+    stored = store_files(
+        current_app.storage,
+        blobs_collection,
+        [
+            (
+                file_id,
+                file.stream,
+                file.content_type,
+                storage_codec(file.filename, file.content_type),
+            )
+            for file_id, file in uploads
+        ],
+        current_app.config["UPLOAD_PART_SIZE"],
+        current_app.config["UPLOAD_MAX_BUFFER"],
+        current_app.config["BATCH_UPLOAD_WORKERS"],
+    )
+
+    current_app.metrics.uploaded_bytes.inc(
+        amount=sum(size for _, _, size, _, _ in stored.values())
+    )
+
+    file_docs = []
+    for file_id, file in uploads:
+        saved_name, blob_id, file_size, codec, shard = stored[file_id]
+        file_doc = build_file_doc(
+            file_id,
+            file.filename,
+            saved_name,
+            blob_id,
+            file_size,
+            file.content_type,
+            options,
+            codec,
+            shard,
+        )
+        file_doc["bundle_id"] = bundle_id
+        plan_preview(file_doc)
+        file_docs.append(file_doc)
+
+    bundle = {
+        "_id": bundle_id,
+        "file_ids": [file_id for file_id, _ in uploads],
+        "file_count": len(uploads),
+        "total_size": sum(size for _, _, size, _, _ in stored.values()),
+        "upload_time": datetime.now(timezone.utc),
+        **options,
+    }
+
+    files_collection = current_app.mongo_db["files"]
+    try:
+        files_collection.insert_many(file_docs)
+        current_app.mongo_db["bundles"].insert_one(bundle)
+    except Exception:
+        files_collection.delete_many({"_id": {"$in": bundle["file_ids"]}})
+        discard_files(current_app.storage, blobs_collection, stored.values())
+        raise
+    for file_doc in file_docs:
+        if file_doc.get("preview"):
+            current_app.preview_generator.submit(file_doc["_id"])
+    return bundle
+
+
+@main.route("/bundles/<bundle_id>", methods=["GET", "POST"])
+def access_bundle(bundle_id):
+    bundle = current_app.mongo_db["bundles"].find_one(
+        {"_id": bundle_id}, FILE_PROJECTION
+    )
+    if not bundle:
+        return jsonify({"error": "Bundle not found or it is expired"}), 404
+
+    expiration_date = expiration_datetime(bundle)
+    if expiration_date and datetime.now(timezone.utc) > expiration_date:
+        return render_template("bundle.html", bundle=bundle, files=[], expired=True)
+
+    action = url_for("main.access_bundle", bundle_id=bundle_id)
+    protected = bundle["has_password"]
+    if protected:
+        entered_password = submitted_password()
+        if request.method != "POST" and not entered_password:
+            return render_template("verify.html", file_id=bundle_id, action=action)
+
+        accepted, retry_after = check_password_attempt(
+            (bundle_id, request.remote_addr),
+            partial(load_bundle_password_hash, bundle_id),
+            entered_password,
+        )
+        if retry_after:
+            flash("Too many incorrect attempts. Please try again later.", "error")
+            return (
+                render_template("verify.html", file_id=bundle_id, action=action),
+                429,
+                {"Retry-After": str(retry_after)},
+            )
+        if not accepted:
+            if request.method == "POST":
+                flash("Incorrect password", "error")
+            return render_template("verify.html", file_id=bundle_id, action=action)
+
+    file_docs = {
+        file_doc["_id"]: file_doc
+        for file_doc in current_app.mongo_db["files"].find(
+            {"_id": {"$in": bundle["file_ids"]}}, FILE_PROJECTION
+        )
+    }
+    files = []
+    for file_id in bundle["file_ids"]:
+        file_doc = file_docs.get(file_id)
+        if not file_doc:
+            continue
+        file_doc["limit_reached"] = bool(
+            file_doc.get("download_limit")
+            and file_doc["download_count"] >= file_doc["download_limit"]
+        )
+        file_doc["token"] = (
+            issue_download_token(current_app.secret_key, file_id) if protected else None
+        )
+        files.append(file_doc)
+
+    archive_url = None
+    if sum(not file_doc["limit_reached"] for file_doc in files) > 1:
+        archive_url = url_for(
+            "main.download_bundle_archive",
+            bundle_id=bundle_id,
+            token=issue_bundle_token(current_app.secret_key, bundle_id)
+            if protected
+            else None,
+        )
+
+    return render_template(
+        "bundle.html", bundle=bundle, files=files, archive_url=archive_url
+    )
+
+
+@main.route("/bundles/<bundle_id>/success")
+def bundle_success(bundle_id):
+    bundle = current_app.mongo_db["bundles"].find_one(
+        {"_id": bundle_id}, FILE_PROJECTION
+    )
+    if not bundle:
+        flash("Bundle not found", "error")
+        return redirect(url_for("main.index"))
+
+    expiration_display = "Never"
+    expiration_date = expiration_datetime(bundle)
+    if expiration_date:
+        expiration_display = expiration_date.strftime("%b %d, %Y at %I:%M %p")
+
+    return render_template(
+        "success.html",
+        file_id=bundle["_id"],
+        file_name=f"{bundle['file_count']} files",
+        file_size=format_file_size(bundle["total_size"]),
+        expiration_date=expiration_display,
+        download_limit=bundle.get("download_limit", 0) or "Unlimited",
+        download_url=url_for(
+            "main.access_bundle", bundle_id=bundle["_id"], _external=True
+        ),
+    )
+
+
+def load_bundle_password_hash(bundle_id):
+    bundle = current_app.mongo_db["bundles"].find_one(
+        {"_id": bundle_id}, {"password": 1}
+    )
+    return bundle.get("password") if bundle else None
+
+
+@main.route("/files", methods=["GET"])
+def list_uploaded_files():
+    # Operator API: lists every link, so it is off unless ADMIN_TOKEN is set
+    admin_token = current_app.config["ADMIN_TOKEN"]
+    if not admin_token:
+        return jsonify({"error": "Not found"}), 404
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(supplied.encode("utf-8"), admin_token.encode("utf-8")):
+        return jsonify({"error": "Unauthorized"}), 401, {"WWW-Authenticate": "Bearer"}
+
+    try:
+        file_docs, next_cursor = list_files(
+            current_app.mongo_db["files"],
+            request.args,
+            current_app.config["LISTING_PAGE_SIZE"],
+        )
+    except ListingError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(
+        {
+            "files": [serialize_file(file_doc) for file_doc in file_docs],
+            "next_cursor": next_cursor,
+        }
+    )
 
 
 @main.route("/files/<file_id>", methods=["GET", "POST"])
 def access_file(file_id):
-    files_collection = current_app.mongo_db["files"]
-    file_doc = files_collection.find_one({"_id": file_id})
+    file_doc = find_file(file_id)
     if not file_doc:
         return jsonify({"error": "File not found or it is expired"}), 404
 
-    if file_doc.get("expiration_date"):
-        # Check if we're using the old date format
-        if len(file_doc["expiration_date"]) == 10:  # YYYY-MM-DD format
-            # Convert to timezone-aware datetime by adding timezone information
-            expiration_date = datetime.strptime(
-                file_doc["expiration_date"], "%Y-%m-%d"
-            ).replace(
-                hour=23, minute=59, second=59, microsecond=999999, tzinfo=timezone.utc
-            )
-        else:  # Using new ISO format
-            expiration_date = datetime.fromisoformat(file_doc["expiration_date"])
+    expiration_date = expiration_datetime(file_doc)
+    expired = bool(expiration_date and datetime.now(timezone.utc) > expiration_date)
+    if request.method == "GET" and not submitted_password():
+        not_modified = conditional_page(page_etag(file_doc, expired))
+        if not_modified:
+            return not_modified
 
-        current_date = datetime.now(timezone.utc)
-        if current_date > expiration_date:
-            return render_template("download.html", file=file_doc, expired=True)
+    if expired:
+        return render_template("download.html", file=file_doc, expired=True)
+
+    if not file_ready(file_doc):
+        return render_template(
+            "download.html", file=file_doc, status=file_doc.get("status")
+        )
 
     if (
         file_doc.get("download_limit")
@@ -202,127 +979,749 @@ def access_file(file_id):
     if not file_doc["has_password"]:
         return render_template("download.html", file=file_doc)
 
-    if request.method == "POST":
-        entered_password = request.form.get("password", None)
-        if entered_password and verify_password(file_doc["password"], entered_password):
-            return render_template(
-                "download.html", file=file_doc, password=entered_password
+    entered_password = submitted_password()
+    if request.method == "POST" or entered_password:
+        accepted, retry_after = check_password_attempt(
+            (file_id, request.remote_addr),
+            partial(load_password_hash, file_id),
+            entered_password,
+        )
+        if retry_after:
+            flash("Too many incorrect attempts. Please try again later.", "error")
+            return (
+                render_template("verify.html", file_id=file_doc["_id"]),
+                429,
+                {"Retry-After": str(retry_after)},
             )
-        else:
-            flash("Incorrect password", "error")
-            return render_template("verify.html", file_id=file_doc["_id"])
 
-    entered_password = request.args.get("password", None)
-    if entered_password and verify_password(file_doc["password"], entered_password):
-        return render_template(
-            "download.html", file=file_doc, password=entered_password
-        )
+        if accepted:
+            response = make_response(
+                render_template(
+                    "download.html",
+                    file=file_doc,
+                    token=issue_download_token(current_app.secret_key, file_id),
+                )
+            )
+            # The page embeds a download token
+            response.cache_control.no_store = True
+            return response
+
+        if request.method == "POST":
+            flash("Incorrect password", "error")
 
     return render_template("verify.html", file_id=file_doc["_id"])
 
 
+def submitted_password():
+    if request.method == "POST":
+        return request.form.get("password", None)
+    return request.args.get("password", None)
+
+
+def check_password_attempt(attempt_key, load_hash, entered_password):
+    """Returns ``(accepted, retry_after)`` for a password attempt."""
+    # Throttle per link and client so floods are refused before bcrypt runs
+    retry_after = current_app.password_attempts.retry_after(attempt_key)
+    if retry_after:
+        return False, retry_after
+
+    if entered_password and verify_password(load_hash(), entered_password):
+        current_app.password_attempts.reset(attempt_key)
+        return True, 0
+
+    current_app.password_attempts.record_failure(attempt_key)
+    return False, 0
+
+
 @main.route("/files/<file_id>/download")
 def download_file(file_id):
     files_collection = current_app.mongo_db["files"]
-    minio = current_app.minio_client
-    bucket_name = current_app.bucket_name
 
-    file_doc = files_collection.find_one({"_id": file_id})
+    file_doc = find_file(file_id)
     if not file_doc:
         return jsonify({"error": "File not found or it is expired"}), 404
 
     # Check if file has expired
-    if file_doc.get("expiration_date"):
-        # Check if we're using the old date format
-        if len(file_doc["expiration_date"]) == 10:  # YYYY-MM-DD format
-            # Convert to timezone-aware datetime by adding timezone information
-            expiration_date = datetime.strptime(
-                file_doc["expiration_date"], "%Y-%m-%d"
-            ).replace(
-                hour=23, minute=59, second=59, microsecond=999999, tzinfo=timezone.utc
-            )
-        else:  # Using new ISO format
-            expiration_date = datetime.fromisoformat(file_doc["expiration_date"])
+    expiration_date = expiration_datetime(file_doc)
+    if expiration_date and datetime.now(timezone.utc) > expiration_date:
+        flash("This file has expired", "error")
+        return redirect(url_for("main.access_file", file_id=file_id))
+
+    if not file_ready(file_doc):
+        return redirect(url_for("main.access_file", file_id=file_id))
 
-        current_date = datetime.now(timezone.utc)
-        if current_date > expiration_date:
-            flash("This file has expired", "error")
+    etag = download_etag(file_doc, download_encoding(file_doc))
+    last_modified = file_last_modified(file_doc)
+    ranges = requested_ranges(file_doc, etag, last_modified)
+    span = download_span(file_doc, ranges)
+
+    # A grant cookie marks follow-up requests (Range resumes and seeks ahead)
+    # that belong to a download which already passed the checks and was
+    # counted. A range that covers bytes already served under the grant
+    # starts the file over and is counted as a new download.
+    grants_collection = current_app.mongo_db["download_grants"]
+    grant_cookie = f"dropit_grant_{file_id}"
+    grant_id = None
+    if ranges and span:
+        grant_id = verify_download_grant(
+            current_app.secret_key,
+            file_id,
+            request.cookies.get(grant_cookie),
+            current_app.config["DOWNLOAD_GRANT_TTL"],
+        )
+        if grant_id and not extend_grant(grants_collection, grant_id, file_id, *span):
+            grant_id = None
+    granted = grant_id is not None
+    release = None
+
+    if not granted:
+        # Check download limits
+        if (
+            file_doc.get("download_limit")
+            and file_doc["download_count"] >= file_doc["download_limit"]
+        ):
+            flash("Download limit reached", "error")
             return redirect(url_for("main.access_file", file_id=file_id))
 
-    # Check download limits
-    if (
-        file_doc.get("download_limit")
-        and file_doc["download_count"] >= file_doc["download_limit"]
+        if file_doc["has_password"] and not verify_download_token(
+            current_app.secret_key,
+            file_id,
+            request.args.get("token"),
+            current_app.config["DOWNLOAD_TOKEN_TTL"],
+        ):
+            return redirect(url_for("main.access_file", file_id=file_id))
+
+    # Revalidations of an unchanged file are answered before the object is
+    # fetched or the download is counted
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
     ):
-        flash("Download limit reached", "error")
-        return redirect(url_for("main.access_file", file_id=file_id))
+        if granted:
+            settle_grant(grants_collection, grant_id, span[1], span[0])
+        response = Response(status=304)
+        response.set_etag(etag)
+        if last_modified:
+            response.last_modified = last_modified
+        set_download_cache_control(response, file_doc)
+        return response
+
+    # Answered before the download is counted, so a request no byte of the
+    # file can satisfy doesn't use up the limit
+    if ranges == []:
+        return unsatisfiable_range_response(file_doc["file_size"])
+
+    # Waits for a transfer slot when all are taken; raises TransfersBusy once
+    # the queue is full, before the download is counted
+    transfer = admit_transfer(file_doc)
+    response = None
+    try:
+        # Files without a download limit don't need the count to be exact at
+        # once, so the download log adds them up and writes them in batches
+        log = current_app.download_log
+        deferred = log.enabled and not granted and not file_doc.get("download_limit")
+
+        if not granted and not deferred:
+            # The limit check and the increment are a single conditional update,
+            # so concurrent downloads can't push download_count past the limit
+            if not claim_download(files_collection, file_id):
+                if transfer:
+                    transfer.close()
+                flash("Download limit reached", "error")
+                return redirect(url_for("main.access_file", file_id=file_id))
+            release = partial(
+                release_download, files_collection, current_app.metadata_cache, file_id
+            )
+
+        storage = current_app.storage.locate(file_doc)
+        response = build_download_response(file_doc, storage, release, ranges)
+        if response is None or response.status_code not in (200, 206, 302):
+            # Nothing of the file was handed out, e.g. send_file answered a
+            # precondition itself
+            if release:
+                release()
+            if granted:
+                settle_grant(grants_collection, grant_id, span[1], span[0])
+        if response is None:
+            if transfer:
+                transfer.close()
+            flash("Error downloading file. Please try again.", "error")
+            return redirect(url_for("main.index"))
+
+        if response.status_code not in (200, 206):
+            # Redirects to MinIO send no body of ours
+            if transfer:
+                transfer.close()
+            if log.enabled and response.status_code == 302:
+                log.record(new_download_event(file_id, granted, "redirected"), deferred)
+            return response
+
+        set_download_cache_control(response, file_doc)
+        if span and not granted:
+            grant_id = open_grant(
+                grants_collection,
+                file_id,
+                *span,
+                current_app.config["DOWNLOAD_GRANT_TTL"],
+            )
+            response.set_cookie(
+                grant_cookie,
+                issue_download_grant(current_app.secret_key, file_id, grant_id),
+                max_age=current_app.config["DOWNLOAD_GRANT_TTL"],
+                path=url_for("main.download_file", file_id=file_id),
+                httponly=True,
+                samesite="Lax",
+            )
+    except Exception:
+        # Whatever failed, the slot and the count go back; the body, if any,
+        # was never handed to the server
+        if transfer:
+            transfer.close()
+        if release:
+            release()
+        if granted:
+            settle_grant(grants_collection, grant_id, span[1], span[0])
+        if response is not None:
+            response.close()
+        raise
+
+    # Nothing below does I/O; from here on the body owns the transfer
+    if not response.direct_passthrough:
+        # Served from the shard rather than the local object cache
+        response.response = CountedBody(
+            response.response,
+            current_app.metrics.storage_bytes,
+            storage.name,
+            "read",
+        )
+    if transfer:
+        shape_response(response, transfer)
+    if log.enabled:
+        response.response = RecordedBody(
+            response.response, log, new_download_event(file_id, granted), deferred
+        )
+    if grant_id and "Content-Encoding" not in response.headers:
+        # Outermost, so it sees what was actually handed to the server;
+        # encoded bodies and multipart ranges keep the whole span served
+        if ranges is None or len(ranges) == 1:
+            response.response = GrantedBody(
+                response.response, grants_collection, grant_id, *span
+            )
+    return response
+
+
+@main.route("/archive", methods=["GET", "POST"])
+def download_archive():
+    file_ids = list(dict.fromkeys(request.values.getlist("file")))
+    if not file_ids:
+        return jsonify({"error": "No files selected"}), 400
+
+    max_files = current_app.config["BATCH_MAX_FILES"]
+    if len(file_ids) > max_files:
+        return jsonify({"error": f"At most {max_files} files per archive"}), 400
+
+    def authorized(file_doc):
+        return not file_doc["has_password"] or verify_download_token(
+            current_app.secret_key,
+            file_doc["_id"],
+            request.values.get(f"token-{file_doc['_id']}"),
+            current_app.config["DOWNLOAD_TOKEN_TTL"],
+        )
+
+    return archive_response(file_ids, authorized)
+
+
+@main.route("/bundles/<bundle_id>/archive")
+def download_bundle_archive(bundle_id):
+    bundle = current_app.mongo_db["bundles"].find_one(
+        {"_id": bundle_id}, FILE_PROJECTION
+    )
+    if not bundle:
+        return jsonify({"error": "Bundle not found or it is expired"}), 404
+
+    expiration_date = expiration_datetime(bundle)
+    if expiration_date and datetime.now(timezone.utc) > expiration_date:
+        return jsonify({"error": "These files have expired"}), 410
 
-    entered_password = request.args.get("password")
-    if file_doc["has_password"]:
-        if not entered_password or not verify_password(
-            file_doc["password"], entered_password
+    if bundle["has_password"] and not verify_bundle_token(
+        current_app.secret_key,
+        bundle_id,
+        request.args.get("token"),
+        current_app.config["DOWNLOAD_TOKEN_TTL"],
+    ):
+        return redirect(url_for("main.access_bundle", bundle_id=bundle_id))
+
+    # Files that already reached their limit are left out of the archive, as
+    # they are on the bundle page
+    available = {
+        file_doc["_id"]
+        for file_doc in current_app.mongo_db["files"].find(
+            {"_id": {"$in": bundle["file_ids"]}, "bundle_id": bundle_id},
+            {"download_limit": 1, "download_count": 1},
+        )
+        if not file_doc.get("download_limit")
+        or file_doc["download_count"] < file_doc["download_limit"]
+    }
+    file_ids = [file_id for file_id in bundle["file_ids"] if file_id in available]
+    if not file_ids:
+        return jsonify({"error": "Download limit reached"}), 403
+
+    # The bundle token covers the files recorded as part of this bundle
+    return archive_response(
+        file_ids, lambda file_doc: file_doc.get("bundle_id") == bundle_id
+    )
+
+
+def archive_response(file_ids, authorized):
+    files_collection = current_app.mongo_db["files"]
+
+    # Every file must pass the same checks as its own download link
+    file_docs = []
+    now = datetime.now(timezone.utc)
+    for file_id in file_ids:
+        file_doc = find_file(file_id)
+        if not file_doc:
+            return jsonify(
+                {"error": "File not found or it is expired", "file_id": file_id}
+            ), 404
+
+        expiration_date = expiration_datetime(file_doc)
+        if expiration_date and now > expiration_date:
+            return jsonify({"error": "This file has expired", "file_id": file_id}), 410
+
+        if not file_ready(file_doc):
+            return jsonify(
+                {"error": "This file is still being processed", "file_id": file_id}
+            ), 409
+
+        if (
+            file_doc.get("download_limit")
+            and file_doc["download_count"] >= file_doc["download_limit"]
         ):
-            return redirect(url_for("main.access_file", file_id=file_id))
+            return jsonify({"error": "Download limit reached", "file_id": file_id}), 403
+
+        if not authorized(file_doc):
+            return jsonify({"error": "Password required", "file_id": file_id}), 403
+        file_docs.append(file_doc)
 
-    temp_file_path = os.path.join(
-        UPLOAD_FOLDER, os.path.basename(file_doc["saved_filename"])
+    claimed = []
+    release = partial(
+        release_downloads, files_collection, current_app.metadata_cache, claimed
+    )
+    for file_doc in file_docs:
+        if not claim_download(files_collection, file_doc["_id"]):
+            release()
+            return jsonify(
+                {"error": "Download limit reached", "file_id": file_doc["_id"]}
+            ), 403
+        claimed.append(file_doc["_id"])
+
+    names = unique_names([file_doc["original_filename"] for file_doc in file_docs])
+    entries = [
+        ArchiveEntry(
+            name,
+            file_doc["saved_filename"],
+            file_doc.get("file_size"),
+            compress=file_doc.get("file_icon") not in PRECOMPRESSED_ICONS,
+            modified=file_last_modified(file_doc),
+            codec=file_doc.get("codec"),
+            storage=shard_location(file_doc),
+        )
+        for name, file_doc in zip(names, file_docs)
+    ]
+    body = ZipStream(
+        current_app.minio_client,
+        current_app.bucket_name,
+        entries,
+        current_app.config["DOWNLOAD_CHUNK_SIZE"],
+        on_error=release,
+    )
+    response = Response(body, mimetype="application/zip")
+    response.headers["Content-Disposition"] = content_disposition("dropit-files.zip")
+    return response
+
+
+def new_download_event(file_id, resumed, status=None):
+    return download_event(
+        file_id,
+        request.remote_addr,
+        request.user_agent.string,
+        resumed,
+        status=status,
+    )
+
+
+def admit_transfer(file_doc):
+    scheduler = current_app.transfer_scheduler
+    if not scheduler.enabled and not file_doc.get("rate_limit"):
+        return None
+    return scheduler.admit(
+        request.remote_addr,
+        file_doc.get("rate_limit") or 0,
+        file_doc.get("bandwidth_weight") or 1,
     )
-    try:
-        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-        minio.fget_object(bucket_name, file_doc["saved_filename"], temp_file_path)
 
-        files_collection.update_one({"_id": file_id}, {"$inc": {"download_count": 1}})
 
-        return send_file(
-            temp_file_path,
-            mimetype=file_doc.get("content_type", "application/octet-stream"),
-            as_attachment=True,
-            download_name=file_doc["original_filename"],
+def shape_response(response, transfer):
+    # Paced bodies can't go out through sendfile, so file responses are
+    # iterated like any other
+    response.direct_passthrough = False
+    response.response = ShapedBody(response.response, transfer)
+
+
+def shard_location(file_doc):
+    shard = current_app.storage.locate(file_doc)
+    return shard.client, shard.bucket_name
+
+
+def requested_ranges(file_doc, etag, last_modified):
+    """The byte ranges to serve; see ``resolve_ranges``."""
+    size = file_doc.get("file_size")
+    if size is None or not if_range_matches(request.if_range, etag, last_modified):
+        return None
+    return resolve_ranges(request.range, size)
+
+
+def download_span(file_doc, ranges):
+    """The ``(start, stop)`` bytes a download covers, or None if unknown."""
+    size = file_doc.get("file_size")
+    if size is None or ranges == []:
+        return None
+    if ranges is None:
+        return 0, size
+    return min(start for start, _ in ranges), max(stop for _, stop in ranges)
+
+
+def unsatisfiable_range_response(size):
+    response = Response(status=416)
+    response.headers["Content-Range"] = f"bytes */{size}"
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+
+def build_download_response(file_doc, storage, release, ranges):
+    minio = storage.client
+    bucket_name = storage.bucket_name
+    codec = file_doc.get("codec")
+    threshold = current_app.config["PRESIGNED_DOWNLOAD_THRESHOLD"]
+    # Compressed objects hold encoded bytes and rate-limited files have to be
+    # paced, so both are always served by us
+    if (
+        threshold
+        and not codec
+        and not file_doc.get("rate_limit")
+        and (file_doc.get("file_size") or 0) >= threshold
+    ):
+        try:
+            # Object storage answers Range requests on the presigned URL itself
+            url = presigned_download_url(
+                storage.public_client,
+                bucket_name,
+                file_doc,
+                current_app.config["PRESIGNED_URL_EXPIRY"],
+            )
+            return redirect(url, code=302)
+        except Exception as e:
+            print(f"Error presigning download: {str(e)}")
+
+    size = file_doc.get("file_size")
+    content_type = file_doc.get("content_type") or "application/octet-stream"
+    encoding = download_encoding(file_doc)
+    etag = download_etag(file_doc, encoding)
+    last_modified = file_last_modified(file_doc)
+    chunk_size = current_app.config["DOWNLOAD_CHUNK_SIZE"]
+
+    if codec and ranges and len(ranges) > 1:
+        # A compressed object can only be decoded from its start, so the
+        # ranges are served as one span instead of decoding it once per range
+        ranges = [(min(start for start, _ in ranges), max(stop for _, stop in ranges))]
+
+    # Multipart ranges are rare enough to always go to MinIO
+    cacheable = (
+        not encoding
+        and (ranges is None or len(ranges) == 1)
+        and current_app.object_cache.accepts(size)
+    )
+    if cacheable:
+        response = cached_download_response(
+            file_doc, minio, bucket_name, etag, last_modified, ranges
         )
+        if response is not None:
+            return response
+
+    try:
+        if encoding:
+            # The stored bytes already are the representation the client asked
+            # for; its length isn't recorded, so the body is sent chunked
+            body = stream_object(
+                minio,
+                bucket_name,
+                file_doc["saved_filename"],
+                chunk_size,
+                on_error=release,
+            )
+            response = Response(body, mimetype=content_type)
+            response.headers["Content-Encoding"] = encoding
+        elif codec:
+            start, stop = ranges[0] if ranges else (0, size)
+            stored = stream_object(
+                minio,
+                bucket_name,
+                file_doc["saved_filename"],
+                chunk_size,
+                on_error=release,
+            )
+            body = DecodedStream(stored, codec, chunk_size, start, stop)
+            if ranges:
+                response = Response(body, status=206, mimetype=content_type)
+                response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+            else:
+                response = Response(body, mimetype=content_type)
+            if stop is not None:
+                response.headers["Content-Length"] = str(stop - start)
+        elif ranges is None:
+            body = stream_object(
+                minio,
+                bucket_name,
+                file_doc["saved_filename"],
+                chunk_size,
+                on_error=release,
+            )
+            response = Response(body, mimetype=content_type)
+            if size is not None:
+                response.headers["Content-Length"] = str(size)
+        elif len(ranges) == 1:
+            start, stop = ranges[0]
+            body = stream_object(
+                minio,
+                bucket_name,
+                file_doc["saved_filename"],
+                chunk_size,
+                on_error=release,
+                offset=start,
+                length=stop - start,
+            )
+            response = Response(body, status=206, mimetype=content_type)
+            response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+            response.headers["Content-Length"] = str(stop - start)
+        else:
+            body = MultipartRangeStream(
+                minio,
+                bucket_name,
+                file_doc["saved_filename"],
+                chunk_size,
+                ranges,
+                size,
+                content_type,
+                on_error=release,
+            )
+            response = Response(body, status=206, mimetype=body.mimetype)
+            response.headers["Content-Length"] = str(body.content_length)
     except Exception as e:
         print(f"Error downloading file: {str(e)}")
-        flash("Error downloading file. Please try again.", "error")
-        return redirect(url_for("main.index"))
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        return None
+
+    if cacheable and ranges is None:
+        # A miss sends the whole object anyway, so the cached copy is written
+        # on the way instead of before the first byte goes out
+        response.response = current_app.object_cache.tee(
+            file_doc["saved_filename"], etag, response.response
+        )
+
+    response.headers["Content-Disposition"] = content_disposition(
+        file_doc["original_filename"]
+    )
+    response.headers["Accept-Ranges"] = "bytes"
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def cached_download_response(file_doc, minio, bucket_name, etag, last_modified, ranges):
+    cache = current_app.object_cache
+    object_name = file_doc["saved_filename"]
+    path = cache.lookup(object_name, etag)
+    if path is None and ranges is not None:
+        # A range can only be cut from a complete copy, so it is filled first
+        path = cache.fetch(
+            object_name,
+            etag,
+            partial(
+                download_to_file,
+                minio,
+                bucket_name,
+                object_name,
+                current_app.config["DOWNLOAD_CHUNK_SIZE"],
+                codec=file_doc.get("codec"),
+            ),
+        )
+    if path is None:
+        return None
+
+    try:
+        # send_file hands the file to the server's sendfile support when it
+        # has any, and answers Range and If-Range requests itself
+        response = send_file(
+            path,
+            mimetype=file_doc.get("content_type") or "application/octet-stream",
+            conditional=True,
+            etag=etag,
+            last_modified=last_modified,
+        )
+    except FileNotFoundError:
+        # Evicted, possibly by another process, after the lookup
+        cache.discard(object_name, etag)
+        return None
+
+    response.headers["Content-Disposition"] = content_disposition(
+        file_doc["original_filename"]
+    )
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
+
+
+def claim_download(files_collection, file_id):
+    now = datetime.now(timezone.utc)
+    claimed = files_collection.find_one_and_update(
+        {
+            "_id": file_id,
+            "$and": [
+                {
+                    "$or": [
+                        {"download_limit": {"$in": [0, None]}},
+                        {"$expr": {"$lt": ["$download_count", "$download_limit"]}},
+                    ]
+                },
+                {
+                    "$or": [
+                        {"expiration_date": None},
+                        {"expiration_date": {"$gt": now}},
+                        # Not yet migrated: string dates always end a UTC day
+                        {"expiration_date": {"$gte": now.strftime("%Y-%m-%d")}},
+                    ]
+                },
+            ],
+        },
+        {"$inc": {"download_count": 1}},
+        projection={"_id": 1},
+    )
+    if claimed is None:
+        return False
+    current_app.metadata_cache.invalidate(file_id)
+    return True
+
+
+def release_download(files_collection, metadata_cache, file_id):
+    # Runs from the response iterator too, so it can't rely on current_app
+    files_collection.update_one(
+        {"_id": file_id, "download_count": {"$gt": 0}},
+        {"$inc": {"download_count": -1}},
+    )
+    metadata_cache.invalidate(file_id)
+
+
+def release_downloads(files_collection, metadata_cache, file_ids):
+    for file_id in file_ids:
+        release_download(files_collection, metadata_cache, file_id)
+
+
+@main.route("/files/<file_id>/preview")
+def file_preview(file_id):
+    file_doc = find_file(file_id)
+    if not file_doc:
+        return jsonify({"error": "File not found or it is expired"}), 404
+
+    expiration_date = expiration_datetime(file_doc)
+    expired = bool(expiration_date and datetime.now(timezone.utc) > expiration_date)
+    if expired or not previewable(file_doc) or not file_ready(file_doc):
+        # The access page explains why, or asks for the password
+        return redirect(url_for("main.access_file", file_id=file_id))
+
+    not_modified = conditional_page(page_etag(file_doc))
+    if not_modified:
+        return not_modified
+    return render_template(
+        "preview.html",
+        file=dict(file_doc, file_id=file_id),
+        preview=file_doc.get("preview") or {},
+    )
+
+
+@main.route("/files/<file_id>/preview/content")
+def file_preview_content(file_id):
+    file_doc = find_file(file_id)
+    preview = (file_doc or {}).get("preview") or {}
+    # Protected and download-limited files never get a preview; the check
+    # also covers previews made before limited files were excluded
+    if not file_doc or not previewable(file_doc) or preview.get("status") != "ready":
+        return jsonify({"error": "Preview not available"}), 404
+
+    expiration_date = expiration_datetime(file_doc)
+    if expiration_date and datetime.now(timezone.utc) > expiration_date:
+        return jsonify({"error": "This file has expired"}), 410
+
+    etag = preview["etag"]
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    else:
+        shard = current_app.storage.get(preview["shard"])
+        try:
+            body = stream_object(
+                shard.client,
+                shard.bucket_name,
+                preview["object_name"],
+                current_app.config["DOWNLOAD_CHUNK_SIZE"],
+            )
+        except Exception as e:
+            print(f"Error streaming preview: {str(e)}")
+            return jsonify({"error": "Preview not available"}), 500
+        current_app.storage.record(shard, "read", preview["size"])
+        response = Response(body, content_type=preview["content_type"])
+        response.content_length = preview["size"]
+    response.set_etag(etag)
+    set_preview_cache_control(response, file_doc)
+    return response
+
+
+def set_preview_cache_control(response, file_doc):
+    # A file's content never changes and neither does its preview, so only
+    # the link's expiry limits how long caches may keep one
+    cache_control = response.cache_control
+    max_age = current_app.config["PREVIEW_CACHE_MAX_AGE"]
+    expires_at = expiration_datetime(file_doc)
+    if expires_at:
+        remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        max_age = min(max_age, int(remaining))
+    if max_age <= 0:
+        cache_control.no_cache = True
+        return
+    cache_control.public = True
+    cache_control.max_age = max_age
+    if not expires_at:
+        cache_control.immutable = True
 
 
 @main.route("/files/<file_id>/success")
 def file_success(file_id):
-    files_collection = current_app.mongo_db["files"]
-    file_doc = files_collection.find_one({"_id": file_id})
+    file_doc = find_file(file_id)
 
     if not file_doc:
         flash("File not found", "error")
         return redirect(url_for("main.index"))
 
-    def format_file_size(size_bytes):
-        if size_bytes < 1024:
-            return f"{size_bytes} bytes"
-        elif size_bytes < 1048576:
-            return f"{size_bytes / 1024:.1f} KB"
-        else:
-            return f"{size_bytes / 1048576:.1f} MB"
+    not_modified = conditional_page(page_etag(file_doc))
+    if not_modified:
+        return not_modified
 
     # Format expiration date for display
     expiration_display = "Never"
-    if file_doc.get("expiration_date"):
-        try:
-            # Check if we're using the old date format
-            if len(file_doc["expiration_date"]) == 10:  # YYYY-MM-DD format
-                expiration_date = datetime.strptime(
-                    file_doc["expiration_date"], "%Y-%m-%d"
-                )
-            else:  # Using new ISO format
-                expiration_date = datetime.fromisoformat(file_doc["expiration_date"])
-
-            expiration_display = expiration_date.strftime("%b %d, %Y at %I:%M %p")
-        except ValueError:
-            expiration_display = file_doc.get("expiration_date", "Never")
+    expiration_date = expiration_datetime(file_doc)
+    if expiration_date:
+        expiration_display = expiration_date.strftime("%b %d, %Y at %I:%M %p")
 
     return render_template(
         "success.html",
+        status=file_doc.get("status"),
         file_id=file_doc["_id"],
         file_name=file_doc["original_filename"],
         file_size=format_file_size(file_doc["file_size"]),
@@ -334,11 +1733,251 @@ def file_success(file_id):
     )
 
 
+def format_file_size(size_bytes):
+    if size_bytes < 1024:
+        return f"{size_bytes} bytes"
+    elif size_bytes < 1048576:
+        return f"{size_bytes / 1024:.1f} KB"
+    else:
+        return f"{size_bytes / 1048576:.1f} MB"
+
+
+def find_file(file_id):
+    # Read-through cache; the password hash is never part of the cached copy
+    cache = current_app.metadata_cache
+    file_doc = cache.get(file_id)
+    if file_doc is None:
+        file_doc = current_app.mongo_db["files"].find_one(
+            {"_id": file_id}, FILE_PROJECTION
+        )
+        if not file_doc:
+            # Staged here and not inserted yet; never cached, it's about to change
+            return current_app.upload_finalizer.staged(file_id)
+        expires_at = expiration_datetime(file_doc)
+        max_age = None
+        if expires_at:
+            # Don't let a cached copy outlive the link's expiry
+            max_age = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        cache.set(file_id, file_doc, max_age=max_age)
+    return dict(file_doc)
+
+
+def file_ready(file_doc):
+    # Documents from before asynchronous finalization have no status
+    return file_doc.get("status", "ready") == "ready"
+
+
+def load_password_hash(file_id):
+    file_doc = current_app.mongo_db["files"].find_one({"_id": file_id}, {"password": 1})
+    return file_doc.get("password") if file_doc else None
+
+
+def expiration_datetime(file_doc):
+    value = file_doc.get("expiration_date")
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        # Mongo hands back naive datetimes that are already in UTC
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    try:
+        return parse_legacy_expiration(value)
+    except ValueError:
+        return None
+
+
+def file_etag(file_doc):
+    # Blob ids are content hashes, so they make strong validators
+    if file_doc.get("blob_id"):
+        return file_doc["blob_id"].rsplit(":", 1)[-1]
+    last_modified = file_last_modified(file_doc)
+    stamp = int(last_modified.timestamp()) if last_modified else 0
+    return f"{file_doc['_id']}-{stamp}"
+
+
+def file_last_modified(file_doc):
+    upload_time = file_doc.get("upload_time")
+    if isinstance(upload_time, datetime) and upload_time.tzinfo is None:
+        return upload_time.replace(tzinfo=timezone.utc)
+    return upload_time
+
+
+def download_encoding(file_doc):
+    """The stored codec to send as ``Content-Encoding``, or None to decode.
+
+    Ranges always address the decoded bytes, so ranged requests are decoded.
+    """
+    codec = file_doc.get("codec")
+    if not codec or request.range is not None:
+        return None
+    if not request.accept_encodings[codec]:
+        return None
+    return codec
+
+
+def download_etag(file_doc, encoding):
+    # Each content coding of a file is a separate representation
+    etag = file_etag(file_doc)
+    return f"{etag}-{encoding}" if encoding else etag
+
+
+def set_download_cache_control(response, file_doc):
+    if file_doc.get("codec"):
+        response.vary.add("Accept-Encoding")
+    cache_control = response.cache_control
+    if file_doc["has_password"] or file_doc.get("download_limit"):
+        # Every fetch has to reach us to be authorized and counted, so shared
+        # caches must not keep a copy and browsers must revalidate
+        cache_control.private = True
+        cache_control.no_cache = True
+        return
+
+    max_age = current_app.config["DOWNLOAD_CACHE_MAX_AGE"]
+    expires_at = expiration_datetime(file_doc)
+    if expires_at:
+        # No cache may keep serving the file after its link expires
+        remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        max_age = min(max_age, int(remaining))
+    if max_age > 0:
+        cache_control.public = True
+        cache_control.max_age = max_age
+    else:
+        cache_control.no_cache = True
+
+
+def page_etag(file_doc, *extra):
+    # Everything the file pages render from; the flashed messages and the
+    # password form are handled by the callers
+    state = (
+        file_doc["_id"],
+        file_etag(file_doc),
+        file_doc.get("status"),
+        file_doc.get("download_count"),
+        file_doc.get("download_limit"),
+        str(file_doc.get("expiration_date")),
+        (file_doc.get("preview") or {}).get("status"),
+        *extra,
+    )
+    return hashlib.sha256(repr(state).encode("utf-8")).hexdigest()[:32]
+
+
+def conditional_page(etag):
+    """Return a 304 if the client's copy of the page is current.
+
+    Otherwise returns None and tags the page the view goes on to render with
+    ``etag``, so the next visit can be answered without rendering it.
+    """
+    # Flashed messages are shown once, so such a page can't be reused
+    if get_flashed_messages():
+        return None
+
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    @after_this_request
+    def add_validator(response):
+        if response.status_code == 200 and not response.cache_control.no_store:
+            response.set_etag(etag, weak=True)
+            # Pages carry per-visitor state, so only the browser may keep them
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        return response
+
+    return None
+
+
+def presigned_download_url(minio, bucket_name, file_doc, expiry_seconds):
+    # S3 applies these overrides to the response it serves for the signed URL
+    response_headers = {
+        "response-content-disposition": content_disposition(
+            file_doc["original_filename"]
+        ),
+        "response-content-type": file_doc.get("content_type")
+        or "application/octet-stream",
+    }
+    return minio.presigned_get_object(
+        bucket_name,
+        file_doc["saved_filename"],
+        expires=timedelta(seconds=expiry_seconds),
+        response_headers=response_headers,
+    )
+
+
+def content_disposition(filename, disposition="attachment"):
+    # Non-ASCII names get an RFC 5987 filename* alongside an ASCII fallback
+    try:
+        filename.encode("ascii")
+        options = {"filename": filename}
+    except UnicodeEncodeError:
+        simple = (
+            unicodedata.normalize("NFKD", filename)
+            .encode("ascii", "ignore")
+            .decode("ascii")
+        )
+        quoted = quote(filename, safe="!#$&+^`|~")
+        options = {"filename": simple, "filename*": f"UTF-8''{quoted}"}
+    return dump_options_header(disposition, options)
+
+
+@main.route("/stats")
+def stats():
+    return jsonify(
+        {
+            "bcrypt": current_app.password_hasher.stats(),
+            "metadata_cache": current_app.metadata_cache.stats(),
+            "expiry_reaper": current_app.expiry_reaper.stats(),
+            "upload_finalizer": current_app.upload_finalizer.stats(),
+            "object_cache": current_app.object_cache.stats(),
+            "transfers": current_app.transfer_scheduler.stats(),
+            "download_log": current_app.download_log.stats(),
+            "storage": current_app.storage.stats(),
+            "storage_rebalancer": current_app.storage_rebalancer.stats(),
+            "previews": current_app.preview_generator.stats(),
+        }
+    )
+
+
+@main.route("/metrics")
+def metrics():
+    return Response(current_app.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@main.route("/ready")
+def ready():
+    # Readiness probe: 503 until this process has bootstrapped its backends
+    status = current_app.storage_bootstrap.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@main.errorhandler(HasherBusy)
+def password_hasher_busy(error):
+    return (
+        jsonify({"error": "Server is busy. Please try again shortly."}),
+        503,
+        {"Retry-After": "1"},
+    )
+
+
+@main.errorhandler(TransfersBusy)
+def transfers_busy(error):
+    return (
+        jsonify({"error": "Too many downloads in progress. Please try again."}),
+        503,
+        {"Retry-After": "5"},
+    )
+
+
 def hash_password(password):
     if not password:
         return None
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode("utf-8"), salt)
+    salt = bcrypt.gensalt(rounds=current_app.config["BCRYPT_ROUNDS"])
+    with current_app.metrics.time_backend("bcrypt", "hashpw"):
+        hashed = current_app.password_hasher.run(
+            bcrypt.hashpw, password.encode("utf-8"), salt
+        )
     return hashed
 
 
@@ -347,4 +1986,7 @@ def verify_password(stored_hash, provided_password):
         return not provided_password
     if isinstance(stored_hash, str):
         stored_hash = stored_hash.encode("utf-8")
-    return bcrypt.checkpw(provided_password.encode("utf-8"), stored_hash)
+    with current_app.metrics.time_backend("bcrypt", "checkpw"):
+        return current_app.password_hasher.run(
+            bcrypt.checkpw, provided_password.encode("utf-8"), stored_hash
+        )
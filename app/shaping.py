@@ -0,0 +1,226 @@
+import threading
+import time
+from collections import deque
+
+
+class TransfersBusy(Exception):
+    """Raised when every transfer slot is taken and the wait queue is full."""
+
+
+class TokenBucket:
+    """Byte budget refilled at ``rate`` bytes per second, up to ``burst``.
+
+    Consumers may overdraw the bucket; the debt tells them how long to pause,
+    so a chunk larger than the burst still goes out whole.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take ``amount`` tokens and return the seconds to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+
+
+class TransferScheduler:
+    """Admits downloads and paces their bodies.
+
+    At most ``max_active`` transfers stream at once; later ones wait in FIFO
+    order, up to ``max_queue`` of them for ``queue_timeout`` seconds, and
+    beyond that ``TransfersBusy`` is raised. Each body is paced by its own
+    limit, a shared per-client limit and its weighted share of the global
+    ``egress_rate``. A limit of 0 means unlimited.
+    """
+
+    def __init__(
+        self,
+        max_active,
+        max_queue,
+        queue_timeout,
+        egress_rate,
+        client_rate,
+        default_rate=0,
+    ):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.egress_rate = egress_rate
+        self.client_rate = client_rate
+        self.default_rate = default_rate
+        self.sleep = time.sleep
+        self._egress = TokenBucket(egress_rate) if egress_rate else None
+        self._clients = {}
+        self._active = 0
+        self._weights = 0
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.throttled_seconds = 0.0
+
+    @property
+    def enabled(self):
+        return bool(
+            self.max_active or self.egress_rate or self.client_rate or self.default_rate
+        )
+
+    def admit(self, client, rate=0, weight=1):
+        """Wait for a transfer slot and return the ``Transfer`` that holds it.
+
+        The caller must ``close()`` the transfer once the body is done.
+        """
+        self._acquire_slot()
+        return Transfer(self, client, rate or self.default_rate, max(weight, 1))
+
+    def _acquire_slot(self):
+        with self._lock:
+            if not self.max_active or (
+                self._active < self.max_active and not self._queue
+            ):
+                self._active += 1
+                self.admitted += 1
+                return
+            if len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                raise TransfersBusy()
+            ready = threading.Event()
+            self._queue.append(ready)
+            self.queued += 1
+
+        if ready.wait(self.queue_timeout):
+            return
+        with self._lock:
+            # The slot may have been handed over just as the wait timed out
+            if ready.is_set():
+                return
+            self._queue.remove(ready)
+            self.rejected += 1
+        raise TransfersBusy()
+
+    def _release_slot(self):
+        with self._lock:
+            if self._queue:
+                # The slot passes straight to the oldest waiter
+                self._queue.popleft().set()
+                self.admitted += 1
+            else:
+                self._active -= 1
+
+    def _join(self, client, weight):
+        with self._lock:
+            self._weights += weight
+            if not self.client_rate:
+                return None
+            entry = self._clients.get(client)
+            if entry is None:
+                entry = self._clients[client] = [TokenBucket(self.client_rate), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _leave(self, client, weight):
+        with self._lock:
+            self._weights -= weight
+            entry = self._clients.get(client)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._clients[client]
+
+    def fair_share(self, weight):
+        with self._lock:
+            return self.egress_rate * weight / max(self._weights, weight)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "active": self._active,
+                "waiting": len(self._queue),
+                "clients": len(self._clients),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "throttled_seconds": round(self.throttled_seconds, 3),
+            }
+
+
+class Transfer:
+    """One admitted download: paces its chunks and frees its slot on close."""
+
+    def __init__(self, scheduler, client, rate, weight):
+        self.scheduler = scheduler
+        self.client = client
+        self.rate = rate
+        self.weight = weight
+        self._client_bucket = scheduler._join(client, weight)
+        self._bucket = None
+        if rate or scheduler.egress_rate:
+            self._bucket = TokenBucket(self._rate())
+        self._closed = False
+
+    def _rate(self):
+        rates = []
+        if self.rate:
+            rates.append(self.rate)
+        if self.scheduler.egress_rate:
+            rates.append(self.scheduler.fair_share(self.weight))
+        return min(rates)
+
+    def throttle(self, amount):
+        delay = 0.0
+        if self._bucket is not None:
+            # Shares shrink and grow as other transfers start and finish
+            self._bucket.set_rate(self._rate())
+            delay = self._bucket.consume(amount)
+        if self._client_bucket is not None:
+            delay = max(delay, self._client_bucket.consume(amount))
+        if self.scheduler._egress is not None:
+            delay = max(delay, self.scheduler._egress.consume(amount))
+        if delay > 0:
+            with self.scheduler._lock:
+                self.scheduler.throttled_seconds += delay
+            self.scheduler.sleep(delay)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.scheduler._leave(self.client, self.weight)
+        self.scheduler._release_slot()
+
+
+class ShapedBody:
+    """Response body paced by ``transfer``; closing it ends the transfer."""
+
+    def __init__(self, body, transfer):
+        self.body = body
+        self.transfer = transfer
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.transfer.throttle(len(chunk))
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.body, "close", None)
+            if close:
+                close()
+        finally:
+            self.transfer.close()
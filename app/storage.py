@@ -0,0 +1,118 @@
+import hashlib
+
+from minio.commonconfig import ComposeSource
+from minio.deleteobjects import DeleteObject
+
+from app.compression import CompressingReader, DecodedStream
+
+# MinIO rejects multipart parts smaller than this (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class CountingReader:
+    """File-like wrapper that counts and hashes the bytes handed to the uploader."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        self.sha256.update(data)
+        return data
+
+
+class ObjectStream:
+    """Iterable body over a MinIO object that releases its connection on close."""
+
+    def __init__(self, response, chunk_size, on_error=None):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.on_error = on_error
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.response.stream(self.chunk_size)
+        except Exception as e:
+            print(f"Error streaming object: {str(e)}")
+            if self.on_error:
+                self.on_error()
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        # WSGI servers call close() even when the client disconnects early
+        if self.closed:
+            return
+        self.closed = True
+        self.response.close()
+        self.response.release_conn()
+
+
+def stream_object(
+    minio, bucket_name, object_name, chunk_size, on_error=None, offset=0, length=0
+):
+    # Open the object up front so a missing key fails before any response is sent
+    response = minio.get_object(bucket_name, object_name, offset=offset, length=length)
+    return ObjectStream(response, chunk_size, on_error)
+
+
+def download_to_file(minio, bucket_name, object_name, chunk_size, path, codec=None):
+    body = stream_object(minio, bucket_name, object_name, chunk_size)
+    if codec:
+        body = DecodedStream(body, codec, chunk_size)
+    with open(path, "wb") as target:
+        for chunk in body:
+            target.write(chunk)
+
+
+def put_stream(
+    minio,
+    bucket_name,
+    object_name,
+    stream,
+    content_type,
+    part_size,
+    max_buffer,
+    codec=None,
+):
+    """Upload ``stream`` as ``object_name``, compressed with ``codec`` if set.
+
+    Returns the size and SHA-256 of the uncompressed content.
+    """
+    part_size = max(MIN_PART_SIZE, min(part_size, max_buffer))
+    # put_object holds the part being read plus one per upload thread in memory
+    num_parallel_uploads = max(1, max_buffer // part_size - 1)
+
+    reader = CompressingReader(stream, codec) if codec else CountingReader(stream)
+    minio.put_object(
+        bucket_name,
+        object_name,
+        reader,
+        length=-1,
+        content_type=content_type or "application/octet-stream",
+        part_size=part_size,
+        num_parallel_uploads=num_parallel_uploads,
+    )
+    return reader.bytes_read, reader.sha256.hexdigest()
+
+
+def chunk_object_name(upload_id, index):
+    return f"uploads/{upload_id}/{index:05d}"
+
+
+def compose_parts(minio, bucket_name, object_name, part_names):
+    # Server-side concatenation; MinIO runs it as a multipart copy
+    sources = [ComposeSource(bucket_name, name) for name in part_names]
+    minio.compose_object(bucket_name, object_name, sources)
+
+
+def remove_objects(minio, bucket_name, object_names):
+    delete_list = [DeleteObject(name) for name in object_names]
+    # remove_objects is lazy; the deletes only happen while errors are iterated
+    for error in minio.remove_objects(bucket_name, delete_list):
+        print(f"Error deleting object {error.name}: {error.message}")
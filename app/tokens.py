@@ -0,0 +1,57 @@
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# Salts keep each kind of token from being accepted in place of another
+DOWNLOAD_TOKEN_SALT = "dropit-download"
+DOWNLOAD_GRANT_SALT = "dropit-download-grant"
+BUNDLE_TOKEN_SALT = "dropit-bundle"
+
+
+def _issue(secret_key, salt, file_id, **claims):
+    serializer = URLSafeTimedSerializer(secret_key, salt=salt)
+    return serializer.dumps({"file_id": file_id, **claims})
+
+
+def _load(secret_key, salt, file_id, token, max_age):
+    # HMAC check with a constant-time compare; no bcrypt on the download path
+    if not token:
+        return None
+    serializer = URLSafeTimedSerializer(secret_key, salt=salt)
+    try:
+        payload = serializer.loads(token, max_age=max_age)
+    except BadSignature:
+        return None
+    return payload if payload.get("file_id") == file_id else None
+
+
+def _verify(secret_key, salt, file_id, token, max_age):
+    return _load(secret_key, salt, file_id, token, max_age) is not None
+
+
+def issue_download_token(secret_key, file_id):
+    return _issue(secret_key, DOWNLOAD_TOKEN_SALT, file_id)
+
+
+def verify_download_token(secret_key, file_id, token, max_age):
+    return _verify(secret_key, DOWNLOAD_TOKEN_SALT, file_id, token, max_age)
+
+
+def issue_download_grant(secret_key, file_id, grant_id):
+    # Handed out with a counted download so follow-up Range requests that
+    # resume or seek ahead within it are not counted again
+    return _issue(secret_key, DOWNLOAD_GRANT_SALT, file_id, grant=grant_id)
+
+
+def verify_download_grant(secret_key, file_id, token, max_age):
+    """The id of the grant ``token`` carries, or None."""
+    payload = _load(secret_key, DOWNLOAD_GRANT_SALT, file_id, token, max_age)
+    return payload.get("grant") if payload else None
+
+
+def issue_bundle_token(secret_key, bundle_id):
+    # One token covers every file of an unlocked bundle, so the ZIP link stays
+    # short however many protected files the bundle holds
+    return _issue(secret_key, BUNDLE_TOKEN_SALT, bundle_id)
+
+
+def verify_bundle_token(secret_key, bundle_id, token, max_age):
+    return _verify(secret_key, BUNDLE_TOKEN_SALT, bundle_id, token, max_age)
@@ -0,0 +1,441 @@
+"""Throughput, latency and memory benchmarks for the upload and download paths.
+
+The app runs in-process against mongomock and a local S3 stand-in, so the
+numbers cover DropIt's own request handling rather than the network:
+
+    python -m benchmarks.run                      # default sizes, check baseline
+    python -m benchmarks.run --sizes 1KB,2GB --concurrency 1,8
+    python -m benchmarks.run --update-baseline    # record this machine's numbers
+
+Exits with status 1 if a result regresses past ``--tolerance``.
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+import mongomock
+
+from app import create_app
+from app.tokens import issue_download_token
+from benchmarks.s3stub import LocalObjectStore
+
+SIZE_UNITS = {"KB": 1024, "MB": 1024**2, "GB": 1024**3}
+MB = 1024 * 1024
+
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+# Upper bound on the bytes moved per scenario; caps iterations for big files
+DATA_BUDGET = 256 * MB
+
+BENCH_PASSWORD = "benchmark-password"
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[: -len(unit)]) * factor)
+    return int(text)
+
+
+def format_size(size):
+    for unit in ("GB", "MB", "KB"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return f"{size}B"
+
+
+class PatternStream(io.RawIOBase):
+    """``size`` bytes of one repeated pseudo-random block, generated on read.
+
+    The block is larger than a deflate window, so the content doesn't
+    compress, and nothing close to ``size`` is ever held in memory. Optional
+    ``prefix`` and ``suffix`` bytes wrap the pattern, e.g. multipart framing.
+    The stream is seekable because the test client measures its length.
+    """
+
+    BLOCK = random.Random(0).randbytes(64 * 1024)
+
+    def __init__(self, size, prefix=b"", suffix=b""):
+        self.size = size
+        self.prefix = prefix
+        self.suffix = suffix
+        self.length = len(prefix) + size + len(suffix)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.length}
+        self.position = max(0, base[whence] + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        wanted = max(0, min(len(buffer), self.length - self.position))
+        view = memoryview(buffer)
+        filled = 0
+        while filled < wanted:
+            chunk = self._segment(wanted - filled)
+            view[filled : filled + len(chunk)] = chunk
+            filled += len(chunk)
+            self.position += len(chunk)
+        return wanted
+
+    def _segment(self, limit):
+        position = self.position
+        if position < len(self.prefix):
+            return self.prefix[position : position + limit]
+        position -= len(self.prefix)
+        if position < self.size:
+            offset = position % len(self.BLOCK)
+            limit = min(limit, self.size - position)
+            return self.BLOCK[offset : offset + limit]
+        position -= self.size
+        return self.suffix[position : position + limit]
+
+
+def expect(response, *statuses):
+    if response.status_code not in statuses:
+        raise RuntimeError(
+            f"{response.request.method} {response.request.path} returned "
+            f"{response.status_code}"
+        )
+    return response
+
+
+def upload_stream(client, size, password=""):
+    response = client.put(
+        "/upload",
+        input_stream=PatternStream(size),
+        content_type="application/octet-stream",
+        headers={"X-File-Name": "bench.bin", "X-File-Password": password},
+    )
+    return expect(response, 200).get_json()["file_id"]
+
+
+def upload_form(client, size):
+    # The multipart body is framed by hand; the test client would otherwise
+    # copy the whole file into a buffer before sending the request
+    boundary = "dropit-benchmark-boundary"
+    prefix = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    suffix = f"\r\n--{boundary}--\r\n".encode()
+    response = client.post(
+        "/",
+        input_stream=PatternStream(size, prefix, suffix),
+        content_type=f"multipart/form-data; boundary={boundary}",
+        headers={"X-Requested-With": "XMLHttpRequest"},
+    )
+    expect(response, 200)
+    return size
+
+
+def read_body(response):
+    try:
+        return sum(len(chunk) for chunk in response.response)
+    finally:
+        response.close()
+
+
+class Scenario:
+    def __init__(self, name, run, sized=True, setup=None):
+        self.name = name
+        self.run = run
+        self.sized = sized
+        self.setup = setup
+
+
+def setup_file(password=""):
+    def setup(app, size):
+        file_id = upload_stream(app.test_client(), size, password)
+        token = issue_download_token(app.secret_key, file_id) if password else None
+        return file_id, token
+
+    return setup
+
+
+def run_download(client, size, context):
+    file_id, token = context
+    url = f"/files/{file_id}/download"
+    if token:
+        url += f"?token={token}"
+    return read_body(expect(client.get(url, buffered=False), 200))
+
+
+def run_access(client, size, context):
+    file_id, _ = context
+    expect(client.get(f"/files/{file_id}"), 200)
+    return 0
+
+
+def run_access_password(client, size, context):
+    file_id, _ = context
+    response = client.post(f"/files/{file_id}", data={"password": BENCH_PASSWORD})
+    if b"token=" not in expect(response, 200).data:
+        raise RuntimeError("password was not accepted")
+    return 0
+
+
+SCENARIOS = [
+    Scenario(
+        "upload_stream",
+        lambda client, size, context: upload_stream(client, size) and size,
+    ),
+    Scenario("upload_form", lambda client, size, context: upload_form(client, size)),
+    Scenario("download", run_download, setup=setup_file()),
+    Scenario(
+        "download_password", run_download, setup=setup_file(password=BENCH_PASSWORD)
+    ),
+    Scenario("access", run_access, sized=False, setup=setup_file()),
+    Scenario(
+        "access_password",
+        run_access_password,
+        sized=False,
+        setup=setup_file(password=BENCH_PASSWORD),
+    ),
+]
+
+
+def create_bench_app(bcrypt_rounds):
+    app = create_app()
+    app.config.update({"TESTING": True})
+    if bcrypt_rounds:
+        app.config["BCRYPT_ROUNDS"] = bcrypt_rounds
+    app.mongo_db = mongomock.MongoClient().db
+    app.minio_client = LocalObjectStore()
+    app.storage_bootstrap.ensure()
+    return app
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def timed_round(app, scenario, size, concurrency, iterations, context):
+    latencies = []
+    moved = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(count):
+        client = app.test_client()
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                nbytes = scenario.run(client, size, context)
+            except Exception as e:
+                errors.append(e)
+                return
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                moved.append(nbytes)
+
+    shares = [iterations // concurrency] * concurrency
+    for index in range(iterations % concurrency):
+        shares[index] += 1
+    threads = [threading.Thread(target=worker, args=(share,)) for share in shares]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    if errors:
+        raise errors[0]
+    return sum(moved) / wall, len(latencies) / wall, latencies
+
+
+def measure(app, scenario, size, concurrency, iterations, rounds):
+    context = scenario.setup(app, size) if scenario.setup else None
+    if scenario.sized:
+        iterations = min(iterations, max(1, DATA_BUDGET // max(size, 1)))
+    iterations = max(iterations, concurrency)
+
+    # Warm-up request, then the median of several rounds, so one round
+    # disturbed by scheduler noise doesn't decide the result
+    scenario.run(app.test_client(), size, context)
+    results = [
+        timed_round(app, scenario, size, concurrency, iterations, context)
+        for _ in range(rounds)
+    ]
+    results.sort(key=lambda result: result[0] + result[1])
+    median = results[len(results) // 2]
+    throughput, request_rate, latencies = median
+
+    # One extra request with allocation tracing; kept out of the timed runs
+    # because tracemalloc slows everything down
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    scenario.run(app.test_client(), size, context)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "requests": len(latencies),
+        "mb_per_s": round(throughput / MB, 2) if scenario.sized else None,
+        "requests_per_s": round(request_rate, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "tracemalloc_peak_mb": round(traced_peak / MB, 3),
+        # Process-wide high-water mark, so it only ever grows during a run
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def result_key(scenario, size, concurrency):
+    if scenario.sized:
+        return f"{scenario.name}[{format_size(size)},c{concurrency}]"
+    return f"{scenario.name}[c{concurrency}]"
+
+
+def run_benchmarks(
+    scenarios, sizes, concurrency_levels, iterations, rounds, bcrypt_rounds
+):
+    app = create_bench_app(bcrypt_rounds)
+    results = {}
+    try:
+        for scenario in scenarios:
+            for size in sizes if scenario.sized else [0]:
+                for concurrency in concurrency_levels:
+                    key = result_key(scenario, size, concurrency)
+                    results[key] = measure(
+                        app, scenario, size, concurrency, iterations, rounds
+                    )
+                    print(format_result(key, results[key]), flush=True)
+    finally:
+        app.minio_client.close()
+    return results
+
+
+def format_result(key, result):
+    throughput = (
+        f"{result['mb_per_s']:>9.2f} MB/s"
+        if result["mb_per_s"] is not None
+        else f"{result['requests_per_s']:>9.2f} req/s"
+    )
+    return (
+        f"{key:<36} {throughput}  p50 {result['p50_ms']:>9.3f} ms"
+        f"  p99 {result['p99_ms']:>9.3f} ms"
+        f"  traced {result['tracemalloc_peak_mb']:>8.3f} MB"
+        f"  rss {result['peak_rss_mb']:>7.1f} MB"
+    )
+
+
+def compare(results, baseline, tolerance, memory_only=False):
+    """Return descriptions of results that regressed against ``baseline``."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if (
+            result["tracemalloc_peak_mb"]
+            > base["tracemalloc_peak_mb"] * (1 + tolerance) + 1
+        ):
+            regressions.append(
+                f"{key}: traced peak {result['tracemalloc_peak_mb']} MB, "
+                f"baseline {base['tracemalloc_peak_mb']}"
+            )
+        if memory_only:
+            continue
+        if base.get("mb_per_s") and result["mb_per_s"] is not None:
+            if result["mb_per_s"] < base["mb_per_s"] * (1 - tolerance):
+                regressions.append(
+                    f"{key}: {result['mb_per_s']} MB/s, baseline {base['mb_per_s']}"
+                )
+        # Small absolute slack so sub-millisecond timings don't flap
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance) + 5:
+            regressions.append(
+                f"{key}: p99 {result['p99_ms']} ms, baseline {base['p99_ms']}"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1KB,1MB,64MB")
+    parser.add_argument("--concurrency", default="1,4")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(scenario.name for scenario in SCENARIOS),
+        help="comma-separated subset of: %(default)s",
+    )
+    parser.add_argument(
+        "--bcrypt-rounds", type=int, default=0, help="defaults to BCRYPT_ROUNDS"
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--memory-only",
+        action="store_true",
+        help="only gate on allocations, for machines unlike the baseline's",
+    )
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    names = set(args.scenarios.split(","))
+    results = run_benchmarks(
+        [scenario for scenario in SCENARIOS if scenario.name in names],
+        [parse_size(size) for size in args.sizes.split(",")],
+        [int(level) for level in args.concurrency.split(",")],
+        args.iterations,
+        args.rounds,
+        args.bcrypt_rounds,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against")
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance, args.memory_only)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class StubObject:
+    def __init__(self, bucket_name, object_name, size, etag):
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.size = size
+        self.etag = etag
+
+
+class StubResponse:
+    """Stands in for the urllib3 response ``Minio.get_object`` returns."""
+
+    def __init__(self, path, offset, length):
+        self._file = open(path, "rb")
+        self._file.seek(offset)
+        self._remaining = length
+
+    def read(self, amt=None):
+        data = self._file.read(
+            self._remaining if amt is None else min(amt, self._remaining)
+        )
+        self._remaining -= len(data)
+        return data
+
+    def stream(self, amt):
+        while self._remaining:
+            data = self._file.read(min(amt, self._remaining))
+            if not data:
+                break
+            self._remaining -= len(data)
+            yield data
+
+    def close(self):
+        self._file.close()
+
+    def release_conn(self):
+        pass
+
+
+class LocalObjectStore:
+    """In-process stand-in for the parts of ``Minio`` the app uses.
+
+    Objects are kept as files in a temporary directory, so multi-gigabyte
+    transfers don't have to fit in memory, and reads and writes go through
+    the same chunked calls as against a real server.
+    """
+
+    def __init__(self, directory=None):
+        self._tempdir = None
+        if directory is None:
+            self._tempdir = tempfile.TemporaryDirectory(prefix="dropit-s3stub-")
+            directory = self._tempdir.name
+        self.directory = directory
+        self._objects = {}
+        self._buckets = set()
+        self._lock = threading.Lock()
+
+    def _path(self, bucket_name, object_name):
+        key = hashlib.sha1(f"{bucket_name}/{object_name}".encode()).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def _stat(self, bucket_name, object_name):
+        with self._lock:
+            size = self._objects.get((bucket_name, object_name))
+        if size is None:
+            raise KeyError(f"{bucket_name}/{object_name}")
+        return size
+
+    def bucket_exists(self, bucket_name):
+        return bucket_name in self._buckets
+
+    def make_bucket(self, bucket_name):
+        self._buckets.add(bucket_name)
+
+    def put_object(self, bucket_name, object_name, data, length, part_size=0, **kwargs):
+        path = self._path(bucket_name, object_name)
+        read_size = part_size or 5 * 1024 * 1024
+        size = 0
+        with open(path, "wb") as target:
+            while length < 0 or size < length:
+                chunk = data.read(read_size if length < 0 else length - size)
+                if not chunk:
+                    break
+                target.write(chunk)
+                size += len(chunk)
+        with self._lock:
+            self._objects[(bucket_name, object_name)] = size
+        return StubObject(bucket_name, object_name, size, f"etag-{object_name}")
+
+    def get_object(self, bucket_name, object_name, offset=0, length=0, **kwargs):
+        size = self._stat(bucket_name, object_name)
+        length = length or size - offset
+        return StubResponse(self._path(bucket_name, object_name), offset, length)
+
+    def stat_object(self, bucket_name, object_name, **kwargs):
+        size = self._stat(bucket_name, object_name)
+        return StubObject(bucket_name, object_name, size, f"etag-{object_name}")
+
+    def compose_object(self, bucket_name, object_name, sources, **kwargs):
+        path = self._path(bucket_name, object_name)
+        size = 0
+        with open(path, "wb") as target:
+            for source in sources:
+                with open(
+                    self._path(source.bucket_name, source.object_name), "rb"
+                ) as f:
+                    while chunk := f.read(1024 * 1024):
+                        target.write(chunk)
+                        size += len(chunk)
+        with self._lock:
+            self._objects[(bucket_name, object_name)] = size
+        return StubObject(bucket_name, object_name, size, f"etag-{object_name}")
+
+    def remove_objects(self, bucket_name, delete_object_list, **kwargs):
+        # Lazy like the real client: deletes happen while errors are iterated
+        for delete_object in delete_object_list:
+            object_name = getattr(delete_object, "_name", None) or delete_object.name
+            with self._lock:
+                self._objects.pop((bucket_name, object_name), None)
+            try:
+                os.remove(self._path(bucket_name, object_name))
+            except FileNotFoundError:
+                pass
+        return
+        yield
+
+    def close(self):
+        if self._tempdir is not None:
+            self._tempdir.cleanup()
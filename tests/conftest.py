@@ -1,5 +1,11 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import mongomock
 import pytest
 from app import create_app
+from app.cache import MetadataCache
+from app.sharding import AppShard, StorageRouter
 
 @pytest.fixture(scope="module")
 def app():
@@ -12,3 +18,26 @@ def app():
 @pytest.fixture
 def app_client(app):
     return app.test_client()
+
+@pytest.fixture
+def make_app():
+    """Build the parts of the app that background workers use.
+
+    The MinIO client is a mock unless one is passed in; other attributes,
+    such as ``config``, are set from keyword arguments.
+    """
+    def make(minio=None, **attributes):
+        if minio is None:
+            minio = MagicMock()
+            minio.remove_objects.return_value = iter([])
+        app = SimpleNamespace(
+            config={},
+            mongo_db=mongomock.MongoClient().db,
+            minio_client=minio,
+            bucket_name="dropit-storage",
+            metadata_cache=MetadataCache(max_entries=10, ttl=60),
+        )
+        vars(app).update(attributes)
+        app.storage = StorageRouter([AppShard(app, "localhost:9000")])
+        return app
+    return make
@@ -0,0 +1,125 @@
+from unittest.mock import MagicMock
+
+import mongomock
+import pytest
+
+from app.analytics import DownloadLog, RecordedBody, download_event
+
+
+@pytest.fixture
+def log_app():
+    app = MagicMock()
+    app.mongo_db = mongomock.MongoClient().db
+    app.mongo_db["files"].insert_one({"_id": "hot", "download_count": 0})
+    return app
+
+
+def event(file_id="hot", status="completed", nbytes=10, resumed=False):
+    recorded = download_event(file_id, "10.0.0.1", "curl/8", resumed, status)
+    recorded["bytes"] = nbytes
+    return recorded
+
+
+def test_flush_writes_events_and_one_counter_update_per_file(log_app, monkeypatch):
+    log = DownloadLog(log_app, capacity=100, flush_size=100, flush_interval=5)
+    for _ in range(3):
+        log.record(event(), count=True)
+    log.record(event(status="failed"), count=True)
+    log.record(event(resumed=True, nbytes=5))
+
+    stats_collection = log_app.mongo_db["download_stats"]
+    update_one = MagicMock(wraps=stats_collection.update_one)
+    monkeypatch.setattr(stats_collection, "update_one", update_one)
+
+    assert log.flush() == 5
+
+    assert update_one.call_count == 1
+    stats = stats_collection.find_one({"_id": "hot"})
+    assert stats["downloads"] == 4
+    assert stats["completed"] == 4
+    assert stats["failed"] == 1
+    assert stats["bytes_served"] == 45
+    # Failed downloads aren't counted against the file
+    assert log_app.mongo_db["files"].find_one({"_id": "hot"})["download_count"] == 3
+    assert log_app.mongo_db["download_events"].count_documents({}) == 5
+    log_app.metadata_cache.invalidate.assert_called_with("hot")
+
+
+def test_full_buffer_drops_oldest_events_but_keeps_counters(log_app):
+    log = DownloadLog(log_app, capacity=2, flush_size=10, flush_interval=5)
+    log._thread = object()  # keep record() from flushing inline
+
+    for nbytes in (1, 2, 3):
+        log.record(event(nbytes=nbytes))
+
+    assert log.stats()["dropped"] == 1
+    log._thread = None
+    log.flush()
+    events = log_app.mongo_db["download_events"].find()
+    assert sorted(e["bytes"] for e in events) == [2, 3]
+    stats = log_app.mongo_db["download_stats"].find_one({"_id": "hot"})
+    assert stats["bytes_served"] == 6
+
+
+def test_failed_flush_keeps_events_for_the_next_one(log_app):
+    log = DownloadLog(log_app, capacity=10, flush_size=10, flush_interval=5)
+    log.record(event(), count=True)
+    real_db = log_app.mongo_db
+    log_app.mongo_db = MagicMock()
+    log_app.mongo_db.__getitem__.return_value.insert_many.side_effect = Exception(
+        "down"
+    )
+    log_app.mongo_db.__getitem__.return_value.update_one.side_effect = Exception("down")
+
+    assert log.flush() == 0
+    assert log.stats()["buffered"] == 1
+    assert log.stats()["pending_files"] == 1
+
+    log_app.mongo_db = real_db
+    assert log.flush() == 1
+    assert real_db["files"].find_one({"_id": "hot"})["download_count"] == 1
+
+
+def test_partly_written_events_are_not_written_twice(log_app, monkeypatch):
+    log = DownloadLog(log_app, capacity=10, flush_size=10, flush_interval=5)
+    log.record(event("first"))
+    log.record(event("second"))
+    events_collection = log_app.mongo_db["download_events"]
+    insert_many = events_collection.insert_many
+
+    def interrupted(events, **kwargs):
+        # The first event reaches the server, then the connection drops
+        insert_many(events[:1], **kwargs)
+        raise Exception("connection reset")
+
+    monkeypatch.setattr(events_collection, "insert_many", interrupted)
+    assert log.flush() == 0
+    assert log.stats()["buffered"] == 2
+
+    monkeypatch.setattr(events_collection, "insert_many", insert_many)
+    # The retry meets the first event's copy and writes only the second
+    assert log.flush() == 1
+    assert log.stats()["buffered"] == 0
+    assert sorted(doc["file_id"] for doc in events_collection.find()) == [
+        "first",
+        "second",
+    ]
+
+
+def test_recorded_body_reports_completed_and_aborted_downloads(log_app):
+    log = DownloadLog(log_app, capacity=10, flush_size=10, flush_interval=5)
+
+    complete = RecordedBody([b"ab", b"cd"], log, event(status=None, nbytes=0))
+    assert b"".join(complete) == b"abcd"
+    complete.close()
+
+    partial = RecordedBody(iter([b"ab", b"cd"]), log, event(status=None, nbytes=0))
+    next(iter(partial))
+    partial.close()
+    partial.close()
+
+    events = list(log._events)
+    assert [(e["status"], e["bytes"]) for e in events] == [
+        ("completed", 4),
+        ("aborted", 2),
+    ]
@@ -0,0 +1,77 @@
+import io
+import zipfile
+from datetime import datetime
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.archive import ArchiveEntry, ZipStream, unique_names
+from app.compression import compress
+
+
+def fake_minio(objects, chunk=4):
+    def get_object(bucket_name, object_name, offset=0, length=0):
+        data = objects[object_name]
+        response = MagicMock()
+        response.stream.return_value = iter(
+            [data[i : i + chunk] for i in range(0, len(data), chunk)]
+        )
+        return response
+
+    minio = MagicMock()
+    minio.get_object.side_effect = get_object
+    return minio
+
+
+def test_zip_stream_builds_a_valid_archive():
+    objects = {"a": b"hello " * 100, "b": b"\x89PNG already compressed"}
+    entries = [
+        ArchiveEntry("a.txt", "a", len(objects["a"]), compress=True),
+        ArchiveEntry(
+            "b.png",
+            "b",
+            len(objects["b"]),
+            compress=False,
+            modified=datetime(2024, 5, 1),
+        ),
+    ]
+    chunks = list(ZipStream(fake_minio(objects), "bucket", entries, chunk_size=4))
+
+    # Output is produced incrementally rather than as one buffer
+    assert len(chunks) > 2
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert archive.read("a.txt") == objects["a"]
+    assert archive.read("b.png") == objects["b"]
+    assert archive.getinfo("a.txt").compress_type == zipfile.ZIP_DEFLATED
+    assert archive.getinfo("b.png").compress_type == zipfile.ZIP_STORED
+    assert archive.getinfo("b.png").date_time == (2024, 5, 1, 0, 0, 0)
+
+
+def test_zip_stream_decodes_compressed_objects():
+    text = b"csv,row\n" * 500
+    objects = {"c": compress("gzip", text)}
+    entries = [ArchiveEntry("c.csv", "c", len(text), compress=True, codec="gzip")]
+    chunks = ZipStream(fake_minio(objects, chunk=64), "bucket", entries, 256)
+
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert archive.read("c.csv") == text
+
+
+def test_zip_stream_reports_missing_objects():
+    on_error = MagicMock()
+    entries = [ArchiveEntry("gone.txt", "gone", 3, compress=True)]
+    stream = ZipStream(fake_minio({}), "bucket", entries, 4, on_error=on_error)
+
+    with pytest.raises(KeyError):
+        list(stream)
+    on_error.assert_called_once()
+
+
+def test_unique_names():
+    assert unique_names(["a.txt", "a.txt", "b", "b", "a.txt"]) == [
+        "a.txt",
+        "a (1).txt",
+        "b",
+        "b (1)",
+        "a (2).txt",
+    ]
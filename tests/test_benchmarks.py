@@ -0,0 +1,38 @@
+from benchmarks import run
+
+
+def test_benchmarks_run_and_gate_against_baseline(tmp_path):
+    baseline = tmp_path / "baseline.json"
+    args = [
+        "--sizes",
+        "1KB",
+        "--concurrency",
+        "1",
+        "--iterations",
+        "2",
+        "--rounds",
+        "1",
+        "--bcrypt-rounds",
+        "4",
+        "--baseline",
+        str(baseline),
+    ]
+
+    assert run.main(args + ["--update-baseline"]) == 0
+    assert "download_password[1KB,c1]" in baseline.read_text()
+    assert run.main(args + ["--memory-only"]) == 0
+
+
+def test_compare_flags_slower_and_hungrier_results():
+    base = {"mb_per_s": 100.0, "p99_ms": 10.0, "tracemalloc_peak_mb": 1.0}
+    result = {"mb_per_s": 50.0, "p99_ms": 40.0, "tracemalloc_peak_mb": 5.0}
+
+    regressions = run.compare(
+        {"download[1MB,c1]": result}, {"download[1MB,c1]": base}, 0.3
+    )
+
+    assert len(regressions) == 3
+    assert (
+        run.compare({"download[1MB,c1]": base}, {"download[1MB,c1]": base}, 0.3) == []
+    )
+    assert len(run.compare({"x": result}, {"x": base}, 0.3, memory_only=True)) == 1
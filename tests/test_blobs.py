@@ -0,0 +1,100 @@
+from unittest.mock import MagicMock
+
+import mongomock
+
+from app import blobs as blobs_module
+from app.blobs import release_blobs, store_blob
+
+
+def test_store_blob_creates_then_deduplicates():
+    blobs = mongomock.MongoClient().db["blobs"]
+    minio = MagicMock()
+    minio.remove_objects.return_value = iter([])
+
+    name, duplicate, shard = store_blob(
+        blobs, minio, "bucket", ["objects/a"], "sha256:abc", 10, "a", "east"
+    )
+    assert (name, duplicate, shard) == ("objects/a", False, "east")
+
+    # A duplicate is read from the shard the first copy went to
+    name, duplicate, shard = store_blob(
+        blobs, minio, "bucket", ["objects/b"], "sha256:abc", 10, "b", "west"
+    )
+    assert (name, duplicate, shard) == ("objects/a", True, "east")
+    # A single uploaded object is kept as the blob rather than copied
+    minio.compose_object.assert_not_called()
+    blob = blobs.find_one({"_id": "sha256:abc"})
+    assert blob["refcount"] == 2
+    assert blob["placement_key"] == "a"
+
+
+def test_store_blob_composes_several_sources(monkeypatch):
+    blobs = mongomock.MongoClient().db["blobs"]
+    minio = MagicMock()
+    removed = []
+    monkeypatch.setattr(
+        blobs_module,
+        "remove_objects",
+        lambda minio, bucket_name, names: removed.extend(names),
+    )
+
+    name, duplicate, _ = store_blob(
+        blobs,
+        minio,
+        "bucket",
+        ["uploads/u/00000", "uploads/u/00001"],
+        "sha256:abc",
+        10,
+        "a",
+    )
+
+    assert (name, duplicate) == ("blobs/abc/a", False)
+    minio.compose_object.assert_called_once()
+    assert removed == ["uploads/u/00000", "uploads/u/00001"]
+
+
+def test_release_blobs_deletes_only_unreferenced_blobs():
+    blobs = mongomock.MongoClient().db["blobs"]
+    blobs.insert_many(
+        [
+            {"_id": "shared", "object_name": "blobs/shared/x", "refcount": 3},
+            {"_id": "single", "object_name": "blobs/single/y", "refcount": 1},
+            {
+                "_id": "moved",
+                "object_name": "objects/z",
+                "refcount": 1,
+                "shard": "east",
+                "moved_from": {"shard": "default"},
+            },
+        ]
+    )
+
+    unused = release_blobs(blobs, ["shared", "single", "shared", "missing", "moved"])
+
+    # A moved blob's old copy goes too if the rebalancer hasn't purged it yet
+    assert unused == [
+        ("default", "blobs/single/y"),
+        ("east", "objects/z"),
+        ("default", "objects/z"),
+    ]
+    assert blobs.find_one({"_id": "shared"})["refcount"] == 1
+    assert blobs.find_one({"_id": "single"}) is None
+
+
+def test_store_blob_keeps_a_source_that_already_is_the_blob(monkeypatch):
+    blobs = mongomock.MongoClient().db["blobs"]
+    removed = []
+    monkeypatch.setattr(
+        blobs_module,
+        "remove_objects",
+        lambda minio, bucket_name, names: removed.extend(names),
+    )
+    store_blob(blobs, MagicMock(), "bucket", ["uploads/u/00000"], "sha256:abc", 10, "a")
+
+    # e.g. a second complete of the same single-chunk upload
+    name, duplicate, _ = store_blob(
+        blobs, MagicMock(), "bucket", ["uploads/u/00000"], "sha256:abc", 10, "a"
+    )
+
+    assert (name, duplicate) == ("uploads/u/00000", True)
+    assert removed == []
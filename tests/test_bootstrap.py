@@ -0,0 +1,71 @@
+from unittest.mock import MagicMock
+
+import pytest
+from minio.error import S3Error
+
+from app import backends as backends_module
+from app.backends import Backends
+from app.bootstrap import StorageBootstrap, ensure_bucket
+
+
+def test_bootstrap_runs_once(make_app):
+    app = make_app()
+    app.minio_client.bucket_exists.return_value = False
+    bootstrap = StorageBootstrap(app)
+
+    bootstrap.ensure()
+    bootstrap.ensure()
+
+    app.minio_client.bucket_exists.assert_called_once_with("dropit-storage")
+    app.minio_client.make_bucket.assert_called_once_with("dropit-storage")
+    assert "expiration_date_1" in app.mongo_db["files"].index_information()
+    status = bootstrap.status()
+    assert status["ready"] and status["bucket_created"]
+
+
+def test_failed_bootstrap_is_retried(make_app):
+    app = make_app()
+    app.minio_client.bucket_exists.side_effect = [RuntimeError("down"), True]
+    bootstrap = StorageBootstrap(app)
+
+    with pytest.raises(RuntimeError):
+        bootstrap.ensure()
+    assert bootstrap.status() == {**bootstrap.status(), "ready": False, "error": "down"}
+
+    bootstrap.ensure()
+    assert bootstrap.ready and bootstrap.error is None
+
+
+def test_ensure_bucket_tolerates_concurrent_creation():
+    minio = MagicMock()
+    minio.bucket_exists.return_value = False
+    minio.make_bucket.side_effect = S3Error(
+        "BucketAlreadyOwnedByYou", "exists", "", "", "", MagicMock()
+    )
+    assert ensure_bucket(minio, "dropit-storage") is False
+
+
+def test_backends_are_recreated_after_fork(monkeypatch):
+    backends = Backends({"MONGO_DBNAME": "dropit"})
+    created = []
+    monkeypatch.setattr(
+        Backends, "_create_mongo_client", lambda self: created.append(1) or {}
+    )
+    monkeypatch.setattr(
+        Backends, "_create_mongo_db", lambda self: self.get("mongo_client")
+    )
+
+    first = backends.get("mongo_db")
+    assert backends.get("mongo_db") is first
+    assert len(created) == 1
+
+    monkeypatch.setattr(backends_module.os, "getpid", lambda: -1)
+    assert backends.get("mongo_db") is not first
+    assert len(created) == 2
+
+
+def test_backend_overrides_take_precedence():
+    backends = Backends({})
+    client = MagicMock()
+    backends.set("minio_client", client)
+    assert backends.get("minio_client") is client
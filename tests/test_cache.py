@@ -0,0 +1,39 @@
+from unittest.mock import patch
+
+from app.cache import MetadataCache
+
+
+def test_cache_hits_misses_and_lru_eviction():
+    cache = MetadataCache(max_entries=2, ttl=60)
+    assert cache.get("a") is None
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # "b" is least recently used
+
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 2
+    assert stats["evictions"] == 1
+
+
+def test_cache_entries_expire():
+    cache = MetadataCache(max_entries=10, ttl=60)
+    with patch("app.cache.time.monotonic", return_value=100.0):
+        cache.set("short", "x", max_age=5)
+        cache.set("long", "y")
+        cache.set("expired", "z", max_age=-1)
+    with patch("app.cache.time.monotonic", return_value=106.0):
+        assert cache.get("short") is None
+        assert cache.get("long") == "y"
+        assert cache.get("expired") is None
+
+
+def test_cache_invalidate():
+    cache = MetadataCache(max_entries=10, ttl=60)
+    cache.set("a", 1)
+    cache.invalidate("a")
+    assert cache.get("a") is None
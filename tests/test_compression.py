@@ -0,0 +1,51 @@
+import gzip
+import hashlib
+import io
+import os
+
+from app.compression import CompressingReader, DecodedStream, compress, probe
+
+
+def test_probe_keeps_every_byte_and_picks_codec():
+    text = b"timestamp,level,message\n" * 10000
+    stream, codec = probe(io.BytesIO(text), "gzip")
+    assert codec == "gzip"
+    assert stream.read(10) + stream.read() == text
+
+
+def test_probe_skips_incompressible_content():
+    noise = os.urandom(100000)
+    stream, codec = probe(io.BytesIO(noise), "gzip")
+    assert codec is None
+    assert stream.read() == noise
+
+
+def test_compressing_reader_hashes_raw_bytes():
+    text = b"log line\n" * 50000
+    reader = CompressingReader(io.BytesIO(text), "gzip")
+    parts = []
+    while True:
+        part = reader.read(4096)
+        if not part:
+            break
+        assert len(part) <= 4096
+        parts.append(part)
+
+    stored = b"".join(parts)
+    assert gzip.decompress(stored) == text
+    assert reader.bytes_read == len(text)
+    assert reader.bytes_written == len(stored) < len(text)
+    assert reader.sha256.hexdigest() == hashlib.sha256(text).hexdigest()
+
+
+def test_decoded_stream_serves_ranges_in_small_chunks():
+    text = bytes(range(256)) * 400
+    stored = compress("gzip", text)
+    chunks = [stored[i : i + 100] for i in range(0, len(stored), 100)]
+
+    full = list(DecodedStream(iter(chunks), "gzip", chunk_size=1024))
+    assert b"".join(full) == text
+    assert max(len(chunk) for chunk in full) <= 1024
+
+    ranged = DecodedStream(iter(chunks), "gzip", 1024, start=5000, stop=70000)
+    assert b"".join(ranged) == text[5000:70000]
@@ -0,0 +1,169 @@
+import io
+import os
+import time
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.finalizer import UploadFinalizer
+from app.metrics import Metrics
+from benchmarks.s3stub import LocalObjectStore
+
+
+@pytest.fixture
+def make_finalizer_app(make_app):
+    def make(minio=None):
+        return make_app(
+            minio or LocalObjectStore(),
+            config={"UPLOAD_PART_SIZE": 1024, "UPLOAD_MAX_BUFFER": 1024},
+            metrics=Metrics(),
+            preview_generator=MagicMock(),
+        )
+
+    return make
+
+
+def file_doc(file_id="f1", **fields):
+    return {
+        "_id": file_id,
+        "original_filename": "notes.txt",
+        "saved_filename": None,
+        "blob_id": None,
+        "file_size": 5,
+        "content_type": "text/plain",
+        "codec": None,
+        "shard": None,
+        "password": "$2b$hash",
+        "has_password": True,
+        "upload_time": datetime.now(timezone.utc),
+        "download_count": 0,
+        **fields,
+    }
+
+
+def stage_upload(finalizer, file_id="f1", data=b"hello"):
+    finalizer.stage_data(file_id, io.BytesIO(data))
+    finalizer.stage(file_doc(file_id, file_size=len(data)))
+
+
+def make_finalizer(app, tmp_path, max_attempts=3):
+    return UploadFinalizer(
+        app,
+        workers=1,
+        max_attempts=max_attempts,
+        backoff=0,
+        staging_dir=str(tmp_path),
+    )
+
+
+def test_finalize_stores_staged_upload_and_inserts_document(
+    tmp_path, make_finalizer_app
+):
+    app = make_finalizer_app()
+    finalizer = make_finalizer(app, tmp_path)
+    stage_upload(finalizer)
+
+    staged = finalizer.staged("f1")
+    assert staged["status"] == "processing"
+    assert "password" not in staged
+    assert app.mongo_db["files"].count_documents({}) == 0
+
+    assert finalizer.finalize("f1") is True
+
+    stored = app.mongo_db["files"].find_one({"_id": "f1"})
+    assert stored["saved_filename"] == "objects/f1"
+    assert stored["blob_id"].startswith("sha256:")
+    assert stored["password"] == "$2b$hash"
+    assert app.mongo_db["blobs"].find_one({"_id": stored["blob_id"]})["refcount"] == 1
+    response = app.minio_client.get_object("dropit-storage", "objects/f1")
+    assert b"".join(response.stream(1024)) == b"hello"
+    assert os.listdir(tmp_path) == []
+    # Already finalized: nothing left to do
+    assert finalizer.finalize("f1") is False
+    assert finalizer.staged("f1") is None
+
+
+def test_finalize_skips_uploads_claimed_by_another_worker(tmp_path, make_finalizer_app):
+    app = make_finalizer_app()
+    finalizer = make_finalizer(app, tmp_path)
+    stage_upload(finalizer)
+    os.rename(tmp_path / "f1.json", tmp_path / "f1.claimed")
+
+    assert finalizer.finalize("f1") is False
+    # Still processing as far as readers can tell
+    assert finalizer.staged("f1")["status"] == "processing"
+    assert finalizer.recover() == 0
+
+    # The claim outlived its lease, e.g. the other process died
+    stale = time.time() - 600
+    os.utime(tmp_path / "f1.claimed", (stale, stale))
+    assert finalizer.recover() == 1
+    assert finalizer.finalize("f1") is True
+
+
+def test_failures_are_retried_then_inserted_as_failed(tmp_path, make_finalizer_app):
+    minio = MagicMock()
+    minio.remove_objects.return_value = iter([])
+    # Several sources have to be composed, which is the step that fails here
+    minio.compose_object.side_effect = RuntimeError("MinIO down")
+    app = make_finalizer_app(minio)
+    finalizer = make_finalizer(app, tmp_path, max_attempts=2)
+    sources = ["uploads/u/00000", "uploads/u/00001"]
+    finalizer.stage(file_doc(), sources=sources, blob_id="sha256-chunks:abc")
+
+    finalizer._process(*finalizer._queue.get_nowait())
+    assert app.mongo_db["files"].count_documents({}) == 0
+    assert finalizer.staged("f1")["status"] == "processing"
+    assert finalizer.stats()["retries"] == 1
+
+    finalizer._process("f1", 2, 0)
+    failed = app.mongo_db["files"].find_one({"_id": "f1"})
+    assert failed["status"] == "failed"
+    assert failed["finalize_error"] == "MinIO down"
+    # Left for the reaper, which removes them with the expired document
+    assert failed["pending_sources"] == sources
+    assert finalizer.stats()["failed"] == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_retry_after_blob_step_does_not_take_a_second_reference(
+    tmp_path, make_finalizer_app
+):
+    app = make_finalizer_app()
+    files_collection = app.mongo_db["files"]
+    insert_one = files_collection.insert_one
+    calls = []
+
+    def flaky_insert_one(document, *args, **kwargs):
+        calls.append(document["_id"])
+        if len(calls) == 1:
+            raise RuntimeError("Mongo down")
+        return insert_one(document, *args, **kwargs)
+
+    files_collection.insert_one = flaky_insert_one
+    finalizer = make_finalizer(app, tmp_path)
+    stage_upload(finalizer)
+
+    finalizer._process("f1", 1, 0)
+    assert files_collection.count_documents({}) == 0
+
+    finalizer._process("f1", 2, 0)
+    stored = files_collection.find_one({"_id": "f1"})
+    assert stored["saved_filename"] == "objects/f1"
+    assert app.mongo_db["blobs"].find_one({"_id": stored["blob_id"]})["refcount"] == 1
+
+
+def test_recover_requeues_staged_uploads(tmp_path, make_finalizer_app):
+    staging = make_finalizer(make_finalizer_app(), tmp_path)
+    stage_upload(staging, "f1")
+    stage_upload(staging, "f2")
+    # A request that died before writing its manifest
+    (tmp_path / "gone.data").write_bytes(b"partial")
+    stale = time.time() - 600
+    os.utime(tmp_path / "gone.data", (stale, stale))
+
+    finalizer = make_finalizer(make_finalizer_app(), tmp_path)
+    assert finalizer.recover() == 2
+    assert finalizer.stats()["queue_depth"] == 2
+    assert not (tmp_path / "gone.data").exists()
@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+
+from app.listing import (
+    ListingError,
+    build_listing_query,
+    decode_cursor,
+    encode_cursor,
+    ensure_listing_indexes,
+    family_types,
+    list_files,
+)
+
+
+@pytest.fixture
+def files_collection():
+    collection = mongomock.MongoClient().db["files"]
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    collection.insert_many(
+        [
+            {
+                "_id": f"file{index:02d}",
+                "original_filename": f"file{index}.bin",
+                "file_size": index * 100,
+                "content_type": "image/png" if index % 2 else "text/plain",
+                # Pairs of uploads share a timestamp, so _id breaks the tie
+                "upload_time": start + timedelta(minutes=index // 2),
+                "expiration_date": start + timedelta(days=index),
+                "password": "hash",
+                "has_password": True,
+            }
+            for index in range(10)
+        ]
+    )
+    return collection
+
+
+def collect_pages(files_collection, args):
+    pages = []
+    cursor = None
+    while True:
+        file_docs, cursor = list_files(files_collection, {**args, "cursor": cursor})
+        pages.append([file_doc["_id"] for file_doc in file_docs])
+        if not cursor:
+            return pages
+
+
+def test_pages_walk_newest_first_without_gaps_or_repeats(files_collection):
+    pages = collect_pages(files_collection, {"limit": "3"})
+
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert sum(pages, []) == [f"file{index:02d}" for index in reversed(range(10))]
+
+
+def test_filters_combine_with_pagination(files_collection):
+    pages = collect_pages(
+        files_collection,
+        {"limit": "2", "content_type": "image/", "min_size": "200", "max_size": "800"},
+    )
+
+    assert sum(pages, []) == ["file07", "file05", "file03"]
+
+
+def test_families_are_listed_by_their_stored_types(files_collection):
+    files_collection.insert_one(
+        {
+            "_id": "lookalike",
+            "file_size": 100,
+            "content_type": "images/x",
+            "upload_time": datetime(2026, 2, 1, tzinfo=timezone.utc),
+        }
+    )
+
+    assert family_types(files_collection, "image/") == ["image/png"]
+    assert family_types(files_collection, "video/") == []
+    query = build_listing_query({"content_type": "image/"}, content_types=["image/png"])
+    assert query == {"content_type": {"$in": ["image/png"]}}
+    file_docs, _ = list_files(files_collection, {"content_type": "video/"})
+    assert file_docs == []
+
+
+def test_every_filter_is_covered_by_a_listing_index(files_collection):
+    ensure_listing_indexes(files_collection)
+
+    keys = [
+        [field for field, _ in index["key"]]
+        for index in files_collection.index_information().values()
+    ]
+    for fields in (["content_type"], []):
+        assert fields + ["upload_time", "_id", "file_size", "expiration_date"] in keys
+
+
+def test_expiry_filters(files_collection):
+    now = datetime(2026, 1, 4, 12, tzinfo=timezone.utc)
+
+    expired = files_collection.find(build_listing_query({"expired": "true"}, now))
+    assert sorted(file_doc["_id"] for file_doc in expired) == [
+        "file00",
+        "file01",
+        "file02",
+        "file03",
+    ]
+    query = build_listing_query({"expires_before": "2026-01-03"})
+    assert files_collection.count_documents(query) == 2
+
+
+def test_password_hashes_are_never_listed(files_collection):
+    file_docs, _ = list_files(files_collection, {})
+
+    assert file_docs
+    assert all("password" not in file_doc for file_doc in file_docs)
+
+
+def test_cursor_round_trips_and_rejects_garbage():
+    upload_time = datetime(2026, 1, 1, 12, 30, tzinfo=timezone.utc)
+    cursor = encode_cursor({"_id": "abc", "upload_time": upload_time})
+
+    assert decode_cursor(cursor) == (upload_time, "abc")
+    with pytest.raises(ListingError):
+        decode_cursor("not-a-cursor")
+    with pytest.raises(ListingError):
+        build_listing_query({"min_size": "big"})
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.metrics import Histogram, Metrics, MongoCommandTimer, TimedClient
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency.", ("route",), (0.1, 1.0))
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.1, "/a")
+    histogram.observe(5, "/a")
+
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{route="/a",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/a",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/a",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{route="/a"} 3' in lines
+
+
+def test_timed_client_records_calls_and_errors():
+    metrics = Metrics()
+    client = MagicMock()
+    client.stat_object.side_effect = OSError("down")
+    timed = TimedClient(client, metrics, "minio")
+
+    timed.bucket_exists("bucket")
+    timed.bucket_exists("bucket")
+    with pytest.raises(OSError):
+        timed.stat_object("bucket", "name")
+
+    assert client.bucket_exists.call_count == 2
+    assert metrics.backend_duration.count("minio", "bucket_exists") == 2
+    assert metrics.backend_errors.value("minio", "stat_object") == 1
+
+
+def test_mongo_commands_are_timed():
+    metrics = Metrics()
+    listener = MongoCommandTimer(metrics)
+    event = SimpleNamespace(command_name="find", duration_micros=1500)
+
+    listener.succeeded(event)
+    listener.failed(event)
+
+    assert metrics.backend_duration.count("mongo", "find") == 2
+    assert metrics.backend_errors.value("mongo", "find") == 1
+    assert 'operation="find"' in metrics.render()
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+
+from app.objectcache import ObjectCache, entry_name
+
+
+def writer(data, calls=None):
+    def fill(path):
+        if calls is not None:
+            calls.append(path)
+        with open(path, "wb") as target:
+            target.write(data)
+
+    return fill
+
+
+def test_miss_fills_then_hits(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_bytes=100, max_object_size=50)
+    calls = []
+
+    path = cache.fetch("objects/a", "etag-1", writer(b"hello", calls))
+    assert open(path, "rb").read() == b"hello"
+    assert cache.fetch("objects/a", "etag-1", writer(b"other", calls)) == path
+    assert len(calls) == 1
+
+    # A different ETag is a different entry
+    changed = cache.fetch("objects/a", "etag-2", writer(b"world", calls))
+    assert changed != path
+    assert open(changed, "rb").read() == b"world"
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["bytes"] == 10
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_bytes=10, max_object_size=10)
+    first = cache.fetch("a", "1", writer(b"aaaa"))
+    cache.fetch("b", "1", writer(b"bbbb"))
+    cache.fetch("a", "1", writer(b"aaaa"))
+    # Over budget without an eviction thread: evicted inline
+    cache.fetch("c", "1", writer(b"cccc"))
+
+    assert os.path.exists(first)
+    assert not os.path.exists(os.path.join(str(tmp_path), entry_name("b", "1")))
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+
+
+def test_concurrent_misses_share_one_fill(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_bytes=100, max_object_size=100)
+    release = threading.Event()
+    calls = []
+
+    def slow_fill(path):
+        calls.append(path)
+        release.wait(5)
+        writer(b"shared")(path)
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(cache.fetch("k", "e", slow_fill))
+        )
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while cache.stats()["merged_misses"] < 4 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(set(results)) == 1 and results[0] is not None
+
+
+def test_failed_fill_leaves_nothing_behind(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_bytes=100, max_object_size=100)
+
+    def broken(path):
+        writer(b"partial")(path)
+        raise OSError("MinIO down")
+
+    assert cache.fetch("k", "e", broken) is None
+    assert os.listdir(str(tmp_path)) == []
+    assert cache.stats()["fill_errors"] == 1
+
+
+def test_restart_adopts_existing_copies(tmp_path):
+    ObjectCache(str(tmp_path), 100, 100).fetch("k", "e", writer(b"kept"))
+    # One fill of another process in progress, one left by a fill that died
+    (tmp_path / "filling.tmp").write_bytes(b"x")
+    (tmp_path / "leftover.tmp").write_bytes(b"x")
+    stale = time.time() - 2 * 3600
+    os.utime(tmp_path / "leftover.tmp", (stale, stale))
+
+    cache = ObjectCache(str(tmp_path), 100, 100)
+    cache.fetch("k", "e", writer(b"refetched"))
+
+    assert cache.stats()["hits"] == 1
+    assert (tmp_path / "filling.tmp").exists()
+    assert not (tmp_path / "leftover.tmp").exists()
+
+
+def test_budget_holds_for_processes_sharing_the_directory(tmp_path):
+    first = ObjectCache(str(tmp_path), max_bytes=10, max_object_size=10)
+    second = ObjectCache(str(tmp_path), max_bytes=10, max_object_size=10)
+    first.fetch("a", "1", writer(b"aaaa"))
+    second.fetch("b", "1", writer(b"bbbb"))
+    # Filled by the other process, so no fill here
+    assert second.lookup("a", "1") is not None
+
+    first.fetch("c", "1", writer(b"cccc"))
+
+    # Twelve bytes on disk: the least recently used copy, b, had to go
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        entry_name(key, "1") for key in ("a", "c")
+    )
+    assert first.stats()["bytes"] == 8
+
+
+def test_tee_fills_the_cache_while_sending(tmp_path):
+    cache = ObjectCache(str(tmp_path), max_bytes=100, max_object_size=100)
+
+    body = cache.tee("k", "e", iter([b"sent ", b"whole"]))
+    assert b"".join(body) == b"sent whole"
+    body.close()
+    path = cache.lookup("k", "e")
+    assert open(path, "rb").read() == b"sent whole"
+
+    # A client that goes away early leaves nothing behind
+    body = cache.tee("other", "e", iter([b"cut ", b"short"]))
+    assert next(iter(body)) == b"cut "
+    body.close()
+    assert cache.lookup("other", "e") is None
+    assert os.listdir(str(tmp_path)) == [os.path.basename(path)]
+
+
+def test_accepts_only_objects_within_limits(tmp_path):
+    assert not ObjectCache(str(tmp_path), 0, 10).accepts(1)
+    cache = ObjectCache(str(tmp_path), 100, 10)
+    assert cache.accepts(10)
+    assert not cache.accepts(11)
+    assert not cache.accepts(None)
@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from app.passwords import AttemptLimiter, HasherBusy, PasswordHasher
+
+
+def test_hasher_runs_work_and_records_timings():
+    hasher = PasswordHasher(workers=1, max_queue=0)
+    assert hasher.run(lambda a, b: a + b, 2, 3) == 5
+
+    stats = hasher.stats()
+    assert stats["calls"] == 1
+    assert stats["rejected"] == 0
+    assert stats["max_seconds"] >= 0
+
+
+def test_hasher_rejects_when_queue_is_full():
+    hasher = PasswordHasher(workers=1, max_queue=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+
+    worker = threading.Thread(target=hasher.run, args=(slow,))
+    worker.start()
+    started.wait(5)
+
+    with pytest.raises(HasherBusy):
+        hasher.run(lambda: None)
+
+    release.set()
+    worker.join(5)
+    assert hasher.stats()["rejected"] == 1
+
+
+def test_attempt_limiter_blocks_after_max_failures():
+    limiter = AttemptLimiter(max_failures=2, window_seconds=60)
+    key = ("file", "127.0.0.1")
+
+    limiter.record_failure(key)
+    assert limiter.retry_after(key) == 0
+    limiter.record_failure(key)
+    assert 0 < limiter.retry_after(key) <= 61
+    assert limiter.retry_after(("file", "10.0.0.1")) == 0
+
+    limiter.reset(key)
+    assert limiter.retry_after(key) == 0
+
+
+def test_attempt_limiter_prunes_keys():
+    limiter = AttemptLimiter(max_failures=1, window_seconds=60, max_keys=2)
+    for client in range(5):
+        limiter.record_failure(("file", client))
+    assert len(limiter._failures) <= 2
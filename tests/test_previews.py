@@ -0,0 +1,159 @@
+import gzip
+import io
+
+import pytest
+
+from app import previews as previews_module
+from app.previews import PreviewGenerator, preview_source, text_excerpt
+from benchmarks.s3stub import LocalObjectStore
+
+
+@pytest.fixture
+def make_preview_app(make_app):
+    def make():
+        return make_app(LocalObjectStore(), config={"DOWNLOAD_CHUNK_SIZE": 1024})
+
+    return make
+
+
+def add_file(app, file_id, data, **fields):
+    app.minio_client.put_object(
+        "dropit-storage", f"objects/{file_id}", io.BytesIO(data), len(data)
+    )
+    app.mongo_db["files"].insert_one(
+        {
+            "_id": file_id,
+            "saved_filename": f"objects/{file_id}",
+            "original_filename": "notes.txt",
+            "content_type": "text/plain",
+            "file_size": len(data),
+            "has_password": False,
+            "preview": {"status": "pending"},
+            **fields,
+        }
+    )
+
+
+def read_preview(app, file_id):
+    preview = app.mongo_db["files"].find_one({"_id": file_id})["preview"]
+    response = app.minio_client.get_object("dropit-storage", preview["object_name"])
+    try:
+        return preview, b"".join(response.stream(1024))
+    finally:
+        response.close()
+
+
+def test_preview_source(monkeypatch):
+    assert preview_source("text/csv", "data.csv") == "text"
+    assert preview_source("application/octet-stream", "README.md") == "text"
+    assert preview_source("application/zip", "files.zip") is None
+    assert preview_source("image/svg+xml", "logo.svg") is None
+
+    monkeypatch.setattr(previews_module, "Image", None)
+    monkeypatch.setattr(previews_module, "fitz", None)
+    # Without the optional renderers images and PDFs get no preview
+    assert preview_source("image/jpeg", "photo.jpg") is None
+    assert preview_source("application/pdf", "paper.pdf") is None
+
+
+def test_protected_and_limited_files_get_no_preview(make_preview_app):
+    generator = PreviewGenerator(
+        make_preview_app(),
+        workers=1,
+        max_source_size=1024,
+        thumbnail_size=64,
+        text_bytes=16,
+    )
+    file_doc = {"content_type": "text/plain", "file_size": 10}
+
+    assert generator.wants(file_doc)
+    assert not generator.wants(dict(file_doc, has_password=True))
+    assert not generator.wants(dict(file_doc, download_limit=3))
+
+
+class Chunks(list):
+    def close(self):
+        self.closed = True
+
+
+def test_text_excerpt_ends_at_a_line_break():
+    chunks = Chunks([b"first line\n", b"second line\n", b"third"])
+
+    assert text_excerpt(chunks, 16) == b"first line\n"
+    assert chunks.closed
+    assert text_excerpt(Chunks([b"short"]), 16) == b"short"
+
+
+def test_generator_stores_text_excerpts_once(make_preview_app):
+    app = make_preview_app()
+    generator = PreviewGenerator(
+        app, workers=1, max_source_size=1024, thumbnail_size=64, text_bytes=16
+    )
+    add_file(app, "plain", b"first line\nsecond line\n")
+    add_file(
+        app,
+        "packed",
+        gzip.compress(b"zipped line\nmore\n"),
+        codec="gzip",
+        file_size=17,
+    )
+
+    assert generator.generate("plain")
+    assert generator.generate("packed")
+    # Already done
+    assert not generator.generate("plain")
+
+    preview, data = read_preview(app, "plain")
+    assert data == b"first line\n"
+    assert preview["kind"] == "text"
+    assert preview["size"] == len(data)
+    assert read_preview(app, "packed")[1] == b"zipped line\n"
+    assert generator.stats()["generated"] == 2
+
+
+def test_generator_waits_for_finalized_files_and_records_failures(make_preview_app):
+    app = make_preview_app()
+    generator = PreviewGenerator(
+        app, workers=1, max_source_size=1024, thumbnail_size=64, text_bytes=16
+    )
+    add_file(app, "staged", b"text", status="processing")
+    app.mongo_db["files"].insert_one(
+        {
+            "_id": "missing",
+            "saved_filename": "objects/missing",
+            "content_type": "text/plain",
+            "preview": {"status": "pending"},
+        }
+    )
+
+    assert not generator.generate("staged")
+    assert generator.generate("missing")
+
+    preview = app.mongo_db["files"].find_one({"_id": "missing"})["preview"]
+    assert preview["status"] == "failed"
+    # Neither is picked up again: one isn't stored yet, the other failed
+    assert generator.recover() == 0
+
+
+def test_generator_makes_image_thumbnails(make_preview_app):
+    image_module = pytest.importorskip("PIL.Image")
+    app = make_preview_app()
+    generator = PreviewGenerator(
+        app, workers=1, max_source_size=10**7, thumbnail_size=64, text_bytes=16
+    )
+    photo = io.BytesIO()
+    image_module.new("RGB", (640, 480), "red").save(photo, "JPEG")
+    add_file(
+        app,
+        "photo",
+        photo.getvalue(),
+        original_filename="photo.jpg",
+        content_type="image/jpeg",
+    )
+
+    generator.generate("photo")
+
+    preview, data = read_preview(app, "photo")
+    assert preview["content_type"] == "image/jpeg"
+    with image_module.open(io.BytesIO(data)) as thumbnail:
+        assert max(thumbnail.size) == 64
@@ -0,0 +1,190 @@
+from datetime import datetime, timedelta, timezone
+
+import mongomock
+import pytest
+
+from app import sharding as sharding_module
+from app.reaper import ExpiryReaper, migrate_expiration_dates
+
+
+def test_migrate_expiration_dates_converts_strings():
+    files = mongomock.MongoClient().db["files"]
+    files.insert_many(
+        [
+            {"_id": "legacy", "expiration_date": "2020-01-02"},
+            {"_id": "iso", "expiration_date": "2030-05-06T23:59:59.999999+00:00"},
+            {"_id": "none", "expiration_date": None},
+            {"_id": "garbage", "expiration_date": "not a date"},
+        ]
+    )
+
+    assert migrate_expiration_dates(files, batch_size=2) == 3
+
+    assert files.find_one({"_id": "legacy"})["expiration_date"] == datetime(
+        2020, 1, 2, 23, 59, 59, 999000
+    )
+    assert isinstance(files.find_one({"_id": "iso"})["expiration_date"], datetime)
+    assert files.find_one({"_id": "garbage"})["expiration_date"] is None
+    assert migrate_expiration_dates(files) == 0
+
+
+def test_reaper_deletes_expired_files_and_objects_in_batches(make_app):
+    app = make_app()
+    files = app.mongo_db["files"]
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    files.insert_many(
+        [
+            {"_id": f"old{i}", "saved_filename": f"old{i}.txt", "expiration_date": past}
+            for i in range(3)
+        ]
+        + [
+            {
+                "_id": "fresh",
+                "saved_filename": "fresh.txt",
+                "expiration_date": datetime.now(timezone.utc) + timedelta(days=1),
+            },
+            {
+                "_id": "legacy",
+                "saved_filename": "legacy.txt",
+                "expiration_date": "2020-01-01",
+            },
+        ]
+    )
+    app.metadata_cache.set("old0", {"_id": "old0"})
+
+    reaper = ExpiryReaper(app, interval=0, batch_size=2, session_ttl=3600)
+    result = reaper.run_once()
+
+    assert result["files_reaped"] == 4
+    assert result["objects_reclaimed"] == 4
+    assert result["lag_seconds"] > 0
+    assert [doc["_id"] for doc in files.find()] == ["fresh"]
+    assert app.metadata_cache.get("old0") is None
+    assert app.minio_client.remove_objects.call_count == 2
+    assert reaper.stats()["files_reaped"] == 4
+
+
+def test_reaper_removes_abandoned_upload_sessions(monkeypatch, make_app):
+    removed = []
+    monkeypatch.setattr(
+        sharding_module,
+        "remove_objects",
+        lambda minio, bucket_name, names: removed.extend(names),
+    )
+    app = make_app()
+    two_days_ago = datetime.now(timezone.utc) - timedelta(days=2)
+    app.mongo_db["upload_sessions"].insert_many(
+        [
+            {
+                "_id": "stale",
+                "file_id": "never-recorded",
+                "parts": {"0": {"size": 1}, "1": {"size": 1}},
+                "created_at": two_days_ago,
+            },
+            # Its complete recorded the file, whose blob is the chunk itself
+            {
+                "_id": "completed",
+                "file_id": "recorded",
+                "parts": {"0": {"size": 1}},
+                "completing": True,
+                "created_at": two_days_ago,
+            },
+        ]
+    )
+    app.mongo_db["files"].insert_one(
+        {"_id": "recorded", "saved_filename": "uploads/completed/00000"}
+    )
+
+    result = ExpiryReaper(app, interval=0, batch_size=10, session_ttl=3600).run_once()
+
+    assert result["sessions_reaped"] == 2
+    assert app.mongo_db["upload_sessions"].count_documents({}) == 0
+    assert removed == ["uploads/stale/00000", "uploads/stale/00001"]
+
+
+def test_reaper_keeps_blobs_that_are_still_referenced(make_app):
+    app = make_app()
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    future = datetime.now(timezone.utc) + timedelta(days=1)
+    app.mongo_db["blobs"].insert_one(
+        {"_id": "sha256:abc", "object_name": "blobs/abc/old", "refcount": 2}
+    )
+    app.mongo_db["files"].insert_many(
+        [
+            {
+                "_id": "old",
+                "blob_id": "sha256:abc",
+                "saved_filename": "blobs/abc/old",
+                "expiration_date": past,
+            },
+            {
+                "_id": "new",
+                "blob_id": "sha256:abc",
+                "saved_filename": "blobs/abc/old",
+                "expiration_date": future,
+            },
+        ]
+    )
+
+    result = ExpiryReaper(app, interval=0, batch_size=10, session_ttl=3600).run_once()
+
+    assert result["files_reaped"] == 1
+    assert result["objects_reclaimed"] == 0
+    assert app.mongo_db["blobs"].find_one({"_id": "sha256:abc"})["refcount"] == 1
+
+
+def test_failed_run_does_not_release_blobs_twice(monkeypatch, make_app):
+    app = make_app()
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    future = datetime.now(timezone.utc) + timedelta(days=1)
+    app.mongo_db["blobs"].insert_one(
+        {"_id": "sha256:abc", "object_name": "blobs/abc/old", "refcount": 2}
+    )
+    app.mongo_db["files"].insert_many(
+        [
+            {"_id": "old", "blob_id": "sha256:abc", "expiration_date": past},
+            {"_id": "live", "blob_id": "sha256:abc", "expiration_date": future},
+        ]
+    )
+    failures = [RuntimeError("MinIO down")]
+
+    def remove(objects):
+        if failures:
+            raise failures.pop()
+
+    monkeypatch.setattr(app.storage, "remove", remove)
+    reaper = ExpiryReaper(app, interval=0, batch_size=10, session_ttl=3600)
+
+    with pytest.raises(RuntimeError):
+        reaper.run_once()
+    reaper.run_once()
+
+    # The live file still holds its reference
+    assert app.mongo_db["blobs"].find_one({"_id": "sha256:abc"})["refcount"] == 1
+
+
+def test_reaper_removes_previews(monkeypatch, make_app):
+    removed = []
+    monkeypatch.setattr(
+        sharding_module,
+        "remove_objects",
+        lambda minio, bucket_name, names: removed.extend(names),
+    )
+    app = make_app()
+    app.mongo_db["files"].insert_one(
+        {
+            "_id": "old",
+            "saved_filename": "objects/old",
+            "expiration_date": datetime.now(timezone.utc) - timedelta(days=1),
+            "preview": {
+                "status": "ready",
+                "object_name": "previews/old",
+                "shard": "default",
+            },
+        }
+    )
+
+    result = ExpiryReaper(app, interval=0, batch_size=10, session_ttl=3600).run_once()
+
+    assert result["objects_reclaimed"] == 2
+    assert sorted(removed) == ["objects/old", "previews/old"]
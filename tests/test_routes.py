@@ -1,4 +1,7 @@
+import io
+import zipfile
 import os
+import re
 import tempfile
 import pytest
 import mongomock
@@ -7,6 +10,12 @@ from datetime import datetime, timedelta, timezone
 from unittest.mock import MagicMock
 from dotenv import load_dotenv
 from app import create_app
+from app import routes
+from app.routes import UPLOAD_FOLDER
+from app.passwords import AttemptLimiter, HasherBusy
+from app.sharding import AppShard, Shard, StorageRouter
+from app.tokens import issue_download_token
+from benchmarks.s3stub import LocalObjectStore
 
 load_dotenv(dotenv_path=os.path.join(os.getcwd(), ".env.test"))
 
@@ -28,6 +37,7 @@ def app_client(app):
 def mongo_collection(app):
     collection = app.mongo_db["files"]
     collection.delete_many({})
+    app.metadata_cache.clear()
 
     hashed_pw = bcrypt.hashpw("testpassword".encode(), bcrypt.gensalt()).decode()
 
@@ -185,3 +195,1138 @@ def test_download_limit_exceeded(app_client, mongo_collection):
     assert b'Download limit reached' in response.data
     
 
+
+def test_download_streams_from_minio(app, app_client, mongo_collection, monkeypatch):
+    minio_response = MagicMock()
+    minio_response.stream.return_value = iter([b"hello ", b"world"])
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(return_value=minio_response)
+    )
+
+    response = app_client.get("/files/test_no_password/download")
+
+    assert response.status_code == 200
+    assert response.data == b"hello world"
+    assert "nopassword.txt" in response.headers["Content-Disposition"]
+    minio_response.stream.assert_called_once_with(app.config["DOWNLOAD_CHUNK_SIZE"])
+    minio_response.release_conn.assert_called_once()
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 1
+
+
+def read_into_minio(stored):
+    def put_object(bucket_name, object_name, data, length, **kwargs):
+        stored[object_name] = data.read()
+        stored["kwargs"] = kwargs
+        return MagicMock(etag=f"etag-{object_name}")
+
+    return put_object
+
+
+def test_upload_streams_into_minio_and_counts_size(app, app_client, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+
+    response = app_client.post(
+        "/",
+        data={"file": (io.BytesIO(b"x" * 4096), "counted.bin")},
+        content_type="multipart/form-data",
+        headers={"X-Requested-With": "XMLHttpRequest"},
+    )
+
+    file_id = response.get_json()["file_id"]
+    file_doc = app.mongo_db["files"].find_one({"_id": file_id})
+    assert file_doc["file_size"] == 4096
+    assert stored[f"objects/{file_id}"] == b"x" * 4096
+    assert stored["kwargs"]["part_size"] >= 5 * 1024 * 1024
+    assert not os.listdir(UPLOAD_FOLDER)
+
+
+def test_raw_stream_upload(app, app_client, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+
+    response = app_client.put(
+        "/upload?download-limit=2",
+        data=b"raw body",
+        content_type="text/plain",
+        headers={"X-File-Name": "r%C3%A9sum%C3%A9.txt", "X-File-Password": "pw"},
+    )
+
+    assert response.status_code == 200
+    file_doc = app.mongo_db["files"].find_one({"_id": response.get_json()["file_id"]})
+    assert file_doc["original_filename"] == "résumé.txt"
+    assert file_doc["file_size"] == len(b"raw body")
+    assert file_doc["download_limit"] == 2
+    assert file_doc["has_password"] is True
+    assert isinstance(file_doc["expiration_date"], datetime)
+
+
+def test_raw_stream_upload_requires_filename(app_client):
+    response = app_client.put("/upload", data=b"data")
+    assert response.status_code == 400
+
+
+def test_resumable_upload_session(app, app_client, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+    monkeypatch.setattr(app.minio_client, "compose_object", MagicMock())
+
+    response = app_client.post(
+        "/uploads",
+        json={"filename": "big.bin", "size": 11, "download-limit": "4"},
+    )
+    assert response.status_code == 201
+    session = response.get_json()
+    assert session["total_chunks"] == 1
+    upload_id = session["upload_id"]
+
+    incomplete = app_client.post(f"/uploads/{upload_id}/complete")
+    assert incomplete.status_code == 409
+    assert incomplete.get_json()["missing"] == [0]
+
+    wrong_size = app_client.put(f"/uploads/{upload_id}/chunks/0", data=b"short")
+    assert wrong_size.status_code == 400
+
+    chunk = app_client.put(f"/uploads/{upload_id}/chunks/0", data=b"hello world")
+    assert chunk.status_code == 200
+    assert stored[f"uploads/{upload_id}/00000"] == b"hello world"
+
+    status = app_client.get(f"/uploads/{upload_id}").get_json()
+    assert status["received"] == [0]
+    assert status["offsets"] == [0]
+    assert status["bytes_received"] == 11
+
+    complete = app_client.post(f"/uploads/{upload_id}/complete")
+    assert complete.status_code == 200
+    file_doc = app.mongo_db["files"].find_one({"_id": complete.get_json()["file_id"]})
+    assert file_doc["file_size"] == 11
+    assert file_doc["download_limit"] == 4
+    # A single chunk becomes the blob without a server-side copy
+    assert file_doc["saved_filename"] == f"uploads/{upload_id}/00000"
+    app.minio_client.compose_object.assert_not_called()
+    assert app.mongo_db["upload_sessions"].find_one({"_id": upload_id}) is None
+
+
+def test_resumable_upload_is_completed_once(app, app_client, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+    upload_id = app_client.post(
+        "/uploads", json={"filename": "once.bin", "size": 4}
+    ).get_json()["upload_id"]
+    chunk_url = f"/uploads/{upload_id}/chunks/0"
+    assert app_client.put(chunk_url, data=b"once").status_code == 200
+
+    # Another request is in the middle of completing it
+    sessions = app.mongo_db["upload_sessions"]
+    sessions.update_one({"_id": upload_id}, {"$set": {"completing": True}})
+    assert app_client.post(f"/uploads/{upload_id}/complete").status_code == 409
+    assert app_client.put(chunk_url, data=b"once").status_code == 409
+    assert app_client.delete(f"/uploads/{upload_id}").status_code == 409
+
+    # A failed complete hands the session back for a retry
+    sessions.update_one({"_id": upload_id}, {"$unset": {"completing": ""}})
+    monkeypatch.setattr(
+        routes, "store_blob", MagicMock(side_effect=RuntimeError("down"))
+    )
+    assert app_client.post(f"/uploads/{upload_id}/complete").status_code == 500
+    assert "completing" not in sessions.find_one({"_id": upload_id})
+
+
+def test_resumable_upload_unknown_session(app_client):
+    assert app_client.get("/uploads/missing").status_code == 404
+    assert app_client.put("/uploads/missing/chunks/0", data=b"x").status_code == 404
+
+
+def test_large_download_redirects_to_presigned_url(
+    app, app_client, mongo_collection, monkeypatch
+):
+    monkeypatch.setitem(app.config, "PRESIGNED_DOWNLOAD_THRESHOLD", 1000)
+    presign = MagicMock(return_value="http://minio.local/signed")
+    monkeypatch.setattr(app.minio_client, "presigned_get_object", presign)
+
+    response = app_client.get("/files/test_no_password/download")
+
+    assert response.status_code == 302
+    assert response.headers["Location"] == "http://minio.local/signed"
+    response_headers = presign.call_args.kwargs["response_headers"]
+    assert "nopassword.txt" in response_headers["response-content-disposition"]
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 1
+
+
+def test_small_download_is_not_redirected(
+    app, app_client, mongo_collection, monkeypatch
+):
+    monkeypatch.setitem(app.config, "PRESIGNED_DOWNLOAD_THRESHOLD", 1000)
+    minio_response = MagicMock()
+    minio_response.stream.return_value = iter([b"small"])
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(return_value=minio_response)
+    )
+
+    response = app_client.get("/files/test_expired_file/download")
+    assert response.status_code == 302  # expired, bounced back to the access page
+
+    mongo_collection.update_one(
+        {"_id": "test_expired_file"}, {"$set": {"expiration_date": None}}
+    )
+    app.metadata_cache.invalidate("test_expired_file")
+    response = app_client.get("/files/test_expired_file/download")
+    assert response.status_code == 200
+    assert response.data == b"small"
+
+
+def test_password_unlock_issues_token_instead_of_password(app_client, mongo_collection):
+    response = app_client.post(
+        "/files/test_with_password", data={"password": "testpassword"}
+    )
+    assert response.status_code == 200
+    assert b"token=" in response.data
+    assert b"testpassword" not in response.data
+
+
+def test_download_with_token_skips_bcrypt(app, app_client, mongo_collection, monkeypatch):
+    minio_response = MagicMock()
+    minio_response.stream.return_value = iter([b"secret"])
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(return_value=minio_response)
+    )
+    checkpw = MagicMock(side_effect=AssertionError("bcrypt should not run"))
+    monkeypatch.setattr(routes, "verify_password", checkpw)
+
+    token = issue_download_token(app.secret_key, "test_with_password")
+    response = app_client.get(f"/files/test_with_password/download?token={token}")
+
+    assert response.status_code == 200
+    assert response.data == b"secret"
+
+
+def test_download_rejects_bad_tokens(app, app_client, mongo_collection):
+    other_file_token = issue_download_token(app.secret_key, "test_no_password")
+    for query in (
+        "",
+        "?password=testpassword",
+        "?token=tampered",
+        f"?token={other_file_token}",
+    ):
+        response = app_client.get(f"/files/test_with_password/download{query}")
+        assert response.status_code == 302
+        assert response.headers["Location"].endswith("/files/test_with_password")
+
+
+def test_password_flood_is_throttled_before_bcrypt(
+    app, app_client, mongo_collection, monkeypatch
+):
+    monkeypatch.setattr(
+        app, "password_attempts", AttemptLimiter(max_failures=2, window_seconds=60)
+    )
+    for _ in range(2):
+        response = app_client.post(
+            "/files/test_with_password", data={"password": "wrong"}
+        )
+        assert response.status_code == 200
+
+    checkpw = MagicMock(side_effect=AssertionError("bcrypt should not run"))
+    monkeypatch.setattr(routes, "verify_password", checkpw)
+    response = app_client.post(
+        "/files/test_with_password", data={"password": "testpassword"}
+    )
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert b"Too many incorrect attempts" in response.data
+
+
+def test_busy_hasher_returns_503(app, app_client, mongo_collection, monkeypatch):
+    monkeypatch.setattr(
+        app.password_hasher, "run", MagicMock(side_effect=HasherBusy())
+    )
+    response = app_client.post(
+        "/files/test_with_password", data={"password": "testpassword"}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_file_metadata_is_cached_without_password_hash(
+    app, app_client, mongo_collection
+):
+    app_client.get("/files/test_with_password")
+    before = app.metadata_cache.stats()
+    app_client.get("/files/test_with_password")
+    after = app.metadata_cache.stats()
+
+    assert after["hits"] == before["hits"] + 1
+    assert "password" not in app.metadata_cache.get("test_with_password")
+    assert app_client.get("/stats").get_json()["metadata_cache"]["hits"] >= 1
+
+
+def test_download_invalidates_cached_metadata(
+    app, app_client, mongo_collection, monkeypatch
+):
+    minio_response = MagicMock()
+    minio_response.stream.return_value = iter([b"data"])
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(return_value=minio_response)
+    )
+    app_client.get("/files/test_no_password")
+    assert app.metadata_cache.get("test_no_password")["download_count"] == 0
+
+    app_client.get("/files/test_no_password/download")
+
+    assert app.metadata_cache.get("test_no_password") is None
+    response = app_client.get("/files/test_no_password")
+    assert b"Ready to download" in response.data
+
+
+def test_download_limit_is_enforced_atomically(
+    app, app_client, mongo_collection, monkeypatch
+):
+    mongo_collection.update_one(
+        {"_id": "test_no_password"}, {"$set": {"download_limit": 1}}
+    )
+    app.metadata_cache.invalidate("test_no_password")
+    minio_response = MagicMock()
+    minio_response.stream.side_effect = lambda size: iter([b"once"])
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(return_value=minio_response)
+    )
+
+    first = app_client.get("/files/test_no_password/download")
+    second = app_client.get("/files/test_no_password/download")
+
+    assert first.status_code == 200
+    assert second.status_code == 302
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 1
+
+
+def test_download_count_rolls_back_when_minio_fails(
+    app, app_client, mongo_collection, monkeypatch
+):
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(side_effect=OSError("down"))
+    )
+    response = app_client.get("/files/test_no_password/download")
+
+    assert response.status_code == 302
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 0
+
+
+def test_download_count_rolls_back_when_stream_breaks(
+    app, app_client, mongo_collection, monkeypatch
+):
+    def broken_stream(size):
+        yield b"partial"
+        raise OSError("connection reset")
+
+    minio_response = MagicMock()
+    minio_response.stream.side_effect = broken_stream
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(return_value=minio_response)
+    )
+
+    response = app_client.get("/files/test_no_password/download")
+    with pytest.raises(OSError):
+        response.get_data()
+
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 0
+    minio_response.release_conn.assert_called_once()
+
+
+def test_duplicate_uploads_share_one_blob(app, app_client, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+    compose = MagicMock()
+    monkeypatch.setattr(app.minio_client, "compose_object", compose)
+    app.mongo_db["blobs"].delete_many({})
+
+    file_ids = []
+    for name in ("setup.exe", "copy-of-setup.exe"):
+        response = app_client.put(
+            "/upload",
+            data=b"same installer bytes",
+            headers={"X-File-Name": name},
+        )
+        file_ids.append(response.get_json()["file_id"])
+
+    first, second = (app.mongo_db["files"].find_one({"_id": i}) for i in file_ids)
+    assert first["blob_id"] == second["blob_id"]
+    assert first["blob_id"].startswith("sha256:")
+    assert first["saved_filename"] == second["saved_filename"]
+    assert first["saved_filename"] == f"objects/{file_ids[0]}"
+    compose.assert_not_called()  # the first upload's object is kept as the blob
+    blob = app.mongo_db["blobs"].find_one({"_id": first["blob_id"]})
+    assert blob["refcount"] == 2
+
+
+def serve_bytes(payload, chunk_size=None):
+    def get_object(bucket_name, object_name, offset=0, length=0, **kwargs):
+        end = offset + length if length else len(payload)
+        step = chunk_size or max(end - offset, 1)
+        minio_response = MagicMock()
+        minio_response.stream.return_value = iter(
+            [
+                payload[start : min(start + step, end)]
+                for start in range(offset, end, step)
+            ]
+        )
+        return minio_response
+
+    return get_object
+
+
+@pytest.fixture
+def ranged_file(app, mongo_collection, monkeypatch):
+    payload = bytes(range(256)) * 4
+    mongo_collection.update_one(
+        {"_id": "test_no_password"},
+        {"$set": {"file_size": len(payload), "content_type": "video/mp4"}},
+    )
+    app.metadata_cache.invalidate("test_no_password")
+    monkeypatch.setattr(app.minio_client, "get_object", serve_bytes(payload))
+    return payload
+
+
+def test_single_range_returns_partial_content(app_client, ranged_file):
+    response = app_client.get(
+        "/files/test_no_password/download", headers={"Range": "bytes=10-19"}
+    )
+
+    assert response.status_code == 206
+    assert response.data == ranged_file[10:20]
+    assert response.headers["Content-Range"] == f"bytes 10-19/{len(ranged_file)}"
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+
+def test_multiple_ranges_return_multipart_byteranges(app_client, ranged_file):
+    response = app_client.get(
+        "/files/test_no_password/download", headers={"Range": "bytes=0-3,-4"}
+    )
+
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    assert int(response.headers["Content-Length"]) == len(response.data)
+    assert ranged_file[0:4] in response.data
+    assert ranged_file[-4:] in response.data
+    assert b"Content-Range: bytes 0-3/1024" in response.data
+    assert b"Content-Range: bytes 1020-1023/1024" in response.data
+
+
+def test_unsatisfiable_range(app_client, ranged_file):
+    response = app_client.get(
+        "/files/test_no_password/download", headers={"Range": "bytes=5000-"}
+    )
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */1024"
+
+
+def test_unsatisfiable_range_is_not_counted(app, ranged_file, mongo_collection):
+    mongo_collection.update_one(
+        {"_id": "test_no_password"}, {"$set": {"download_limit": 1}}
+    )
+    app.metadata_cache.invalidate("test_no_password")
+    client = app.test_client()
+
+    for _ in range(2):
+        response = client.get(
+            "/files/test_no_password/download", headers={"Range": "bytes=5000-"}
+        )
+        assert response.status_code == 416
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 0
+    assert client.get("/files/test_no_password/download").data == ranged_file
+
+
+def test_stale_if_range_sends_full_file(app_client, ranged_file):
+    response = app_client.get(
+        "/files/test_no_password/download",
+        headers={"Range": "bytes=10-19", "If-Range": '"some-other-version"'},
+    )
+    assert response.status_code == 200
+    assert response.data == ranged_file
+
+
+def test_resumed_range_requests_count_once(
+    app, ranged_file, mongo_collection, monkeypatch
+):
+    monkeypatch.setattr(
+        app.minio_client, "get_object", serve_bytes(ranged_file, chunk_size=256)
+    )
+    client = app.test_client()
+    # The connection drops after the first chunk
+    first = client.get("/files/test_no_password/download", buffered=False)
+    assert first.status_code == 200
+    first.close()
+
+    resumed = client.get(
+        "/files/test_no_password/download",
+        headers={"Range": "bytes=512-", "If-Range": first.headers["ETag"]},
+    )
+    assert resumed.status_code == 206
+    assert resumed.data == ranged_file[512:]
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 1
+
+    # Those bytes were served under the grant, so fetching them again counts
+    client.get("/files/test_no_password/download", headers={"Range": "bytes=512-"})
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 2
+
+    # A fresh client has no grant, so its ranged request is a new download
+    app.test_client().get(
+        "/files/test_no_password/download", headers={"Range": "bytes=0-9"}
+    )
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 3
+
+
+def upload_bundle(app_client, files, **form):
+    return app_client.post(
+        "/bundles",
+        data={
+            "files": [(io.BytesIO(data), name) for name, data in files],
+            **form,
+        },
+        content_type="multipart/form-data",
+        headers={"X-Requested-With": "XMLHttpRequest"},
+    )
+
+
+def test_bundle_upload_stores_files_in_one_request(app, app_client, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+    monkeypatch.setattr(app.minio_client, "compose_object", MagicMock())
+    files = [(f"photo{i}.jpg", f"photo {i}".encode()) for i in range(5)]
+
+    response = upload_bundle(
+        app_client, files, **{"password": "bundlepw", "download-limit": "3"}
+    )
+
+    assert response.status_code == 200
+    result = response.get_json()
+    bundle = app.mongo_db["bundles"].find_one({"_id": result["bundle_id"]})
+    assert bundle["file_ids"] == result["file_ids"]
+    assert bundle["file_count"] == 5
+    assert bundle["total_size"] == sum(len(data) for _, data in files)
+
+    file_docs = list(app.mongo_db["files"].find({"bundle_id": result["bundle_id"]}))
+    assert sorted(doc["original_filename"] for doc in file_docs) == [
+        name for name, _ in files
+    ]
+    # The bundle's options are shared, including a single password hash
+    assert {doc["password"] for doc in file_docs} == {bundle["password"]}
+    assert all(doc["download_limit"] == 3 for doc in file_docs)
+    assert all(stored[f"objects/{doc['_id']}"] for doc in file_docs)
+
+
+def test_bundle_page_lists_files_after_password(app, app_client, monkeypatch):
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio({}))
+    monkeypatch.setattr(app.minio_client, "compose_object", MagicMock())
+    response = upload_bundle(
+        app_client, [("a.txt", b"a"), ("b.txt", b"b")], password="bundlepw"
+    )
+    bundle_id = response.get_json()["bundle_id"]
+
+    locked = app_client.get(f"/bundles/{bundle_id}")
+    assert b"Enter Password" in locked.data
+    assert f"/bundles/{bundle_id}".encode() in locked.data
+
+    unlocked = app_client.post(f"/bundles/{bundle_id}", data={"password": "bundlepw"})
+    assert b"a.txt" in unlocked.data and b"b.txt" in unlocked.data
+    assert unlocked.data.count(b"/download?token=") == 2
+
+
+def test_bundle_success_page(app, app_client, monkeypatch):
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio({}))
+    monkeypatch.setattr(app.minio_client, "compose_object", MagicMock())
+    response = upload_bundle(app_client, [("a.txt", b"a"), ("b.txt", b"b")])
+
+    page = app_client.get(response.get_json()["redirect_url"])
+    assert b"2 files" in page.data
+    assert f"/bundles/{response.get_json()['bundle_id']}".encode() in page.data
+
+
+def test_failed_bundle_upload_leaves_nothing_behind(app, app_client, monkeypatch):
+    def put_object(bucket_name, object_name, data, length, **kwargs):
+        if data.read() == b"bad":
+            raise RuntimeError("MinIO unavailable")
+        return MagicMock(etag="etag")
+
+    monkeypatch.setattr(app.minio_client, "put_object", put_object)
+    monkeypatch.setattr(app.minio_client, "compose_object", MagicMock())
+    monkeypatch.setattr(app.minio_client, "remove_objects", MagicMock(return_value=[]))
+    app.mongo_db["blobs"].delete_many({})
+    files_before = app.mongo_db["files"].count_documents({})
+
+    response = upload_bundle(app_client, [("good.txt", b"good"), ("bad.txt", b"bad")])
+
+    assert response.status_code == 500
+    assert app.mongo_db["files"].count_documents({}) == files_before
+    assert app.mongo_db["blobs"].count_documents({}) == 0
+
+
+def test_bundle_upload_requires_files(app_client):
+    response = upload_bundle(app_client, [])
+    assert response.status_code == 400
+
+
+def test_archive_streams_several_files(app, app_client, mongo_collection, monkeypatch):
+    payloads = {
+        "nopassword_saved.txt": b"first file",
+        "withpassword_saved.txt": b"second file",
+    }
+
+    def get_object(bucket_name, object_name, **kwargs):
+        minio_response = MagicMock()
+        minio_response.stream.return_value = iter([payloads[object_name]])
+        return minio_response
+
+    monkeypatch.setattr(app.minio_client, "get_object", get_object)
+    token = issue_download_token(app.secret_key, "test_with_password")
+
+    response = app_client.get(
+        "/archive",
+        query_string={
+            "file": ["test_no_password", "test_with_password"],
+            "token-test_with_password": token,
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.read("nopassword.txt") == b"first file"
+    assert archive.read("withpassword.txt") == b"second file"
+    counts = {
+        doc["_id"]: doc["download_count"]
+        for doc in mongo_collection.find(
+            {"_id": {"$in": ["test_no_password", "test_with_password"]}}
+        )
+    }
+    assert counts == {"test_no_password": 1, "test_with_password": 1}
+
+
+def test_archive_checks_every_file(app_client, mongo_collection):
+    response = app_client.get(
+        "/archive", query_string={"file": ["test_no_password", "test_with_password"]}
+    )
+    assert response.status_code == 403
+    assert response.get_json()["file_id"] == "test_with_password"
+
+    response = app_client.get(
+        "/archive", query_string={"file": ["test_no_password", "test_expired_file"]}
+    )
+    assert response.status_code == 410
+    # Nothing is counted when the archive is refused
+    doc = mongo_collection.find_one({"_id": "test_no_password"})
+    assert doc["download_count"] == 0
+
+
+def test_async_finalization_returns_before_anything_is_stored(
+    app, app_client, monkeypatch, tmp_path
+):
+    monkeypatch.setitem(app.config, "ASYNC_UPLOAD_FINALIZE", True)
+    monkeypatch.setattr(app.upload_finalizer, "staging_dir", str(tmp_path))
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+
+    response = app_client.put(
+        "/upload", data=b"queued bytes", headers={"X-File-Name": "queued.txt"}
+    )
+    file_id = response.get_json()["file_id"]
+
+    # Neither MinIO nor the files collection was written by the request
+    assert stored == {}
+    assert app.mongo_db["files"].find_one({"_id": file_id}) is None
+    assert app.upload_finalizer.stats()["queue_depth"] >= 1
+    assert b"Processing Upload" in app_client.get(f"/files/{file_id}/success").data
+    assert b"being processed" in app_client.get(f"/files/{file_id}").data
+    download = app_client.get(f"/files/{file_id}/download")
+    assert download.status_code == 302
+
+    assert app.upload_finalizer.finalize(file_id)
+    file_doc = app.mongo_db["files"].find_one({"_id": file_id})
+    assert file_doc["saved_filename"] == f"objects/{file_id}"
+    assert stored[f"objects/{file_id}"] == b"queued bytes"
+    assert b"Upload Successful" in app_client.get(f"/files/{file_id}/success").data
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_readiness_reports_bootstrap(app, app_client, monkeypatch):
+    monkeypatch.setattr(app.storage_bootstrap, "ready", False)
+    assert app_client.get("/ready").status_code == 503
+
+    app.storage_bootstrap.ensure()
+    response = app_client.get("/ready")
+    assert response.status_code == 200
+    assert response.get_json()["ready"] is True
+
+
+def test_uploads_do_not_check_the_bucket_each_time(app, app_client, monkeypatch):
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio({}))
+    bucket_exists = MagicMock(return_value=True)
+    monkeypatch.setattr(app.minio_client, "bucket_exists", bucket_exists)
+    app.storage_bootstrap.ensure()
+
+    for name in ("one.txt", "two.txt"):
+        app_client.put("/upload", data=b"data", headers={"X-File-Name": name})
+
+    bucket_exists.assert_not_called()
+
+
+def test_grant_does_not_allow_full_refetch_past_limit(
+    app, ranged_file, mongo_collection
+):
+    mongo_collection.update_one(
+        {"_id": "test_no_password"}, {"$set": {"download_limit": 1}}
+    )
+    app.metadata_cache.invalidate("test_no_password")
+    client = app.test_client()
+
+    first = client.get(
+        "/files/test_no_password/download", headers={"Range": "bytes=0-99"}
+    )
+    assert first.status_code == 206
+
+    # Continuing the counted download is still allowed
+    resumed = client.get(
+        "/files/test_no_password/download", headers={"Range": "bytes=100-"}
+    )
+    assert resumed.status_code == 206
+    assert resumed.data == ranged_file[100:]
+
+    # Every byte was served, so any range is a second download
+    for byte_range in ("bytes=1-", "bytes=0-"):
+        again = client.get(
+            "/files/test_no_password/download", headers={"Range": byte_range}
+        )
+        assert again.status_code == 302
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 1
+
+
+def test_bundle_archive_link_stays_short(app, app_client, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+    files = [(f"doc{i}.txt", f"document {i}".encode()) for i in range(40)]
+    response = upload_bundle(app_client, files, password="bundlepw")
+    bundle_id = response.get_json()["bundle_id"]
+
+    page = app_client.post(f"/bundles/{bundle_id}", data={"password": "bundlepw"})
+    archive_url = re.search(
+        rb'href="([^"]*/bundles/[^"]*/archive[^"]*)"', page.data
+    ).group(1)
+    # One bundle token instead of one token per protected file
+    assert len(archive_url) < 300
+
+    def get_object(bucket_name, object_name, **kwargs):
+        minio_response = MagicMock()
+        minio_response.stream.return_value = iter([stored[object_name]])
+        return minio_response
+
+    monkeypatch.setattr(app.minio_client, "get_object", get_object)
+    archive = app_client.get(archive_url.decode().replace("&amp;", "&"))
+    assert archive.status_code == 200
+    names = zipfile.ZipFile(io.BytesIO(archive.data)).namelist()
+    assert sorted(names) == sorted(name for name, _ in files)
+
+    # Without the token the archive is refused
+    assert app_client.get(f"/bundles/{bundle_id}/archive").status_code == 302
+
+
+def test_hot_downloads_are_served_from_disk_cache(
+    app, app_client, mongo_collection, monkeypatch, tmp_path
+):
+    from app.objectcache import ObjectCache
+
+    monkeypatch.setattr(app, "object_cache", ObjectCache(str(tmp_path), 4096, 4096))
+    payload = bytes(range(250)) * 4  # matches the document's file_size
+    get_object = MagicMock(side_effect=serve_bytes(payload))
+    monkeypatch.setattr(app.minio_client, "get_object", get_object)
+
+    first = app_client.get("/files/test_no_password/download")
+    assert first.data == payload
+    # The copy is written while the miss is sent and kept once it's closed
+    first.close()
+    second = app_client.get("/files/test_no_password/download")
+    ranged = app_client.get(
+        "/files/test_no_password/download", headers={"Range": "bytes=10-19"}
+    )
+
+    assert second.data == payload
+    assert "nopassword.txt" in second.headers["Content-Disposition"]
+    assert ranged.status_code == 206
+    assert ranged.data == payload[10:20]
+    assert get_object.call_count == 1
+    assert app.object_cache.stats()["hits"] == 2
+
+
+def test_download_revalidation_returns_304_without_fetching(
+    app, app_client, ranged_file, mongo_collection, monkeypatch
+):
+    first = app_client.get("/files/test_no_password/download")
+    assert first.headers["Cache-Control"].startswith("public")
+    get_object = MagicMock()
+    monkeypatch.setattr(app.minio_client, "get_object", get_object)
+
+    response = app_client.get(
+        "/files/test_no_password/download",
+        headers={"If-None-Match": first.headers["ETag"]},
+    )
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == first.headers["ETag"]
+    get_object.assert_not_called()
+    assert mongo_collection.find_one({"_id": "test_no_password"})["download_count"] == 1
+
+
+def test_protected_downloads_are_never_cached_publicly(
+    app, app_client, mongo_collection, monkeypatch
+):
+    minio_response = MagicMock()
+    minio_response.stream.return_value = iter([b"secret"])
+    monkeypatch.setattr(
+        app.minio_client, "get_object", MagicMock(return_value=minio_response)
+    )
+    token = issue_download_token(app.secret_key, "test_with_password")
+
+    response = app_client.get(f"/files/test_with_password/download?token={token}")
+
+    assert response.status_code == 200
+    assert "public" not in response.headers["Cache-Control"]
+    assert "private" in response.headers["Cache-Control"]
+
+    page = app_client.post(
+        "/files/test_with_password", data={"password": "testpassword"}
+    )
+    assert "no-store" in page.headers["Cache-Control"]
+    assert "ETag" not in page.headers
+
+
+def test_public_cache_lifetime_stops_at_expiry(app, app_client, mongo_collection):
+    from app.routes import set_download_cache_control
+
+    soon = datetime.now(timezone.utc) + timedelta(seconds=120)
+    file_doc = {"_id": "x", "has_password": False, "expiration_date": soon}
+    response = routes.Response()
+    set_download_cache_control(response, file_doc)
+
+    assert response.cache_control.public
+    assert 0 < response.cache_control.max_age <= 120
+
+
+def test_file_pages_are_revalidated_with_304(app_client, mongo_collection):
+    page = app_client.get("/files/test_no_password")
+    assert page.status_code == 200
+    etag = page.headers["ETag"]
+
+    again = app_client.get("/files/test_no_password", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+
+    # A download changes what the page shows
+    mongo_collection.update_one(
+        {"_id": "test_no_password"}, {"$set": {"download_count": 1}}
+    )
+    routes.current_app.metadata_cache.invalidate("test_no_password")
+    changed = app_client.get(
+        "/files/test_no_password", headers={"If-None-Match": etag}
+    )
+    assert changed.status_code == 200
+
+    success = app_client.get("/files/test_no_password/success")
+    assert app_client.get(
+        "/files/test_no_password/success",
+        headers={"If-None-Match": success.headers["ETag"]},
+    ).status_code == 304
+
+
+def test_text_uploads_are_stored_compressed(
+    app, app_client, mongo_collection, monkeypatch
+):
+    import gzip
+
+    monkeypatch.setitem(app.config, "STORAGE_COMPRESSION", "gzip")
+    stored = {}
+    monkeypatch.setattr(app.minio_client, "put_object", read_into_minio(stored))
+    text = b"2024-01-01 INFO request served\n" * 2000
+
+    response = app_client.put(
+        "/upload",
+        data=text,
+        headers={"X-File-Name": "server.log", "Content-Type": "text/plain"},
+    )
+    file_id = response.get_json()["file_id"]
+    file_doc = mongo_collection.find_one({"_id": file_id})
+    object_name = f"objects/{file_id}"
+
+    assert file_doc["codec"] == "gzip"
+    assert file_doc["file_size"] == len(text)
+    assert gzip.decompress(stored[object_name]) == text
+
+    def get_object(bucket_name, name, offset=0, length=0, **kwargs):
+        assert offset == 0
+        minio_response = MagicMock()
+        minio_response.stream.return_value = iter([stored[name]])
+        return minio_response
+
+    monkeypatch.setattr(app.minio_client, "get_object", get_object)
+    url = f"/files/{file_id}/download"
+
+    passthrough = app_client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert passthrough.headers["Content-Encoding"] == "gzip"
+    assert passthrough.data == stored[object_name]
+    assert "Accept-Encoding" in passthrough.headers["Vary"]
+
+    decoded = app_client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in decoded.headers
+    assert decoded.data == text
+    assert decoded.headers["ETag"] != passthrough.headers["ETag"]
+
+    ranged = app_client.get(url, headers={"Range": "bytes=100-199"})
+    assert ranged.status_code == 206
+    assert ranged.data == text[100:200]
+
+
+def test_metrics_endpoint_reports_routes_and_bytes(
+    app, app_client, ranged_file, mongo_collection
+):
+    in_flight = app.metrics.transfers_in_flight
+    before = app.metrics.downloaded_bytes.value()
+    active = in_flight.value("download")
+
+    download = app_client.get("/files/test_no_password/download")
+    assert in_flight.value("download") == active + 1
+    download.close()
+    assert in_flight.value("download") == active
+
+    response = app_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    body = response.get_data(as_text=True)
+    assert (
+        'dropit_http_request_duration_seconds_count{method="GET",'
+        'route="/files/<file_id>/download",status="200"}'
+    ) in body
+    assert app.metrics.downloaded_bytes.value() - before == len(ranged_file)
+
+
+def test_upload_records_rate_limit_and_weight(app_client, mongo_collection):
+    response = app_client.put(
+        "/upload?rate-limit=64&bandwidth-weight=99",
+        data=b"limited",
+        headers={"X-File-Name": "limited.bin"},
+    )
+    file_doc = mongo_collection.find_one({"_id": response.get_json()["file_id"]})
+
+    assert file_doc["rate_limit"] == 64 * 1024
+    assert file_doc["bandwidth_weight"] == routes.MAX_BANDWIDTH_WEIGHT
+
+
+def test_rate_limited_download_is_paced(
+    app, app_client, ranged_file, mongo_collection, monkeypatch
+):
+    mongo_collection.update_one(
+        {"_id": "test_no_password"}, {"$set": {"rate_limit": 256}}
+    )
+    app.metadata_cache.invalidate("test_no_password")
+    delays = []
+    monkeypatch.setattr(app.transfer_scheduler, "sleep", delays.append)
+
+    response = app_client.get("/files/test_no_password/download")
+    assert response.data == ranged_file
+    response.close()
+
+    # The first 256 bytes are the bucket's burst; the rest is paced
+    assert sum(delays) == pytest.approx(3.0, abs=0.05)
+    assert app.transfer_scheduler.stats()["active"] == 0
+
+
+def test_failed_download_gives_its_transfer_slot_back(
+    app, app_client, ranged_file, mongo_collection, monkeypatch
+):
+    mongo_collection.update_one(
+        {"_id": "test_no_password"}, {"$set": {"rate_limit": 256}}
+    )
+    app.metadata_cache.invalidate("test_no_password")
+    monkeypatch.setattr(
+        app.storage, "locate", MagicMock(side_effect=RuntimeError("no shard"))
+    )
+
+    with pytest.raises(RuntimeError):
+        app_client.get("/files/test_no_password/download")
+
+    assert app.transfer_scheduler.stats()["active"] == 0
+    file_doc = mongo_collection.find_one({"_id": "test_no_password"})
+    assert file_doc["download_count"] == 0
+
+
+def test_download_is_refused_when_transfer_queue_is_full(
+    app, app_client, ranged_file, mongo_collection, monkeypatch
+):
+    scheduler = app.transfer_scheduler
+    monkeypatch.setattr(scheduler, "max_active", 1)
+    monkeypatch.setattr(scheduler, "max_queue", 0)
+    holder = scheduler.admit("10.0.0.1")
+
+    try:
+        response = app_client.get("/files/test_no_password/download")
+    finally:
+        holder.close()
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+    file_doc = mongo_collection.find_one({"_id": "test_no_password"})
+    assert file_doc["download_count"] == 0
+
+
+def test_download_log_counts_unlimited_downloads_in_batches(
+    app, app_client, ranged_file, mongo_collection, monkeypatch
+):
+    log = app.download_log
+    monkeypatch.setattr(log, "capacity", 100)
+    monkeypatch.setattr(log, "flush_size", 100)
+    app.mongo_db["download_events"].delete_many({})
+
+    for _ in range(3):
+        response = app_client.get("/files/test_no_password/download")
+        assert response.data == ranged_file
+        response.close()
+
+    # Nothing is written on the request path
+    file_doc = mongo_collection.find_one({"_id": "test_no_password"})
+    assert file_doc["download_count"] == 0
+
+    log.flush()
+
+    file_doc = mongo_collection.find_one({"_id": "test_no_password"})
+    assert file_doc["download_count"] == 3
+    stats = app.mongo_db["download_stats"].find_one({"_id": "test_no_password"})
+    assert stats["completed"] == 3
+    assert stats["bytes_served"] == 3 * len(ranged_file)
+    event = app.mongo_db["download_events"].find_one()
+    assert event["client"] == "127.0.0.1"
+    assert event["status"] == "completed"
+
+
+def test_file_listing_requires_admin_token(
+    app, app_client, mongo_collection, monkeypatch
+):
+    assert app_client.get("/files").status_code == 404
+
+    monkeypatch.setitem(app.config, "ADMIN_TOKEN", "s3cret")
+    assert app_client.get("/files").status_code == 401
+
+    headers = {"Authorization": "Bearer s3cret"}
+    first = app_client.get("/files?limit=2", headers=headers)
+    assert first.status_code == 200
+    page = first.get_json()
+    assert len(page["files"]) == 2
+    assert all("password" not in entry for entry in page["files"])
+
+    second = app_client.get(
+        "/files",
+        query_string={"limit": 10, "cursor": page["next_cursor"]},
+        headers=headers,
+    ).get_json()
+    listed = [entry["file_id"] for entry in page["files"] + second["files"]]
+    assert sorted(listed) == sorted(doc["_id"] for doc in mongo_collection.find())
+    assert second["next_cursor"] is None
+
+    bad = app_client.get("/files?cursor=nope", headers=headers)
+    assert bad.status_code == 400
+
+
+def test_uploads_are_stored_and_read_on_their_shard(app, app_client, monkeypatch):
+    east = MagicMock()
+    stored = {}
+    east.put_object.side_effect = read_into_minio(stored)
+    router = StorageRouter(
+        [
+            AppShard(app, "localhost:9000"),
+            Shard("east", "east:9000", "east-bucket", lambda: east),
+        ],
+        app.metrics,
+    )
+    monkeypatch.setattr(router, "place", lambda key: router.shards["east"])
+    monkeypatch.setattr(app, "storage", router)
+
+    response = app_client.post(
+        "/",
+        data={"file": (io.BytesIO(b"east data"), "east.bin")},
+        content_type="multipart/form-data",
+        headers={"X-Requested-With": "XMLHttpRequest"},
+    )
+
+    file_id = response.get_json()["file_id"]
+    assert app.mongo_db["files"].find_one({"_id": file_id})["shard"] == "east"
+    assert stored[f"objects/{file_id}"] == b"east data"
+
+    minio_response = MagicMock()
+    minio_response.stream.return_value = iter([b"east data"])
+    east.get_object.return_value = minio_response
+
+    download = app_client.get(f"/files/{file_id}/download")
+
+    assert download.data == b"east data"
+    assert east.get_object.call_args[0][:2] == ("east-bucket", f"objects/{file_id}")
+    shards = app_client.get("/stats").get_json()["storage"]["shards"]
+    assert shards["east"]["bytes_written"] == len(b"east data")
+    assert shards["east"]["bytes_read"] == len(b"east data")
+
+
+def test_previews_are_generated_after_upload_and_cached(app, app_client, monkeypatch):
+    monkeypatch.setattr(app, "minio_client", LocalObjectStore())
+    monkeypatch.setattr(app.preview_generator, "workers", 1)
+
+    response = app_client.post(
+        "/",
+        data={"file": (io.BytesIO(b"line one\nline two\n"), "notes.txt")},
+        content_type="multipart/form-data",
+        headers={"X-Requested-With": "XMLHttpRequest"},
+    )
+    file_id = response.get_json()["file_id"]
+    file_doc = app.mongo_db["files"].find_one({"_id": file_id})
+    assert file_doc["preview"] == {"status": "pending"}
+    assert app.preview_generator.generate(file_id)
+
+    page = app_client.get(f"/files/{file_id}/preview")
+    assert page.status_code == 200
+    assert f"/files/{file_id}/preview/content" in page.get_data(as_text=True)
+
+    content = app_client.get(f"/files/{file_id}/preview/content")
+    assert content.data == b"line one\nline two\n"
+    assert content.mimetype == "text/plain"
+    # Cached for long, but never past the link's expiry
+    assert content.cache_control.public
+    expires_at = file_doc["expiration_date"].replace(tzinfo=timezone.utc)
+    remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+    assert 0 < content.cache_control.max_age <= remaining
+
+    revalidated = app_client.get(
+        f"/files/{file_id}/preview/content",
+        headers={"If-None-Match": content.headers["ETag"]},
+    )
+    assert revalidated.status_code == 304
+
+
+def test_protected_files_have_no_preview(app_client, mongo_collection):
+    page = app_client.get("/files/test_with_password/preview")
+    assert page.status_code == 302
+    assert page.headers["Location"].endswith("/files/test_with_password")
+
+    content = app_client.get("/files/test_with_password/preview/content")
+    assert content.status_code == 404
+
+
+def test_download_limited_files_have_no_preview(app, app_client, mongo_collection):
+    # Made before limited files were excluded
+    mongo_collection.update_one(
+        {"_id": "test_no_password"},
+        {
+            "$set": {
+                "download_limit": 1,
+                "preview": {"status": "ready", "etag": "p", "shard": None},
+            }
+        },
+    )
+    app.metadata_cache.invalidate("test_no_password")
+
+    page = app_client.get("/files/test_no_password/preview")
+    assert page.status_code == 302
+    content = app_client.get("/files/test_no_password/preview/content")
+    assert content.status_code == 404
@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+
+from app.shaping import ShapedBody, TokenBucket, TransferScheduler, TransfersBusy
+
+
+def scheduler(**limits):
+    options = {
+        "max_active": 0,
+        "max_queue": 0,
+        "queue_timeout": 5,
+        "egress_rate": 0,
+        "client_rate": 0,
+    }
+    options.update(limits)
+    scheduler = TransferScheduler(**options)
+    scheduler.delays = []
+    scheduler.sleep = scheduler.delays.append
+    return scheduler
+
+
+def test_token_bucket_allows_burst_then_reports_debt():
+    bucket = TokenBucket(rate=1000)
+
+    assert bucket.consume(1000) == 0
+    assert bucket.consume(500) == pytest.approx(0.5, abs=0.01)
+
+
+def test_transfer_is_paced_by_its_own_rate():
+    limits = scheduler()
+    transfer = limits.admit("10.0.0.1", rate=1000)
+
+    body = ShapedBody([b"x" * 1000, b"x" * 2000], transfer)
+    assert b"".join(body) == b"x" * 3000
+    body.close()
+
+    assert limits.delays == [pytest.approx(2.0, abs=0.01)]
+    assert limits.stats()["active"] == 0
+
+
+def test_egress_budget_is_shared_by_weight():
+    limits = scheduler(egress_rate=3000)
+    light = limits.admit("10.0.0.1")
+    heavy = limits.admit("10.0.0.2", weight=2)
+
+    assert limits.fair_share(light.weight) == 1000
+    assert limits.fair_share(heavy.weight) == 2000
+
+    heavy.close()
+    assert limits.fair_share(light.weight) == 3000
+    light.close()
+
+
+def test_client_rate_is_shared_by_its_downloads():
+    limits = scheduler(client_rate=1000)
+    first = limits.admit("10.0.0.1")
+    second = limits.admit("10.0.0.1")
+    other = limits.admit("10.0.0.2")
+
+    first.throttle(1000)
+    second.throttle(1000)
+    other.throttle(1000)
+
+    assert limits.delays == [pytest.approx(1.0, abs=0.01)]
+    for transfer in (first, second, other):
+        transfer.close()
+    assert limits.stats()["clients"] == 0
+
+
+def test_waiting_transfers_get_slots_in_order():
+    limits = scheduler(max_active=1, max_queue=1)
+    holder = limits.admit("10.0.0.1")
+    admitted = []
+
+    waiter = threading.Thread(target=lambda: admitted.append(limits.admit("10.0.0.2")))
+    waiter.start()
+    while limits.stats()["waiting"] == 0:
+        pass
+
+    # The queue is full too, so a third transfer is turned away
+    with pytest.raises(TransfersBusy):
+        limits.admit("10.0.0.3")
+
+    holder.close()
+    waiter.join(5)
+    assert admitted and admitted[0].client == "10.0.0.2"
+    assert limits.stats()["active"] == 1
+    admitted[0].close()
+    assert limits.stats()["active"] == 0
+
+
+def test_queued_transfer_gives_up_after_timeout():
+    limits = scheduler(max_active=1, max_queue=1, queue_timeout=0.01)
+    holder = limits.admit("10.0.0.1")
+
+    with pytest.raises(TransfersBusy):
+        limits.admit("10.0.0.2")
+
+    assert limits.stats()["rejected"] == 1
+    assert limits.stats()["waiting"] == 0
+    holder.close()